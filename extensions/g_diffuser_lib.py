@@ -207,6 +207,18 @@ def strip_args(args, level=0): # remove args we wouldn't want to print or serial
         if "no_json" in args_stripped: del args_stripped.no_json
 
         if "uuid_str" in args_stripped: del args_stripped.uuid_str
+        if "answer_id" in args_stripped: del args_stripped.answer_id
+        if "answer_ids" in args_stripped: del args_stripped.answer_ids
+        if "init_answer" in args_stripped:
+            if args_stripped.init_answer == "": del args_stripped.init_answer
+        if "request_id" in args_stripped: del args_stripped.request_id
+        if "checkpoint_steps" in args_stripped:
+            if args_stripped.checkpoint_steps == "": del args_stripped.checkpoint_steps
+        if "resume_from" in args_stripped:
+            if args_stripped.resume_from == "": del args_stripped.resume_from
+        if "priority" in args_stripped:
+            if args_stripped.priority == "": del args_stripped.priority
+        if "user" in args_stripped: del args_stripped.user
         if "status" in args_stripped: del args_stripped.status
         if "err_txt" in args_stripped: del args_stripped.err_txt
 
@@ -337,26 +349,53 @@ def build_sample_args(args):
         if not args.h: args.h = DEFAULT_SAMPLE_SETTINGS.resolution[1]
 
     if "grid_image" in args: del args.grid_image
+    args.answer_ids = [] # answer ids of this batch of samples, to make variations of them later
 
     return init_image, mask_image
 
-def get_samples(args, write=True):
+def get_answer_artifacts(answers): # like grpc_client.process_artifacts_from_answers, but also gives the answer for each artifact
+    for answer in answers:
+        for artifact in answer.artifacts: yield answer, artifact
+
+async def get_answer_artifacts_async(answers):
+    async for answer in answers:
+        for artifact in answer.artifacts: yield answer, artifact
+
+def get_resume_from(args): # "last" resumes from the checkpoints of the previous sample command, so tweaks to it only rerun the last steps
+    if args.resume_from == "last": return args.request_id if "request_id" in args else None
+    return args.resume_from if args.resume_from else None
+
+def get_grpc_client(args): # endlessly repeated samples give way to interactive ones on the server, unless a priority is given
+    priority = vars(args).get("priority", "") or ("batch" if args.n <= 0 else "interactive")
+    user = args.user if "user" in args else None # the server shares its time fairly between users
+    return grpc_client.StabilityInference("localhost:50051", None, engine=args.model_name, verbose=False, priority=priority, user=user)
+
+def get_estimate(args): # how long the server expects a sample command to take and wait for, and if it would accept it right now
+    init_image, mask_image = build_sample_args(args)
+    stability_api = get_grpc_client(args)
+    return stability_api.estimate(args.prompt, **build_grpc_request_dict(args, init_image, mask_image))
+
+def get_samples(args, write=True, on_draft=None): # on_draft is called with the artifact of each draft, if drafts are enabled
     global DEFAULT_PATHS, GRPC_SERVER_SETTINGS
     assert((args.n > 0) or write) # repeating forever without writing to disk wouldn't make much sense
     init_image, mask_image = build_sample_args(args)
 
     samples = []
-    stability_api = grpc_client.StabilityInference("localhost:50051", None, engine=args.model_name, verbose=False)
+    stability_api = get_grpc_client(args)
     while True: # watch out! a wild shrew!
         try:
             request_dict = build_grpc_request_dict(args, init_image, mask_image)
             answers = stability_api.generate(args.prompt, **request_dict)
-            grpc_samples = grpc_client.process_artifacts_from_answers("", answers, write=False, verbose=False)
 
             start_time = datetime.datetime.now(); args.start_time = str(start_time)
-            for path, artifact in grpc_samples:
+            for answer, artifact in get_answer_artifacts(answers):
+                if artifact.draft: # just a preview of the next sample, the full quality sample replaces it
+                    if on_draft: on_draft(artifact)
+                    continue
                 end_time = datetime.datetime.now(); args.end_time = str(end_time); args.elapsed_time = str(end_time-start_time)
                 args.status = 2; args.err_txt = "" # completed successfully
+                args.answer_id = answer.answer_id; args.answer_ids.append(answer.answer_id) # the server keeps the latents of each answer for a while, for variations
+                args.request_id = answer.request_id # and the checkpoints of each request, for resume_from
 
                 image = cv2.imdecode(np.fromstring(artifact.binary, dtype="uint8"), cv2.IMREAD_UNCHANGED)
                 if "annotation" in args: image = get_annotated_image(image, args)
@@ -382,20 +421,25 @@ def get_samples(args, write=True):
         save_samples_grid(samples, args) # if batch size > 1 and write to disk is enabled, save composite "grid image"
     return samples
 
-async def get_samples_async(args, write=True):
+async def get_samples_async(args, write=True, on_draft=None): # on_draft is awaited with the artifact of each draft, if drafts are enabled
     global DEFAULT_PATHS, GRPC_SERVER_SETTINGS
     assert(args.n > 0) # in async mode all batches must have a definite number of samples until we have a way to cancel pipeline requests
     init_image, mask_image = build_sample_args(args)
 
     samples = []
-    stability_api = grpc_client.StabilityInference("localhost:50051", None, engine=args.model_name, verbose=False)
+    stability_api = get_grpc_client(args)
     while True: # watch out! a wild shrew!
         try:
             request_dict = build_grpc_request_dict(args, init_image, mask_image)            
             start_time = datetime.datetime.now(); args.start_time = str(start_time)
-            async for path, artifact in grpc_client.process_artifacts_from_answers_async("", stability_api.generate_async(args.prompt, **request_dict), write=False, verbose=False):
+            async for answer, artifact in get_answer_artifacts_async(stability_api.generate_async(args.prompt, **request_dict)):
+                if artifact.draft: # just a preview of the next sample, the full quality sample replaces it
+                    if on_draft: await on_draft(artifact)
+                    continue
                 end_time = datetime.datetime.now(); args.end_time = str(end_time); args.elapsed_time = str(end_time-start_time)
                 args.status = 2; args.err_txt = "" # completed successfully
+                args.answer_id = answer.answer_id; args.answer_ids.append(answer.answer_id) # the server keeps the latents of each answer for a while, for variations
+                args.request_id = answer.request_id # and the checkpoints of each request, for resume_from
 
                 image = cv2.imdecode(np.fromstring(artifact.binary, dtype="uint8"), cv2.IMREAD_UNCHANGED)
                 if "annotation" in args: image = get_annotated_image(image, args)
@@ -536,7 +580,7 @@ def get_args_parser():
         "--sampler",
         type=str,
         default="k_euler",
-        help="sampler to use (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms)"
+        help="sampler to use (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms, k_dpmpp_2m, k_dpmpp_2m_karras)"
     )  
     parser.add_argument(
         "--command",
@@ -556,18 +600,48 @@ def get_args_parser():
         default=DEFAULT_SAMPLE_SETTINGS.steps,
         help="number of sampling steps (number of times to refine image)",
     )
+    parser.add_argument(
+        "--convergence_tolerance",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.convergence_tolerance,
+        help="stop sampling early once the image changes less than this (relative) per step (0 to disable)",
+    )
+    parser.add_argument(
+        "--convergence_patience",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.convergence_patience,
+        help="number of steps in a row the change must stay below the convergence tolerance to stop early",
+    )
     parser.add_argument(
         "--scale",
         type=float,
         default=DEFAULT_SAMPLE_SETTINGS.scale,
         help="classifier-free guidance scale (~amount of change per step)",
     )
+    parser.add_argument(
+        "--guidance_interval",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.guidance_interval,
+        help="fraction of the sampling steps (from the start) to apply classifier-free guidance for, the remaining steps are about twice as fast",
+    )
+    parser.add_argument(
+        "--guidance_threshold",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.guidance_threshold,
+        help="stop applying classifier-free guidance once the guided and unguided predictions are this close (0 to disable)",
+    )
     parser.add_argument(
         "--noise_q",
         type=float,
         default=DEFAULT_SAMPLE_SETTINGS.noise_q,
         help="falloff of shaped noise distribution for in/out-painting ( > 0), 1 is matched, lower values mean smaller features and higher means larger features",
     )
+    parser.add_argument(
+        "--inpaint_crop_margin",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.inpaint_crop_margin,
+        help="if >= 0, in-painting only samples the masked area plus this many pixels of context around it (-1 to sample the whole image)",
+    )
     parser.add_argument(
         "--noise_start",
         type=float,
@@ -604,12 +678,72 @@ def get_args_parser():
         default=None,
         help="set output height or override height of input image",
     )
+    parser.add_argument(
+        "--hires_fix_strength",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.hires_fix_strength,
+        help="if > 0, images larger than hires_fix_base_size are sampled at that size first, then refined at full size with this strength (0 to disable)",
+    )
+    parser.add_argument(
+        "--hires_fix_base_size",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.hires_fix_base_size,
+        help="size of the longest side of the first, lower resolution, pass of hires fix",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.tile_size,
+        help="if > 0, images larger than this are denoised in overlapping tiles of this size to limit memory use (0 to disable)",
+    )
+    parser.add_argument(
+        "--tile_overlap",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.tile_overlap,
+        help="number of pixels neighbouring tiles overlap by when tiling",
+    )
+    parser.add_argument(
+        "--draft_steps",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.draft_steps,
+        help="if > 0, the server sends a quick draft of each sample with this many steps before the full quality one (0 to disable)",
+    )
+    parser.add_argument(
+        "--draft_scale",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.draft_scale,
+        help="resolution of drafts relative to the sample, at 1 the full quality pass carries on from the draft instead of starting over",
+    )
+    parser.add_argument(
+        "--priority",
+        type=str,
+        default=DEFAULT_SAMPLE_SETTINGS.priority,
+        help="interactive or batch, batch samples give way to interactive ones on the server (defaults to batch for endlessly repeated samples)",
+    )
     parser.add_argument(
         "--init-img",
         type=str,
         default="",
         help="path to the input image",
     )
+    parser.add_argument(
+        "--init_answer",
+        type=str,
+        default="",
+        help="answer id of an earlier sample (saved in its json file) to make variations of, the server reuses its latents instead of an input image",
+    )
+    parser.add_argument(
+        "--checkpoint_steps",
+        type=str,
+        default=DEFAULT_SAMPLE_SETTINGS.checkpoint_steps,
+        help="comma separated steps the server keeps the latents at, so later samples can resume from them",
+    )
+    parser.add_argument(
+        "--resume_from",
+        type=str,
+        default="",
+        help="request id of an earlier sample with checkpoints (or 'last' for the previous sample) to resume from, only running the remaining steps",
+    )
     parser.add_argument(
         "--output_path",
         type=str,
@@ -682,12 +816,28 @@ def build_grpc_request_dict(args, init_image, mask_image):
         "start_schedule": args.noise_start,
         "end_schedule": args.noise_end,
         "cfg_scale": args.scale,
+        "cfg_interval": args.guidance_interval,
+        "cfg_threshold": args.guidance_threshold,
         "eta": args.noise_eta,
         "sampler": grpc_client.get_sampler_from_str(args.sampler),
         "steps": args.steps,
+        "convergence_tolerance": args.convergence_tolerance,
+        "convergence_patience": args.convergence_patience,
         "seed": seed,
         "samples": n,
         "init_image": init_image_bytes,
         "mask_image": mask_image_bytes,
         #"negative_prompt": args.negative_prompt
+        "extended_parameters": {
+            "inpaint_crop_margin": args.inpaint_crop_margin if args.inpaint_crop_margin >= 0 else None,
+            "hires_fix_strength": args.hires_fix_strength if args.hires_fix_strength > 0 else None,
+            "hires_fix_base_size": args.hires_fix_base_size if args.hires_fix_strength > 0 else None,
+            "tile_size": args.tile_size if args.tile_size > 0 else None,
+            "tile_overlap": args.tile_overlap if args.tile_size > 0 else None,
+            "draft_steps": args.draft_steps if args.draft_steps > 0 else None,
+            "draft_scale": args.draft_scale if args.draft_steps > 0 and args.draft_scale < 1 else None,
+            "init_answer": args.init_answer if args.init_answer else None,
+            "checkpoint_steps": args.checkpoint_steps if args.checkpoint_steps else None,
+            "resume_from": get_resume_from(args),
+        },
     }    
\ No newline at end of file
@@ -47,6 +47,8 @@ algorithms: Dict[str, int] = {
     "k_dpm_2": generation.SAMPLER_K_DPM_2,
     "k_dpm_2_ancestral": generation.SAMPLER_K_DPM_2_ANCESTRAL,
     "k_lms": generation.SAMPLER_K_LMS,
+    "k_dpmpp_2m": generation.SAMPLER_K_DPMPP_2M,
+    "k_dpmpp_2m_karras": generation.SAMPLER_K_DPMPP_2M_KARRAS,
 }
 
 def image_to_prompt(im, init: bool = False, mask: bool = False) -> Tuple[str, generation.Prompt]:
@@ -86,6 +88,23 @@ def get_sampler_from_str(s: str) -> generation.DiffusionSampler:
     return algorithm
 
 
+def build_extended_parameters(extended: Dict[str, Union[float, int, str]]) -> generation.ExtendedParameters:
+    """
+    Convert a dictionary of local extension parameters to an ExtendedParameters message.
+
+    :param extended: The parameters, by name. Parameters with a value of None are left out.
+    :return: The ExtendedParameters message, or None if there are no parameters.
+    """
+    parameters = []
+    for name, value in extended.items():
+        if value is None: continue
+        elif isinstance(value, str): parameters.append(generation.ExtendedParameter(name=name, str=value))
+        elif isinstance(value, float): parameters.append(generation.ExtendedParameter(name=name, float=value))
+        else: parameters.append(generation.ExtendedParameter(name=name, int=value))
+
+    return generation.ExtendedParameters(parameters=parameters) if parameters else None
+
+
 def process_artifacts_from_answers(
     prefix: str,
     answers: Union[
@@ -102,12 +121,15 @@ def process_artifacts_from_answers(
     :param write: Whether to write the artifacts to disk.
     :param verbose: Whether to print the artifact filenames.
     :return: A Generator of tuples of artifact filenames and Artifacts, intended
-        for passthrough.
+        for passthrough. Drafts are written too, and their files removed once the
+        artifact that replaces them arrives.
     """
     idx = 0
+    drafts = {}
     for resp in answers:
         for artifact in resp.artifacts:
             artifact_p = f"{prefix}-{resp.request_id}-{resp.answer_id}-{idx}"
+            if artifact.draft: artifact_p = f"{prefix}-{resp.request_id}-draft-{artifact.index}"
             if artifact.type == generation.ARTIFACT_IMAGE:
                 ext = mimetypes.guess_extension(artifact.mime)
                 contents = artifact.binary
@@ -130,6 +152,12 @@ def process_artifacts_from_answers(
                         if artifact.finish_reason == generation.FILTER: logger.info(f"{artifact_t} flagged as NSFW")
 
             yield [out_p, artifact]
+            if artifact.draft:
+                drafts[artifact.index] = out_p
+                continue
+
+            draft_p = drafts.pop(artifact.index, None)
+            if write and draft_p and os.path.exists(draft_p): os.remove(draft_p)
             idx += 1
 
 async def process_artifacts_from_answers_async(
@@ -148,12 +176,15 @@ async def process_artifacts_from_answers_async(
     :param write: Whether to write the artifacts to disk.
     :param verbose: Whether to print the artifact filenames.
     :return: A Generator of tuples of artifact filenames and Artifacts, intended
-        for passthrough.
+        for passthrough. Drafts are written too, and their files removed once the
+        artifact that replaces them arrives.
     """
     idx = 0
+    drafts = {}
     async for resp in answers:
         for artifact in resp.artifacts:
             artifact_p = f"{prefix}-{resp.request_id}-{resp.answer_id}-{idx}"
+            if artifact.draft: artifact_p = f"{prefix}-{resp.request_id}-draft-{artifact.index}"
             if artifact.type == generation.ARTIFACT_IMAGE:
                 ext = mimetypes.guess_extension(artifact.mime)
                 contents = artifact.binary
@@ -176,6 +207,12 @@ async def process_artifacts_from_answers_async(
                         if artifact.finish_reason == generation.FILTER: logger.info(f"{artifact_t} flagged as NSFW")
 
             yield [out_p, artifact]
+            if artifact.draft:
+                drafts[artifact.index] = out_p
+                continue
+
+            draft_p = drafts.pop(artifact.index, None)
+            if write and draft_p and os.path.exists(draft_p): os.remove(draft_p)
             idx += 1
 
 def open_images(
@@ -212,6 +249,8 @@ class StabilityInference:
         verbose: bool = False,
         wait_for_ready: bool = True,
         async_mode: bool = False,
+        priority: str = None,
+        user: str = None,
     ):
         """
         Initialize the client.
@@ -222,12 +261,19 @@ class StabilityInference:
         :param verbose: Whether to print debug messages.
         :param wait_for_ready: Whether to wait for the server to be ready, or
             to fail immediately.
+        :param priority: Priority class to queue requests under (interactive
+            or batch), if the server supports it.
+        :param user: User to share the server fairly between, if the server
+            supports it.
         """
         self.verbose = verbose
         self.engine = engine
 
         self.grpc_args = {"wait_for_ready": wait_for_ready}
 
+        metadata = [(key, value) for key, value in (("priority", priority), ("user", user)) if value]
+        if metadata: self.grpc_args["metadata"] = metadata
+
         if verbose:
             logger.info(f"Opening channel to {host}")
 
@@ -253,17 +299,23 @@ class StabilityInference:
             logger.info(f"Channel opened to {host}")
         self.stub = generation_grpc.GenerationServiceStub(channel)
 
-    def generate(
+    def build_request(
         self,
         prompt: Union[List[str], str],
         negative_prompt: str = None,
         init_image: Image.Image = None,
         mask_image: Image.Image = None,
+        init_latents: generation.Artifact = None,
+        return_latents: bool = False,
         height: int = 512,
         width: int = 512,
         start_schedule: float = 1.0,
         end_schedule: float = 0.01,
         cfg_scale: float = 7.0,
+        cfg_interval: float = None,
+        cfg_threshold: float = None,
+        convergence_tolerance: float = None,
+        convergence_patience: int = None,
         eta: float = 0.0,
         sampler: generation.DiffusionSampler = generation.SAMPLER_K_LMS,
         steps: int = 50,
@@ -271,31 +323,18 @@ class StabilityInference:
         samples: int = 1,
         safety: bool = True,
         classifiers: generation.ClassifierParameters = None,
-    ) -> Generator[generation.Answer, None, None]:
+        extended_parameters: Dict[str, Union[float, int, str]] = None,
+    ) -> generation.Request:
         """
-        Generate images from a prompt.
+        Build the Request that generate sends (see generate for the parameters).
 
-        :param prompt: Prompt to generate images from.
-        :param init_image: Init image.
-        :param mask_image: Mask image
-        :param height: Height of the generated images.
-        :param width: Width of the generated images.
-        :param start_schedule: Start schedule for init image.
-        :param end_schedule: End schedule for init image.
-        :param cfg_scale: Scale of the configuration.
-        :param sampler: Sampler to use.
-        :param steps: Number of steps to take.
-        :param seed: Seed for the random number generator.
-        :param samples: Number of samples to generate.
-        :param safety: Whether to use safety mode.
-        :param classifiers: Classifier parameters to use.
-        :return: Generator of Answer objects.
+        :return: The Request.
         """
         if safety and classifiers is None:
             classifiers = generation.ClassifierParameters()
 
-        if (prompt is None) and (init_image is None):
-            raise ValueError("prompt and/or init_image must be provided")
+        if (prompt is None) and (init_image is None) and (init_latents is None):
+            raise ValueError("prompt, init_image and/or init_latents must be provided")
 
         if (mask_image is not None) and (init_image is None):
             raise ValueError("If mask_image is provided, init_image must also be provided")
@@ -317,12 +356,19 @@ class StabilityInference:
         if negative_prompt:
             prompt += [generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1))]
 
-        if (init_image is not None):
-            prompt += [image_to_prompt(init_image, init=True)]
+        if (init_latents is not None):
+            prompt += [generation.Prompt(artifact=init_latents, parameters=generation.PromptParameters(init=True))]
+
+        if (init_image is not None) or (init_latents is not None):
+            if (init_image is not None): prompt += [image_to_prompt(init_image, init=True)]
             parameters = generation.StepParameter(
                     scaled_step=0,
                     sampler=generation.SamplerParameters(
                         cfg_scale=cfg_scale,
+                        cfg_interval=cfg_interval,
+                        cfg_threshold=cfg_threshold,
+                        convergence_tolerance=convergence_tolerance,
+                        convergence_patience=convergence_patience,
                         eta=eta,
                     ),
                     schedule=generation.ScheduleParameters(
@@ -337,6 +383,10 @@ class StabilityInference:
                     scaled_step=0,
                     sampler=generation.SamplerParameters(
                         cfg_scale=cfg_scale,
+                        cfg_interval=cfg_interval,
+                        cfg_threshold=cfg_threshold,
+                        convergence_tolerance=convergence_tolerance,
+                        convergence_patience=convergence_patience,
                         eta=eta,
                     ),
                 ),
@@ -344,6 +394,7 @@ class StabilityInference:
         rq = generation.Request(
             engine_id=self.engine,
             request_id=request_id,
+            requested_type=generation.ARTIFACT_LATENT if return_latents else generation.ARTIFACT_IMAGE,
             prompt=prompt,
             image=generation.ImageParameters(
                 transform=generation.TransformType(diffusion=sampler),
@@ -353,15 +404,90 @@ class StabilityInference:
                 steps=steps,
                 samples=samples,
                 parameters=parameters,
+                extension=build_extended_parameters(extended_parameters) if extended_parameters else None,
             ),
             #classifier=classifiers,
         )
 
+        return rq
+
+    def estimate(self, prompt: Union[List[str], str], **kwargs) -> generation.CostEstimate:
+        """
+        Ask the server how long a request would take, how long it would wait before it started, and whether it
+        would be accepted right now, without running it.
+
+        :param prompt: Prompt to generate images from.
+        :param kwargs: Any of the other parameters of generate.
+        :return: A CostEstimate.
+        """
+        kwargs.pop("timeout", None)
+        return self.stub.Estimate(self.build_request(prompt, **kwargs), **self.grpc_args)
+
+    def generate(
+        self,
+        prompt: Union[List[str], str],
+        negative_prompt: str = None,
+        init_image: Image.Image = None,
+        mask_image: Image.Image = None,
+        init_latents: generation.Artifact = None,
+        return_latents: bool = False,
+        height: int = 512,
+        width: int = 512,
+        start_schedule: float = 1.0,
+        end_schedule: float = 0.01,
+        cfg_scale: float = 7.0,
+        cfg_interval: float = None,
+        cfg_threshold: float = None,
+        convergence_tolerance: float = None,
+        convergence_patience: int = None,
+        eta: float = 0.0,
+        sampler: generation.DiffusionSampler = generation.SAMPLER_K_LMS,
+        steps: int = 50,
+        seed: Union[Sequence[int], int] = 0,
+        samples: int = 1,
+        safety: bool = True,
+        classifiers: generation.ClassifierParameters = None,
+        extended_parameters: Dict[str, Union[float, int, str]] = None,
+        timeout: float = None,
+    ) -> Generator[generation.Answer, None, None]:
+        """
+        Generate images from a prompt.
+
+        :param prompt: Prompt to generate images from.
+        :param init_image: Init image.
+        :param mask_image: Mask image
+        :param init_latents: Latent artifact returned by an earlier request, to use instead of an init image.
+        :param return_latents: Return the final latents as ARTIFACT_LATENT artifacts, instead of images.
+        :param height: Height of the generated images.
+        :param width: Width of the generated images.
+        :param start_schedule: Start schedule for init image.
+        :param end_schedule: End schedule for init image.
+        :param cfg_scale: Scale of the configuration.
+        :param cfg_interval: Fraction of the steps, from the start, to apply CFG for.
+        :param cfg_threshold: Stop applying CFG once the guided and unguided predictions are this close.
+        :param convergence_tolerance: Stop early once the predicted image changes less than this per step.
+        :param convergence_patience: Number of steps in a row the change must stay below convergence_tolerance.
+        :param sampler: Sampler to use.
+        :param steps: Number of steps to take.
+        :param seed: Seed for the random number generator.
+        :param samples: Number of samples to generate.
+        :param safety: Whether to use safety mode.
+        :param classifiers: Classifier parameters to use.
+        :param extended_parameters: Local extension parameters (like inpaint_crop_margin), by name.
+        :param timeout: Seconds the server has to generate everything, before giving up with DEADLINE_EXCEEDED.
+        :return: Generator of Answer objects.
+        """
+        rq = self.build_request(
+            prompt, negative_prompt, init_image, mask_image, init_latents, return_latents, height, width, 
+            start_schedule, end_schedule, cfg_scale, cfg_interval, cfg_threshold, convergence_tolerance, 
+            convergence_patience, eta, sampler, steps, seed, samples, safety, classifiers, extended_parameters
+        )
+
         if self.verbose:
             logger.info("Sending request.")
 
         start = time.time()
-        answers = self.stub.Generate(rq, **self.grpc_args)
+        answers = self.stub.Generate(rq, timeout=timeout, **self.grpc_args)
 
         def cancel_request(unused_signum, unused_frame):
             #print("Cancelling")
@@ -382,6 +508,7 @@ class StabilityInference:
                     logger.info(
                         f"Got {answer.answer_id} with {artifact_ts} in "
                         f"{duration:0.2f}s"
+                        + (f" after {answer.meta.steps} steps" if answer.meta.HasField("steps") else "")
                     )
                 else:
                     logger.info(
@@ -398,11 +525,17 @@ class StabilityInference:
         negative_prompt: str = None,
         init_image: Image.Image = None,
         mask_image: Image.Image = None,
+        init_latents: generation.Artifact = None,
+        return_latents: bool = False,
         height: int = 512,
         width: int = 512,
         start_schedule: float = 1.0,
         end_schedule: float = 0.01,
         cfg_scale: float = 7.0,
+        cfg_interval: float = None,
+        cfg_threshold: float = None,
+        convergence_tolerance: float = None,
+        convergence_patience: int = None,
         eta: float = 0.0,
         sampler: generation.DiffusionSampler = generation.SAMPLER_K_LMS,
         steps: int = 50,
@@ -410,6 +543,8 @@ class StabilityInference:
         samples: int = 1,
         safety: bool = True,
         classifiers: generation.ClassifierParameters = None,
+        extended_parameters: Dict[str, Union[float, int, str]] = None,
+        timeout: float = None,
     ) -> AsyncGenerator[generation.Answer, None]:
         """
         Generate images from a prompt.
@@ -417,90 +552,38 @@ class StabilityInference:
         :param prompt: Prompt to generate images from.
         :param init_image: Init image.
         :param mask_image: Mask image
+        :param init_latents: Latent artifact returned by an earlier request, to use instead of an init image.
+        :param return_latents: Return the final latents as ARTIFACT_LATENT artifacts, instead of images.
         :param height: Height of the generated images.
         :param width: Width of the generated images.
         :param start_schedule: Start schedule for init image.
         :param end_schedule: End schedule for init image.
         :param cfg_scale: Scale of the configuration.
+        :param cfg_interval: Fraction of the steps, from the start, to apply CFG for.
+        :param cfg_threshold: Stop applying CFG once the guided and unguided predictions are this close.
+        :param convergence_tolerance: Stop early once the predicted image changes less than this per step.
+        :param convergence_patience: Number of steps in a row the change must stay below convergence_tolerance.
         :param sampler: Sampler to use.
         :param steps: Number of steps to take.
         :param seed: Seed for the random number generator.
         :param samples: Number of samples to generate.
         :param safety: Whether to use safety mode.
         :param classifiers: Classifier parameters to use.
+        :param extended_parameters: Local extension parameters (like inpaint_crop_margin), by name.
+        :param timeout: Seconds the server has to generate everything, before giving up with DEADLINE_EXCEEDED.
         :return: Generator of Answer objects.
         """
-        if safety and classifiers is None:
-            classifiers = generation.ClassifierParameters()
-
-        if (prompt is None) and (init_image is None):
-            raise ValueError("prompt and/or init_image must be provided")
-
-        if (mask_image is not None) and (init_image is None):
-            raise ValueError("If mask_image is provided, init_image must also be provided")
-
-        request_id = str(uuid.uuid4())
-
-        if not seed:
-            seed = [random.randrange(0, 4294967295)]
-        else:
-            seed = [seed]
-
-        if isinstance(prompt, str):
-            prompt = [generation.Prompt(text=prompt)]
-        elif isinstance(prompt, Sequence):
-            prompt = [generation.Prompt(text=p) for p in prompt]
-        else:
-            raise TypeError("prompt must be a string or a sequence")
-
-        if negative_prompt:
-            prompt += [generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1))]
-
-        if (init_image is not None):
-            prompt += [image_to_prompt(init_image, init=True)]
-            parameters = generation.StepParameter(
-                    scaled_step=0,
-                    sampler=generation.SamplerParameters(
-                        cfg_scale=cfg_scale,
-                        eta=eta,
-                    ),
-                    schedule=generation.ScheduleParameters(
-                        start=start_schedule,
-                        end=end_schedule,
-                    )
-                ),
-            if (mask_image is not None):
-                prompt += [image_to_prompt(mask_image, mask=True)]
-        else:
-            parameters = generation.StepParameter(
-                    scaled_step=0,
-                    sampler=generation.SamplerParameters(
-                        cfg_scale=cfg_scale,
-                        eta=eta,
-                    ),
-                ),
-
-        rq = generation.Request(
-            engine_id=self.engine,
-            request_id=request_id,
-            prompt=prompt,
-            image=generation.ImageParameters(
-                transform=generation.TransformType(diffusion=sampler),
-                height=height,
-                width=width,
-                seed=seed,
-                steps=steps,
-                samples=samples,
-                parameters=parameters,
-            ),
-            #classifier=classifiers,
+        rq = self.build_request(
+            prompt, negative_prompt, init_image, mask_image, init_latents, return_latents, height, width, 
+            start_schedule, end_schedule, cfg_scale, cfg_interval, cfg_threshold, convergence_tolerance, 
+            convergence_patience, eta, sampler, steps, seed, samples, safety, classifiers, extended_parameters
         )
 
         if self.verbose:
             logger.info("Sending request.")
 
         start = time.time()
-        answers = self.stub.Generate(rq, **self.grpc_args)
+        answers = self.stub.Generate(rq, timeout=timeout, **self.grpc_args)
         #answers = list(answers)
 
         def cancel_request(unused_signum, unused_frame):
@@ -522,6 +605,7 @@ class StabilityInference:
                     logger.info(
                         f"Got {answer.answer_id} with {artifact_ts} in "
                         f"{duration:0.2f}s"
+                        + (f" after {answer.meta.steps} steps" if answer.meta.HasField("steps") else "")
                     )
                 else:
                     logger.info(
@@ -542,6 +626,10 @@ def build_request_dict(cli_args: Namespace) -> Dict[str, Any]:
         "start_schedule": cli_args.start_schedule,
         "end_schedule": cli_args.end_schedule,
         "cfg_scale": cli_args.cfg_scale,
+        "cfg_interval": cli_args.cfg_interval,
+        "cfg_threshold": cli_args.cfg_threshold,
+        "convergence_tolerance": cli_args.convergence_tolerance,
+        "convergence_patience": cli_args.convergence_patience,
         "eta": cli_args.eta,
         "sampler": get_sampler_from_str(cli_args.sampler),
         "steps": cli_args.steps,
@@ -549,7 +637,26 @@ def build_request_dict(cli_args: Namespace) -> Dict[str, Any]:
         "samples": cli_args.num_samples,
         "init_image": cli_args.init_image,
         "mask_image": cli_args.mask_image,
-        "negative_prompt": cli_args.negative_prompt
+        "init_latents": cli_args.init_latents,
+        "return_latents": cli_args.latents,
+        "timeout": cli_args.timeout,
+        "negative_prompt": cli_args.negative_prompt,
+        "extended_parameters": {
+            "inpaint_crop_margin": cli_args.inpaint_crop_margin,
+            "hires_fix_strength": cli_args.hires_fix_strength,
+            "hires_fix_base_size": cli_args.hires_fix_base_size,
+            "tile_size": cli_args.tile_size,
+            "tile_overlap": cli_args.tile_overlap,
+            "tile_batch_size": cli_args.tile_batch_size,
+            "upscaler": cli_args.upscaler,
+            "upscale_factor": cli_args.upscale_factor,
+            "init_answer": cli_args.init_answer,
+            "checkpoint_steps": cli_args.checkpoint_steps,
+            "resume_from": cli_args.resume_from,
+            "draft_steps": cli_args.draft_steps,
+            "draft_scale": cli_args.draft_scale,
+            "deadline_degrade": cli_args.deadline_degrade,
+        },
     }
 
 
@@ -596,6 +703,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--cfg_scale", "-C", type=float, default=7.0, help="[7.0] CFG scale factor"
     )
+    parser.add_argument(
+        "--cfg_interval", type=float, default=None, help="[1.0] fraction of the steps to apply CFG for"
+    )
+    parser.add_argument(
+        "--cfg_threshold", type=float, default=None, help="[0.0] stop applying CFG once the guided and unguided predictions are this close"
+    )
+    parser.add_argument(
+        "--convergence_tolerance", type=float, default=None, help="[0.0] stop early once the image changes less than this per step"
+    )
+    parser.add_argument(
+        "--convergence_patience", type=int, default=None, help="[3] number of steps in a row the change must stay below the tolerance"
+    )
     parser.add_argument(
         "--eta", "-E", type=float, default=0.0, help="[0.0] ETA factor (for DDIM scheduler)"
     )
@@ -641,16 +760,111 @@ if __name__ == "__main__":
         type=str,
         help="Mask image",
     )
+    parser.add_argument(
+        "--init_latents",
+        type=str,
+        help="Latents (a .pb file saved by an earlier --latents run) to use instead of an init image",
+    )
+    parser.add_argument(
+        "--latents", action="store_true", help="return the final latents (saved as .pb files) instead of images, skipping the VAE decode"
+    )
     parser.add_argument(
         "--negative_prompt", "-N",
         type=str,
         help="Negative Prompt",
     )
+    parser.add_argument(
+        "--inpaint_crop_margin",
+        type=int,
+        help="When inpainting, only diffuse the area around the mask plus this many pixels of context",
+    )
+    parser.add_argument(
+        "--hires_fix_strength",
+        type=float,
+        help="Generate large images at a lower resolution first, then refine at full size with this strength",
+    )
+    parser.add_argument(
+        "--hires_fix_base_size",
+        type=int,
+        help="[512] Size of the longest side of the first pass when using hires fix",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        help="Denoise images larger than this in overlapping tiles of this size (a multiple of 64)",
+    )
+    parser.add_argument(
+        "--tile_overlap",
+        type=int,
+        help="[128] Number of pixels neighbouring tiles overlap by when using tiles",
+    )
+    parser.add_argument(
+        "--tile_batch_size",
+        type=int,
+        help="Maximum number of tiles to pass through the model at once (defaults to all of them)",
+    )
+    parser.add_argument(
+        "--upscaler",
+        type=str,
+        help="[rgb] Upscaler to use with --upscale_factor (rgb, esrgan or gfpgan, if the server has them)",
+    )
+    parser.add_argument(
+        "--upscale_factor",
+        type=float,
+        help="Upscale the generated images by this much before returning them",
+    )
+    parser.add_argument(
+        "--init_answer",
+        type=str,
+        help="Make variations of an earlier answer (by answer id), starting from the latents the server kept for it",
+    )
+    parser.add_argument(
+        "--checkpoint_steps",
+        type=str,
+        help="Comma separated steps to keep the intermediate latents at, so later requests can resume from them",
+    )
+    parser.add_argument(
+        "--resume_from",
+        type=str,
+        help="Resume from the checkpoints kept for an earlier request (by request id), rerunning just the remaining steps",
+    )
+    parser.add_argument(
+        "--draft_steps",
+        type=int,
+        help="Return a quick draft of each image with this many steps first, before the full quality result",
+    )
+    parser.add_argument(
+        "--draft_scale",
+        type=float,
+        help="Generate drafts at this fraction of the resolution (the full quality pass can't reuse them then)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Give the server this many seconds to generate everything",
+    )
+    parser.add_argument(
+        "--deadline_degrade",
+        type=str,
+        choices=["steps", "resolution"],
+        help="If the request wouldn't finish within the timeout, reduce the steps or resolution to fit rather than failing",
+    )
+    parser.add_argument(
+        "--priority",
+        type=str,
+        choices=["interactive", "batch"],
+        help="[interactive] Priority to queue the request under, batch requests give way to interactive ones",
+    )
+    parser.add_argument(
+        "--user",
+        type=str,
+        help="User to queue the request as, the server shares its time fairly between users",
+    )
     parser.add_argument("prompt", nargs="*")
 
     args = parser.parse_args()
-    if not args.prompt and not args.init_image:
-        logger.warning("prompt or init image must be provided")
+    if not args.prompt and not args.init_image and not args.init_latents and not args.init_answer:
+        logger.warning("prompt, init image or init latents must be provided")
         parser.print_help()
         sys.exit(1)
     else:
@@ -662,10 +876,14 @@ if __name__ == "__main__":
     if args.mask_image:
         args.mask_image = Image.open(args.mask_image)
 
+    if args.init_latents:
+        with open(args.init_latents, "rb") as f:
+            args.init_latents = generation.Artifact.FromString(f.read())
+
     request = build_request_dict(args)
 
     stability_api = StabilityInference(
-        STABILITY_HOST, STABILITY_KEY, engine=args.engine, verbose=True
+        STABILITY_HOST, STABILITY_KEY, engine=args.engine, verbose=True, priority=args.priority, user=args.user
     )
 
     answers = stability_api.generate(args.prompt, **request)
@@ -0,0 +1,191 @@
+import threading, time
+from contextlib import contextmanager
+from types import SimpleNamespace as SN
+
+# Seconds per step at 512x512 to assume for an engine before any of its requests have been timed
+DEFAULT_STEP_SECONDS = 0.25
+
+# Pixel counts are measured in units of 512x512
+UNIT_PIXELS = 512 * 512
+
+# Priority classes, highest first
+PRIORITIES = ("interactive", "batch")
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, wait):
+        super().__init__(f"Server is busy, try again in about {wait:.0f}s")
+        self.wait = wait
+
+class _StepFit(object):
+    """
+    An exponentially weighted least squares fit of seconds per step against pixels, so newer timings count for more.
+    Until there are timings at more than one resolution, step time is assumed to be proportional to pixels
+    """
+
+    def __init__(self, decay):
+        self._decay = decay
+        self._sums = [0.0] * 5 # weight, x, y, xx, xy
+
+    def add(self, x, y):
+        self._sums = [total * self._decay + value for total, value in zip(self._sums, (1, x, y, x * x, x * y))]
+
+    def predict(self, x):
+        w, sx, sy, sxx, sxy = self._sums
+        variance = w * sxx - sx * sx
+
+        if variance > 1e-6 * w * w:
+            slope = (w * sxy - sx * sy) / variance
+            intercept = (sy - slope * sx) / w
+            prediction = intercept + slope * x
+            # An odd set of timings can give a silly fit, so fall back to proportional if so
+            if slope >= 0 and prediction > 0: return prediction
+
+        return sy / sx * x
+
+class CostModel(object):
+    """
+    Learns how long a denoising step takes from the samples the server generates, per engine and sampler, as a function
+    of resolution. Step time includes a share of the per sample fixed costs (like the VAE). Samplers that haven't been
+    timed on an engine fall back to that engine's timings for any sampler, and engines that haven't been timed at all
+    to DEFAULT_STEP_SECONDS
+    """
+
+    def __init__(self, decay=0.9, default_step_seconds=DEFAULT_STEP_SECONDS):
+        self._decay = decay
+        self._default = default_step_seconds
+        self._fits = {}
+        self._lock = threading.Lock()
+
+    def record(self, engine_id, sampler, pixels, steps, seconds):
+        if steps <= 0 or pixels <= 0: return
+        x, y = pixels / UNIT_PIXELS, seconds / steps
+
+        with self._lock:
+            for key in ((engine_id, sampler), (engine_id, None)):
+                self._fits.setdefault(key, _StepFit(self._decay)).add(x, y)
+
+    def estimate(self, engine_id, sampler, pixels, steps, learned_only=False):
+        """
+        Seconds to run this many steps at this many pixels. If learned_only, returns None rather than guessing for an
+        engine that hasn't been timed yet
+        """
+        x = pixels / UNIT_PIXELS
+
+        with self._lock:
+            fit = self._fits.get((engine_id, sampler)) or self._fits.get((engine_id, None))
+            if fit is not None: return fit.predict(x) * steps
+
+        return None if learned_only else self._default * x * steps
+
+class AdmissionController(object):
+    """
+    Runs requests one at a time from a bounded queue. A request is only admitted if the queue (including the running
+    request) is shorter than max_queue, and the estimated cost of everything queued plus the new request is no more than
+    max_outstanding_cost seconds. An idle server always admits a request, however expensive.
+
+    The next request to run is picked by priority class, interactive before batch, but a batch request that has waited 
+    for aging_seconds is treated as interactive, so batch work can't be starved forever. Within a class, owners (users
+    or access tokens) get a fair share of the server in proportion to their weight (default 1), by start time fair 
+    queuing on the estimated costs, with each owner's requests run in the order they were admitted
+    """
+
+    def __init__(self, max_queue=16, max_outstanding_cost=600, aging_seconds=120, weights=None):
+        self.max_queue = max_queue
+        self.max_outstanding_cost = max_outstanding_cost
+        self.aging_seconds = aging_seconds
+        self.weights = weights or {}
+
+        self._queue = []
+        self._running = None
+        self._virtual_time = 0.0
+        self._finish_tags = {}
+        self._condition = threading.Condition()
+
+    def _remaining(self, ticket):
+        if ticket.started is None: return ticket.cost
+        return max(ticket.cost - (time.monotonic() - ticket.started), 0)
+
+    def _admissible(self, cost):
+        if not self._queue: return True
+        if len(self._queue) >= self.max_queue: return False
+        return sum(ticket.cost for ticket in self._queue) + cost <= self.max_outstanding_cost
+
+    def _ticket(self, cost, priority, owner):
+        if priority not in PRIORITIES: priority = "interactive"
+
+        # The virtual time an owner's next request starts at, which moves on by cost / weight for every request
+        start_tag = max(self._virtual_time, self._finish_tags.get(owner, 0.0))
+        return SN(cost=cost, priority=priority, owner=owner, admitted=time.monotonic(), started=None, start_tag=start_tag)
+
+    def _order(self, ticket, now):
+        aged = now - ticket.admitted >= self.aging_seconds
+        return (0 if ticket.priority == "interactive" or aged else 1, ticket.start_tag, ticket.admitted)
+
+    def _next(self):
+        now = time.monotonic()
+        waiting = [ticket for ticket in self._queue if ticket is not self._running]
+        return min(waiting, key=lambda ticket: self._order(ticket, now)) if waiting else None
+
+    def _wait(self, ticket):
+        # Time until the ticket would start, if nothing else was admitted in the meantime
+        now = time.monotonic()
+        order = self._order(ticket, now)
+        ahead = [other for other in self._queue if other is self._running or self._order(other, now) < order]
+        return sum(self._remaining(other) for other in ahead), len(ahead)
+
+    def estimate(self, cost, priority="interactive", owner=""):
+        """
+        Returns (estimated wait in seconds before a request of this cost would start, number of requests that would be 
+        ahead of it, admissible)
+        """
+        with self._condition:
+            wait, ahead = self._wait(self._ticket(cost, priority, owner))
+            return wait, ahead, self._admissible(cost)
+
+    def admit(self, cost, priority="interactive", owner=""):
+        with self._condition:
+            ticket = self._ticket(cost, priority, owner)
+            if not self._admissible(cost): raise AdmissionRejectedError(self._wait(ticket)[0])
+
+            self._finish_tags[owner] = ticket.start_tag + cost / self.weights.get(owner, 1)
+            self._queue.append(ticket)
+            return ticket
+
+    def wait(self, ticket, stop_event):
+        """Wait for the ticket's turn. Returns False (and gives up its place) if the stop event is set first"""
+        with self._condition:
+            while self._running is not None or self._next() is not ticket:
+                if stop_event.is_set():
+                    self._release(ticket)
+                    return False
+
+                # Stop events don't notify the condition (and waiting tickets age), so check every now and then
+                self._condition.wait(timeout=0.25)
+
+            self._running = ticket
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            ticket.started = time.monotonic()
+            return True
+
+    def _release(self, ticket):
+        if ticket in self._queue: self._queue.remove(ticket)
+        if self._running is ticket: self._running = None
+
+        # Forget owners that have caught up with virtual time, they'd start from there anyway
+        self._finish_tags = {owner: tag for owner, tag in self._finish_tags.items() if tag > self._virtual_time}
+        self._condition.notify_all()
+
+    def release(self, ticket):
+        with self._condition: self._release(ticket)
+
+    @contextmanager
+    def slot(self, cost, stop_event, priority="interactive", owner=""):
+        """
+        Admit a request and wait for its turn, yielding True once it's running, or False if it was stopped while
+        waiting. Raises AdmissionRejectedError if it isn't admitted
+        """
+        ticket = self.admit(cost, priority, owner)
+        try:
+            yield self.wait(ticket, stop_event)
+        finally:
+            self.release(ticket)
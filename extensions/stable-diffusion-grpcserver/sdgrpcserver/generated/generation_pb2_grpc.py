@@ -27,6 +27,11 @@ class GenerationServiceStub(object):
                 request_serializer=generation__pb2.ChainRequest.SerializeToString,
                 response_deserializer=generation__pb2.Answer.FromString,
                 )
+        self.Estimate = channel.unary_unary(
+                '/gooseai.GenerationService/Estimate',
+                request_serializer=generation__pb2.Request.SerializeToString,
+                response_deserializer=generation__pb2.CostEstimate.FromString,
+                )
 
 
 class GenerationServiceServicer(object):
@@ -47,6 +52,12 @@ class GenerationServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def Estimate(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_GenerationServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -60,6 +71,11 @@ def add_GenerationServiceServicer_to_server(servicer, server):
                     request_deserializer=generation__pb2.ChainRequest.FromString,
                     response_serializer=generation__pb2.Answer.SerializeToString,
             ),
+            'Estimate': grpc.unary_unary_rpc_method_handler(
+                    servicer.Estimate,
+                    request_deserializer=generation__pb2.Request.FromString,
+                    response_serializer=generation__pb2.CostEstimate.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'gooseai.GenerationService', rpc_method_handlers)
@@ -106,3 +122,20 @@ class GenerationService(object):
             generation__pb2.Answer.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Estimate(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/gooseai.GenerationService/Estimate',
+            generation__pb2.Request.SerializeToString,
+            generation__pb2.CostEstimate.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
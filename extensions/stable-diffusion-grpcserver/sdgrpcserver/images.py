@@ -4,7 +4,7 @@
 # All images in are in BCHW unless specified in the variable name, as floating point 0..1
 # All functions will handle RGB or RGBA images
 
-from math import ceil
+from math import ceil, inf
 import cv2 as cv
 import torch, torchvision
 import numpy as np
@@ -41,10 +41,11 @@ def toCV(tensor):
 
     return (bgrBHWC.to(torch.float32) * 255).round().to(torch.uint8).cpu().numpy()
 
-def fromPngBytes(bytes):
+def fromPngBytes(bytes, device=None):
     intensor = torch.tensor(np.frombuffer(bytes, dtype=np.uint8))
     asuint8 = torchvision.io.decode_image(intensor, torchvision.io.image.ImageReadMode.RGB_ALPHA)
-    return asuint8[None, ...].to(torch.float32) / 255
+    # Move to the device (if any) while still uint8, so there's a quarter as much to transfer
+    return asuint8[None, ...].to(device).to(torch.float32) / 255
 
 # Images with alpha will be slow for now. TODO: Move to OpenCV (torchvision does not support encoding alpha images)
 def toPngBytes(tensor):
@@ -87,11 +88,180 @@ def channelmap(tensor, srcchannels):
 
     return tensor
 
+class PointwiseAdjustment(object):
+    """
+    A chain of levels, invert and channelmap adjustments, fused so the whole chain is applied in one pass
+
+    Each output channel is tracked as clamp(source * scale + offset, low, high), where source is one of the
+    input channels. All three adjustments map that form back onto itself, so any chain of them collapses to
+    a single channel gather, multiply, add and clamp.
+    """
+
+    def __init__(self, channels):
+        self.sources = list(range(channels))
+        self.scale = [1.0] * channels
+        self.offset = [0.0] * channels
+        self.low = [-inf] * channels
+        self.high = [inf] * channels
+
+    def _affine(self, scale, offset, low=-inf, high=inf):
+        for i in range(len(self.sources)):
+            if scale == 0: 
+                inlow = inhigh = offset
+            else:
+                inlow, inhigh = sorted([self.low[i] * scale + offset, self.high[i] * scale + offset])
+
+            self.scale[i] *= scale
+            self.offset[i] = self.offset[i] * scale + offset
+            self.low[i], self.high[i] = max(inlow, low), min(inhigh, high)
+
+            # If the clamps don't overlap, the channel is constant
+            if self.low[i] > self.high[i]:
+                self.scale[i], self.offset[i] = 0.0, low if inhigh < low else high
+                self.low[i], self.high[i] = -inf, inf
+
+    def levels(self, in0, in1, out0, out1):
+        c = (out1-out0) / (in1-in0)
+        self._affine(c, out0 - in0 * c, 0, 1)
+
+    def invert(self):
+        self._affine(-1, 1)
+
+    # Same channel numbering as channelmap
+    def channelmap(self, srcchannels):
+        channels = list(zip(self.sources, self.scale, self.offset, self.low, self.high))
+        outchannels = []
+
+        for c in srcchannels:
+            if c == 6: continue
+            elif c == 4 or c == 5: outchannels.append((0, 0.0, float(c == 5), -inf, inf))
+            else: outchannels.append(channels[c if c < len(channels) else 0])
+
+        self.sources, self.scale, self.offset, self.low, self.high = [list(x) for x in zip(*outchannels)]
+
+    def __call__(self, tensor):
+        def param(values): return torch.tensor(values, device=tensor.device, dtype=tensor.dtype)[None, :, None, None]
+
+        # Indexing with a list always copies, so everything after can be done in-place
+        tensor = tensor[:, self.sources]
+        tensor.mul_(param(self.scale)).add_(param(self.offset))
+
+        if any(low != -inf for low in self.low) or any(high != inf for high in self.high):
+            tensor.clamp_(param(self.low), param(self.high))
+
+        return tensor
+
 def gaussianblur(tensor, sigma):
     if np.isscalar(sigma): sigma = (sigma, sigma)
     kernel = [ceil(sigma[0]*6), ceil(sigma[1]*6)]
     kernel = [kernel[0] - kernel[0] % 2 + 1, kernel[1] - kernel[1] % 2 + 1]
     return torchvision.transforms.functional.gaussian_blur(tensor, kernel, sigma)
 
+def _gaussiankernel1d(sigma, device):
+    # The same kernel (size and values) torchvision's gaussian_blur (and so gaussianblur) uses
+    size = ceil(sigma*6)
+    size = size - size % 2 + 1
+    x = torch.linspace(-(size // 2), size // 2, size, device=device)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return (kernel / kernel.sum()).tolist()
+
+def _blur1d(tensor, kernel, dim):
+    half = len(kernel) // 2
+    padded = torch.nn.functional.pad(tensor, [half, half, 0, 0] if dim == 3 else [0, 0, half, half], mode="reflect")
+
+    # For small kernels, summing shifted slices is much faster on CPU than a single channel conv
+    size = tensor.shape[dim]
+    result = padded.narrow(dim, 0, size) * kernel[0]
+    for i, weight in enumerate(kernel[1:], 1): result.add_(padded.narrow(dim, i, size), alpha=weight)
+    return result
+
+def _directionalsteps(tensor, limit, kernel, steps, clamp):
+    for _ in range(steps): tensor = clamp(_blur1d(_blur1d(tensor, kernel, 3), kernel, 2), limit)
+    return tensor
+
+# Blur, but only allow values to go up ("up") or down ("down") from the original. This is repeated small
+# gaussian blurs, clamped against the original after each one, so the mask "grows" (or shrinks) smoothly.
+#
+# Most of the steps are done at a lower resolution when the blur is large enough for that to not matter, and
+# then refined with a few steps at full resolution. With the default mask post adjustments this is within 
+# 0.03 (max absolute difference, 0.005 mean) of doing every step at full resolution, and an order of magnitude faster
+def directionalblur(tensor, sigma, direction, steps=256, refine_steps=8):
+    clamp = torch.maximum if direction == "up" else torch.minimum
+    step_sigma = sigma / steps ** 0.5
+    kernel = _gaussiankernel1d(step_sigma, tensor.device)
+
+    # Largest power of two downscale that keeps each step at least a pixel of blur, and the image larger than the kernel
+    scale = 1
+    while scale * 2 <= step_sigma and min(tensor.shape[-2:]) // (scale * 2) > len(kernel): scale *= 2
+
+    if scale == 1: return _directionalsteps(tensor, tensor, kernel, steps, clamp)
+
+    small = torch.nn.functional.avg_pool2d(tensor, scale)
+    small = _directionalsteps(small, small, _gaussiankernel1d(step_sigma / scale, tensor.device), steps - refine_steps, clamp)
+
+    result = clamp(torch.nn.functional.interpolate(small, size=tensor.shape[-2:], mode="bilinear", align_corners=False), tensor)
+    return _directionalsteps(result, tensor, kernel, refine_steps, clamp)
+
 def crop(tensor, top, left, height, width):
     return tensor[:, :, top:top+height, left:left+width]
+
+def _lanczosWeights(insize, outsize, a, device):
+    scale = insize / outsize
+    # When downscaling, stretch the kernel to cover the source pixels each output pixel spans (antialiasing)
+    support = max(scale, 1)
+
+    centers = (torch.arange(outsize, device=device, dtype=torch.float32) + 0.5) * scale - 0.5
+    distance = (torch.arange(insize, device=device, dtype=torch.float32)[None, :] - centers[:, None]) / support
+
+    weights = torch.sinc(distance) * torch.sinc(distance / a) * (distance.abs() < a)
+    return weights / weights.sum(dim=1, keepdim=True)
+
+def lanczos(tensor, height, width, a=3):
+    # Lanczos is separable, so resample as two (batched) matrix multiplies, one per axis
+    hweights = _lanczosWeights(tensor.shape[-2], height, a, tensor.device).to(tensor.dtype)
+    wweights = _lanczosWeights(tensor.shape[-1], width, a, tensor.device).to(tensor.dtype)
+    return (hweights @ tensor @ wweights.T).clamp(0, 1)
+
+RESIZE_ALGORITHMS = ["lanczos", "area", "bicubic", "bilinear", "nearest"]
+
+def resize(tensor, height, width, algorithm=None):
+    if tensor.shape[-2:] == (height, width): return tensor
+
+    # Default to lanczos for upscaling, and area (which is cheap and doesn't alias) for downscaling
+    if algorithm is None:
+        algorithm = "lanczos" if height * width > tensor.shape[-2] * tensor.shape[-1] else "area"
+
+    if algorithm == "lanczos": 
+        return lanczos(tensor, height, width)
+    elif algorithm in {"bicubic", "bilinear"}:
+        resized = torch.nn.functional.interpolate(tensor, size=(height, width), mode=algorithm, align_corners=False, antialias=True)
+        return resized.clamp(0, 1)
+    elif algorithm in RESIZE_ALGORITHMS:
+        return torch.nn.functional.interpolate(tensor, size=(height, width), mode=algorithm)
+    else:
+        raise ValueError(f"Unknown resize algorithm {algorithm}")
+
+# mode is one of "strict" (stretch to exactly height x width), "crop" (scale to cover, then center crop) or "fit" 
+# (scale to fit within, then center on a transparent / black background). If only one of height or width is given, the 
+# other is picked to keep the aspect ratio. resizer is called as resizer(tensor, height, width), defaulting to resize
+def rescale(tensor, height, width, mode="strict", resizer=None):
+    if resizer is None: resizer = resize
+
+    inheight, inwidth = tensor.shape[-2:]
+
+    if not height and not width: return tensor
+    if not height: height = round(inheight * width / inwidth)
+    if not width: width = round(inwidth * height / inheight)
+
+    if mode == "strict": return resizer(tensor, height, width)
+
+    scale = max(height / inheight, width / inwidth) if mode == "crop" else min(height / inheight, width / inwidth)
+    scaledheight, scaledwidth = max(round(inheight * scale), 1), max(round(inwidth * scale), 1)
+
+    tensor = resizer(tensor, scaledheight, scaledwidth)
+
+    if mode == "crop":
+        return crop(tensor, (scaledheight - height) // 2, (scaledwidth - width) // 2, height, width)
+    
+    top, left = (height - scaledheight) // 2, (width - scaledwidth) // 2
+    return torch.nn.functional.pad(tensor, [left, width - scaledwidth - left, top, height - scaledheight - top])
@@ -1,5 +1,6 @@
 
 import os, warnings
+from types import SimpleNamespace as SN
 from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
 import torch
 
@@ -17,8 +18,11 @@ from diffusers.utils import deprecate
 
 import generation_pb2
 
-from sdgrpcserver.pipeline.unified_pipeline import UnifiedPipeline
+from sdgrpcserver.pipeline.unified_pipeline import UnifiedPipeline, ConvergenceMonitor, BatchSplitter
+from sdgrpcserver.memory_planner import MemoryPlanner
+from sdgrpcserver.snapshot import SnapshotStore
 from sdgrpcserver.pipeline.safety_checkers import FlagOnlySafetyChecker
+from sdgrpcserver.upscalers import RGBUpscaler, TorchScriptUpscaler
 
 from sdgrpcserver.pipeline.schedulers.scheduling_ddim import DDIMScheduler
 from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_discrete import EulerDiscreteScheduler
@@ -26,6 +30,7 @@ from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_ancestral_discrete im
 from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_discrete import DPM2DiscreteScheduler
 from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_ancestral_discrete import DPM2AncestralDiscreteScheduler
 from sdgrpcserver.pipeline.old_schedulers.scheduling_heun_discrete import HeunDiscreteScheduler
+from sdgrpcserver.pipeline.schedulers.scheduling_dpmpp_2m_discrete import DPMPP2MDiscreteScheduler
 
 class WithNoop(object):
     def __enter__(self):
@@ -63,6 +68,7 @@ class ProgressBarWrapper(object):
 
 class EngineMode(object):
     def __init__(self, vram_optimisation_level=0, enable_cuda = True, enable_mps = False):
+        # "auto" leaves the memory saving options to a MemoryPlanner, per request
         self._vramO = vram_optimisation_level
         self._enable_cuda = enable_cuda
         self._enable_mps = enable_mps
@@ -73,28 +79,29 @@ class EngineMode(object):
         self._hasMps = self._enable_mps and getattr(torch.backends, 'mps', False) and torch.backends.mps.is_available()
         return "cuda" if self._hasCuda else "mps" if self._hasMps else "cpu"
 
+    @property
+    def auto(self):
+        return self._vramO == "auto"
+
     @property
     def attention_slice(self):
-        return self.device == "cuda" and self._vramO > 0
+        return self.device == "cuda" and not self.auto and self._vramO > 0
 
     @property
     def fp16(self):
-        return self.device == "cuda" and self._vramO > 1
+        # Precision is fixed when the weights are loaded, so the planner can't choose it per request
+        return self.device == "cuda" and (self.auto or self._vramO > 1)
 
     @property
     def module_mode(self):
-        return "one" if self.device == "cuda" and self._vramO > 2 else "all"
+        return "one" if self.device == "cuda" and not self.auto and self._vramO > 2 else "all"
 
 class PipelineWrapper(object):
 
     def __init__(self, id, mode, pipeline):
         self._id = id
-        self._mode = mode
-
         self._pipeline = pipeline
-
-        self._pipeline.enable_attention_slicing(1 if self.mode.attention_slice else None)
-        self._pipeline.set_module_mode(self.mode.module_mode)
+        self._applyMode(mode)
 
         self._plms = self._prepScheduler(PNDMScheduler(
                 beta_start=0.00085, 
@@ -146,6 +153,39 @@ class PipelineWrapper(object):
                 beta_schedule="scaled_linear",
                 num_train_timesteps=1000
             ))
+        self._dpmpp2m = self._prepScheduler(DPMPP2MDiscreteScheduler(
+                beta_start=0.00085, 
+                beta_end=0.012, 
+                beta_schedule="scaled_linear",
+                num_train_timesteps=1000
+            ))
+        self._dpmpp2mk = self._prepScheduler(DPMPP2MDiscreteScheduler(
+                beta_start=0.00085, 
+                beta_end=0.012, 
+                beta_schedule="scaled_linear",
+                num_train_timesteps=1000,
+                use_karras_sigmas=True
+            ))
+
+    def _applyMode(self, mode):
+        # Everything that depends on the mode (or the machine), and so isn't kept in snapshots
+        self._mode = mode
+
+        self._pipeline.enable_attention_slicing(1 if self.mode.attention_slice else None)
+        self._pipeline.set_module_mode(self.mode.module_mode)
+
+        # Remembers how big a unet batch fits in memory at each resolution on this engine
+        self._batch_splitter = BatchSplitter()
+
+        self._planner = MemoryPlanner(self._pipeline, self.mode.device) if self.mode.auto else None
+        # Fixed levels don't know how much to leave free for activations, so only keep the module in use on the device
+        self._pipeline.set_module_reserve(0 if self.mode.auto else float("inf"))
+        self._plan = SN(module_mode=self.mode.module_mode, attention_slice=1 if self.mode.attention_slice else None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_mode", "_batch_splitter", "_planner", "_plan"): state.pop(key, None)
+        return state
 
     def _prepScheduler(self, scheduler):
         if isinstance(scheduler, OldSchedulerMixin):
@@ -181,7 +221,24 @@ class PipelineWrapper(object):
         self._pipeline.to("cpu", forceAll=True)
         if self.mode.device == "cuda": torch.cuda.empty_cache()
 
-    def generate(self, text, params, image=None, mask=None, outmask=None, negative_text=None, progress_callback=None, stop_event=None):
+    def _applyPlan(self, params):
+        plan = self._planner.plan(params)
+
+        if plan.module_mode != self._plan.module_mode: self._pipeline.set_module_mode(plan.module_mode)
+        if plan.attention_slice != self._plan.attention_slice: self._pipeline.enable_attention_slicing(plan.attention_slice)
+        if plan.module_mode == "one": self._pipeline.set_module_reserve(plan.activations)
+        self._plan = plan
+
+        available = "unknown" if plan.available is None else f"{plan.available / 2**30:.2f}GB"
+        print(
+            f"Memory plan for {params.width}x{params.height}: modules {plan.module_mode}, attention slice {plan.attention_slice}, "
+            f"unet batch limit {plan.unet_batch_limit}, vae tile size {plan.vae_tile_size}, "
+            f"estimated peak {plan.peak / 2**30:.2f}GB of {available} available{'' if plan.fits else ' (may not fit)'}"
+        )
+
+        return plan
+
+    def generate(self, text, params, image=None, mask=None, outmask=None, negative_text=None, progress_callback=None, stop_event=None, init_latents=None, output_latents=False, latent_checkpoints=None, run_safety_checker=True):
         generator=None
 
         if params.seed > 0:
@@ -204,39 +261,71 @@ class PipelineWrapper(object):
             scheduler=self._dpm2a
         elif params.sampler == generation_pb2.SAMPLER_K_HEUN:
             scheduler=self._heun
+        elif params.sampler == generation_pb2.SAMPLER_K_DPMPP_2M:
+            scheduler=self._dpmpp2m
+        elif params.sampler == generation_pb2.SAMPLER_K_DPMPP_2M_KARRAS:
+            scheduler=self._dpmpp2mk
         else:
             raise NotImplementedError("Scheduler not implemented")
 
         self._pipeline.scheduler = scheduler
         self._pipeline.progress_bar = ProgressBarWrapper(progress_callback, stop_event)
 
+        plan = self._applyPlan(params) if self._planner else None
+
+        # Keep the final latents, so the caller can reuse them (for variations) without a VAE encode
+        final_latents = []
+
+        convergence_monitor = None
+        if params.convergence_tolerance:
+            convergence_monitor = ConvergenceMonitor(params.convergence_tolerance, params.convergence_patience)
+
         images = self._pipeline(
             prompt=text,
             negative_prompt=negative_text if negative_text else None,
             init_image=image,
             mask_image=mask,
             outmask_image=outmask,
+            init_latents=init_latents,
             strength=params.strength,
             width=params.width,
             height=params.height,
             num_inference_steps=params.steps,
             guidance_scale=params.cfg_scale,
+            guidance_interval=params.cfg_interval,
+            guidance_threshold=params.cfg_threshold,
             eta=params.eta,
             generator=generator,
-            output_type="tensor",
-            return_dict=False
+            convergence_monitor=convergence_monitor,
+            inpaint_crop_margin=params.inpaint_crop_margin,
+            hires_fix_strength=params.hires_fix_strength,
+            hires_fix_base_size=params.hires_fix_base_size,
+            tile_size=params.tile_size,
+            tile_overlap=params.tile_overlap,
+            tile_batch_size=params.tile_batch_size,
+            latent_checkpoints=latent_checkpoints,
+            run_safety_checker=run_safety_checker,
+            batch_splitter=self._batch_splitter,
+            unet_batch_limit=plan.unet_batch_limit if plan else None,
+            vae_tile_size=plan.vae_tile_size if plan else None,
+            output_type="latent" if output_latents else "tensor",
+            return_dict=False,
+            latents_callback=final_latents.append
         )
 
-        return images
+        # Returns (images - or latents if output_latents, nsfw flags, number of steps actually run - or None if not known,
+        # final latents - or None if not available)
+        return (*images, convergence_monitor.steps_used if convergence_monitor else None, final_latents[0] if final_latents else None)
 
 class EngineManager(object):
 
-    def __init__(self, engines, weight_root="./weights", mode=EngineMode(), nsfw_behaviour="block"):
+    def __init__(self, engines, weight_root="./weights", mode=EngineMode(), nsfw_behaviour="block", snapshot_root=None):
         self.engines = engines
         self._default = None
         self._pipelines = {}
         self._activeId = None
         self._active = None
+        self._upscalers = {generation_pb2.UPSCALER_RGB: RGBUpscaler()}
 
         self._weight_root = weight_root
 
@@ -244,9 +333,14 @@ class EngineManager(object):
         self._nsfw = nsfw_behaviour
         self._token = os.environ.get("HF_API_TOKEN", True)
 
+        self._snapshots = SnapshotStore(snapshot_root) if snapshot_root else None
+
     @property
     def mode(self): return self._mode
 
+    @property
+    def nsfw_behaviour(self): return self._nsfw
+
     def _getWeightPath(self, remote_path, local_path):
         if local_path:
             test_path = local_path if os.path.isabs(local_path) else os.path.join(self._weight_root, local_path)
@@ -298,11 +392,51 @@ class EngineManager(object):
                 )
             )
     
+    def _snapshotSettings(self):
+        # Everything (other than the engine config) that changes what buildPipeline builds
+        return {"fp16": bool(self.mode.fp16), "nsfw_behaviour": self._nsfw}
+
+    def restorePipeline(self, engine):
+        """Restore an engine from its snapshot, or return None if there isn't a snapshot to restore from"""
+        if not self._snapshots: return None
+
+        pipe = self._snapshots.load(engine, self._snapshotSettings())
+        if not isinstance(pipe, PipelineWrapper): return None
+
+        pipe._applyMode(self._mode)
+        print(f"Restored {engine['id']} from snapshot")
+        return pipe
+
+    def snapshotPipelines(self):
+        """Save a snapshot of every loaded engine, returning the bundle paths"""
+        if not self._snapshots: raise ValueError("No snapshot root set")
+
+        engines = {engine["id"]: engine for engine in self.engines}
+        paths = []
+
+        for id, pipe in self._pipelines.items():
+            # Snapshots always hold the modules on the CPU
+            if pipe is self._active: pipe.deactivate()
+            paths.append(self._snapshots.save(engines[id], self._snapshotSettings(), pipe))
+
+        if self._active: self._active.activate()
+        return paths
+
+    def buildUpscaler(self, engine):
+        path = engine["local_model"]
+        if not os.path.isabs(path): path = os.path.normpath(os.path.join(self._weight_root, path))
+
+        return TorchScriptUpscaler(id=engine["id"], path=path, mode=self._mode)
+
     def loadPipelines(self):
         for engine in self.engines:
             if not engine.get("enabled", False): continue
 
-            pipe=self.buildPipeline(engine)
+            if engine["class"] == "TorchScriptUpscaler":
+                self._upscalers[generation_pb2.Upscaler.Value(engine["upscaler"])] = self.buildUpscaler(engine)
+                continue
+
+            pipe=self.restorePipeline(engine) or self.buildPipeline(engine)
 
             if pipe:
                 self._pipelines[pipe.id] = pipe
@@ -311,7 +445,8 @@ class EngineManager(object):
                 raise Exception(f'Unknown engine class "{engine["class"]}"')
 
     def getStatus(self):
-        return {engine["id"]: engine["id"] in self._pipelines for engine in self.engines if engine.get("enabled", True)}
+        upscalers = {upscaler.id for upscaler in self._upscalers.values()}
+        return {engine["id"]: engine["id"] in self._pipelines or engine["id"] in upscalers for engine in self.engines if engine.get("enabled", True)}
 
     def getPipe(self, id):
         """
@@ -329,6 +464,10 @@ class EngineManager(object):
         self._active.activate()
 
         return self._active
-            
-
 
+    def getUpscaler(self, upscaler):
+        """
+        Get an upscaler by Upscaler enum value. UPSCALER_RGB is always available, learned upscalers only if 
+        they are configured and enabled in engines.yaml. Raises KeyError otherwise
+        """
+        return self._upscalers[upscaler]
@@ -0,0 +1,219 @@
+import os
+from types import SimpleNamespace as SN
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+from sdgrpcserver.pipeline.fastattention import has_xformers
+from sdgrpcserver.pipeline.unified_pipeline import tile_starts
+
+# Rough (deliberately generous) activation sizes, in elements. The unet figure is per latent pixel per batch item for
+# a unet with 320 base channels, not counting the attention scores, which are estimated separately. The VAE figure
+# is per output pixel when decoding, for a VAE with 128 base channels
+UNET_ELEMENTS_PER_LATENT_PIXEL = 80_000
+VAE_ELEMENTS_PER_PIXEL = 3_000
+
+# Only plan to use this much of the available memory, to leave room for fragmentation and anything we haven't counted
+HEADROOM = 0.9
+
+# VAE tile sizes to try, largest first
+VAE_TILE_SIZES = (1024, 768, 512, 256)
+
+def _host_available():
+    """Bytes of host memory we could still allocate, going by free memory, cgroup limits and rlimits (or None)"""
+    limits = []
+
+    try:
+        import psutil
+        limits.append(psutil.virtual_memory().available)
+    except ImportError:
+        try:
+            with open("/proc/meminfo") as f:
+                meminfo = dict(line.split(":", 1) for line in f)
+            limits.append(int(meminfo["MemAvailable"].split()[0]) * 1024)
+        except (OSError, KeyError, ValueError):
+            pass
+
+    # cgroup v2, then v1
+    for limit_path, usage_path in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"), ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        try:
+            with open(limit_path) as f: limit = f.read().strip()
+            with open(usage_path) as f: usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+
+        if limit.isdigit() and int(limit) < 2**60: limits.append(int(limit) - usage)
+        break
+
+    # An address space limit applies to our virtual size
+    soft, _ = resource.getrlimit(resource.RLIMIT_AS) if resource else (None, None)
+    if soft is not None and soft != resource.RLIM_INFINITY:
+        try:
+            with open("/proc/self/statm") as f: size = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+            limits.append(soft - size)
+        except (OSError, ValueError):
+            pass
+
+    return max(min(limits), 0) if limits else None
+
+def available_memory(device):
+    """Bytes of memory we could still allocate on the device (or None if there's no way to tell)"""
+    device = torch.device(device)
+
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        # Memory torch has cached but isn't using is as good as free
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    if device.type == "mps" and hasattr(torch, "mps") and hasattr(torch.mps, "recommended_max_memory"):
+        return torch.mps.recommended_max_memory() - torch.mps.current_allocated_memory()
+
+    # MPS without memory reporting shares host memory anyway
+    return _host_available()
+
+def module_size(module):
+    if not isinstance(module, torch.nn.Module): return 0
+    return sum(tensor.numel() * tensor.element_size() for tensor in (*module.parameters(), *module.buffers()))
+
+class MemoryPlanner(object):
+    """
+    Picks the memory saving options for each request, rather than using the same fixed ones for everything. Estimates
+    the peak memory of a request from its resolution, unet batch (the unconditional half and tiles) and precision,
+    and compares it to the memory available on the device (or to the host memory, cgroup and rlimits on the CPU).
+
+    Options are added in order of how much they slow things down, until the estimate fits: attention slicing (from
+    half the heads down to one), splitting the unet batch, then moving modules to the device only while they're in
+    use (the ModuleScheduler keeps as many on the device as fit alongside the estimated activations). The VAE decode is
+    tiled if it won't fit whole. If nothing fits, the most frugal plan is used anyway, and the BatchSplitter catches 
+    anything that still runs out of memory
+    """
+
+    def __init__(self, pipeline, device):
+        self._pipeline = pipeline
+        self._device = torch.device(device)
+
+    def _sizes(self):
+        pipeline = self._pipeline
+        return {name: module_size(getattr(pipeline, f"_{name}", None)) for name in ("text_encoder", "unet", "vae", "safety_checker")}
+
+    def _resident(self):
+        # Our modules on the device count as available too, since we can move them off it
+        resident = 0
+        for name in ("text_encoder", "unet", "vae", "safety_checker"):
+            module = getattr(self._pipeline, f"_{name}", None)
+            parameter = next(module.parameters(), None) if isinstance(module, torch.nn.Module) else None
+            if parameter is not None and parameter.device.type == self._device.type:
+                resident += module_size(module)
+        return resident
+
+    def _unetBatch(self, params, latent_height, latent_width):
+        copies = 2 if params.cfg_scale > 1 else 1
+        if not params.tile_size or max(params.height, params.width) <= params.tile_size: return copies
+
+        tile, overlap = params.tile_size // 8, params.tile_overlap // 8
+        tiles = len(tile_starts(latent_height, tile, overlap)) * len(tile_starts(latent_width, tile, overlap))
+        return copies * min(params.tile_batch_size or tiles, tiles)
+
+    def _unetPeak(self, batch, tokens, attention_slice, dtype_size):
+        unet = self._pipeline._unet
+        heads = unet.config.attention_head_dim
+        activations = batch * tokens * UNET_ELEMENTS_PER_LATENT_PIXEL * unet.config.block_out_channels[0] / 320
+
+        # The scores and probabilities of the self attention at the full latent resolution
+        attention = 0 if has_xformers() else 2 * (attention_slice or batch * heads) * tokens * tokens
+        return (activations + attention) * dtype_size
+
+    def _vaePeak(self, height, width, vae_tile_size, dtype_size):
+        vae = self._pipeline._vae
+        if vae_tile_size: height, width = min(height, vae_tile_size), min(width, vae_tile_size)
+
+        activations = height * width * VAE_ELEMENTS_PER_PIXEL * vae.config.block_out_channels[0] / 128
+        # The mid block attention is single headed, at the latent resolution
+        tokens = (height // 8) * (width // 8)
+        return (activations + 2 * tokens * tokens) * dtype_size
+
+    def _slices(self):
+        if has_xformers(): return [None]
+
+        heads = self._pipeline._unet.config.attention_head_dim
+        slices, size = [None], heads // 2
+        while size >= 1:
+            if heads % size == 0: slices.append(size)
+            size //= 2
+        return slices
+
+    def plan(self, params):
+        """
+        Returns the plan for a request, as a SimpleNamespace of module_mode ("all" or "one"), attention_slice (or
+        None), unet_batch_limit (or None), vae_tile_size (or None), and the estimated peak, peak activation and 
+        available bytes
+        """
+        available = available_memory(self._device)
+        height, width = params.height, params.width
+
+        # Tiles are what go through the unet
+        latent_height, latent_width = height // 8, width // 8
+        if params.tile_size and max(height, width) > params.tile_size:
+            tokens = min(latent_height, params.tile_size // 8) * min(latent_width, params.tile_size // 8)
+        else:
+            tokens = latent_height * latent_width
+
+        sizes = self._sizes()
+        dtype_size = next(self._pipeline._unet.parameters()).element_size()
+        full_batch = self._unetBatch(params, latent_height, latent_width)
+
+        # Without a budget (or on the CPU, where modules never move) only the one plan makes sense
+        module_modes = ["all"] if self._device.type == "cpu" else ["all", "one"]
+        capacity = None if available is None else (available + (sum(sizes.values()) if self._device.type == "cpu" else self._resident())) * HEADROOM
+
+        def batches():
+            batch = full_batch
+            while True:
+                yield batch
+                if batch == 1: return
+                batch = (batch + 1) // 2
+
+        def need(module_mode, unet_peak, vae_peak):
+            if module_mode == "all": return sum(sizes.values()) + max(unet_peak, vae_peak)
+            return max(sizes["unet"] + unet_peak, sizes["vae"] + vae_peak, sizes["text_encoder"], sizes["safety_checker"])
+
+        chosen = None
+        if capacity is not None:
+            for module_mode in module_modes:
+                unet = next((
+                    (batch, attention_slice) for batch in batches() for attention_slice in self._slices()
+                    if need(module_mode, self._unetPeak(batch, tokens, attention_slice, dtype_size), 0) <= capacity
+                ), None)
+                vae_tile_size = next((
+                    vae_tile_size for vae_tile_size in (None, *VAE_TILE_SIZES)
+                    if need(module_mode, 0, self._vaePeak(height, width, vae_tile_size, dtype_size)) <= capacity
+                ), False)
+
+                if unet is not None and vae_tile_size is not False:
+                    chosen = module_mode, unet, vae_tile_size
+                    break
+
+        if chosen is None:
+            if capacity is None: chosen = "all", (full_batch, None), None
+            else: chosen = module_modes[-1], (1, self._slices()[-1]), VAE_TILE_SIZES[-1]
+
+        module_mode, (batch, attention_slice), vae_tile_size = chosen
+        if vae_tile_size and max(height, width) <= vae_tile_size: vae_tile_size = None
+
+        unet_peak, vae_peak = self._unetPeak(batch, tokens, attention_slice, dtype_size), self._vaePeak(height, width, vae_tile_size, dtype_size)
+        peak = need(module_mode, unet_peak, vae_peak)
+
+        return SN(
+            module_mode=module_mode,
+            attention_slice=attention_slice,
+            unet_batch_limit=batch if batch < full_batch else None,
+            vae_tile_size=vae_tile_size,
+            peak=peak,
+            activations=max(unet_peak, vae_peak),
+            available=available,
+            fits=capacity is None or peak <= capacity
+        )
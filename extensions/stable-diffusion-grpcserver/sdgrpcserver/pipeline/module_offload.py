@@ -0,0 +1,169 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# The order the pipeline uses its dynamic modules in
+MODULE_ORDER = ("text_encoder", "unet", "vae", "safety_checker")
+
+# Only plan to use this much of the available memory for modules
+HEADROOM = 0.9
+
+class ModuleDevice(object):
+    """
+    The device operations a ModuleScheduler needs. Kept separate so the scheduling can be tested against a simulated
+    device (which just needs to track what's "resident" and what the budget is) on the CPU
+    """
+
+    def size(self, module):
+        return sum(tensor.numel() * tensor.element_size() for tensor in (*module.parameters(), *module.buffers()))
+
+    def resident(self, module):
+        raise NotImplementedError
+
+    def load(self, module):
+        """Move a module to the device. Called from the prefetch thread, so must be finished with once it returns"""
+        raise NotImplementedError
+
+    def unload(self, module):
+        raise NotImplementedError
+
+    def available(self):
+        """Bytes that could still be allocated on the device, or None if unknown"""
+        return None
+
+class TorchModuleDevice(ModuleDevice):
+    """A real torch device. On CUDA, modules are loaded on their own stream, so loading overlaps with compute"""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def resident(self, module):
+        parameter = next(module.parameters(), None)
+        return parameter is not None and parameter.device.type == self.device.type
+
+    def load(self, module):
+        if self._stream is None:
+            module.to(self.device)
+            return
+
+        with torch.cuda.stream(self._stream):
+            module.to(self.device, non_blocking=True)
+        self._stream.synchronize()
+
+    def unload(self, module):
+        module.to("cpu")
+
+    def available(self):
+        # Imported here, as the planner imports the pipeline
+        from sdgrpcserver.memory_planner import available_memory
+        return available_memory(self.device)
+
+class ModuleScheduler(object):
+    """
+    Moves the pipeline's dynamic modules on and off the device as they're used (the "one" module mode). Knowing the
+    order modules are used in, it loads the next module on a background thread while the current one computes, and
+    leaves modules on the device for as long as the memory budget (less `reserve` bytes kept free for activations)
+    allows, evicting the ones that won't be needed for longest first. If the budget isn't known, only the module
+    in use is kept on the device, and nothing is prefetched
+    """
+
+    def __init__(self, get_module, device, order=MODULE_ORDER, reserve=0):
+        self._get_module = get_module
+        self.device = device
+        self.order = order
+        self.reserve = reserve
+
+        self._current = None
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="module-prefetch")
+
+    def _module(self, name):
+        module = self._get_module(name)
+        return module if isinstance(module, torch.nn.Module) else None
+
+    def _next(self, name):
+        index = self.order.index(name) if name in self.order else -1
+        return next((following for following in self.order[index+1:] if self._module(following) is not None), None)
+
+    def _distance(self, name, current):
+        # How far ahead in the order a module will next be needed (later modules are needed again next request)
+        if name not in self.order or current not in self.order: return len(self.order)
+        return (self.order.index(name) - self.order.index(current)) % len(self.order)
+
+    def _settle(self, name):
+        future = self._pending.pop(name, None)
+        if future is not None: future.result()
+
+    def _makeRoom(self, needed, keep):
+        """Unload modules not in keep, furthest needed first, until needed bytes fit. Returns False if they can't"""
+        available = self.device.available()
+        if available is None: return False
+
+        # Loads still in flight haven't allocated all their memory yet
+        loading = sum(self.device.size(self._module(name)) for name, future in self._pending.items() if not future.done())
+        budget = available * HEADROOM - self.reserve - loading
+        evictable = [
+            name for name in self.order
+            if name not in keep and self._module(name) is not None and self.device.resident(self._module(name))
+        ]
+        evictable.sort(key=lambda name: self._distance(name, self._current), reverse=True)
+
+        # Unload only if unloading enough would make it fit
+        freed, evict = 0, []
+        for name in evictable:
+            if budget + freed >= needed: break
+            freed += self.device.size(self._module(name))
+            evict.append(name)
+
+        if budget + freed < needed: return False
+
+        for name in evict:
+            self._settle(name)
+            self.device.unload(self._module(name))
+
+        return True
+
+    def _unloadOthers(self, keep):
+        for name in self.order:
+            module = self._module(name)
+            if name in keep or module is None: continue
+            self._settle(name)
+            if self.device.resident(module): self.device.unload(module)
+
+    def _prefetch(self, name):
+        module = self._module(name)
+        if module is None or name in self._pending or self.device.resident(module): return
+
+        if self._makeRoom(self.device.size(module), keep={self._current, name}):
+            self._pending[name] = self._executor.submit(self.device.load, module)
+
+    def acquire(self, name):
+        """Make sure a module is on the device, returning it, and start loading whatever will be needed next"""
+        with self._lock:
+            module = self._module(name)
+            if name == self._current and self.device.resident(module): return module
+
+            self._current = name
+            self._settle(name)
+
+            if not self.device.resident(module):
+                if not self._makeRoom(self.device.size(module), keep={name}): self._unloadOthers(keep={name})
+                self.device.load(module)
+
+            following = self._next(name)
+            if following is not None: self._prefetch(following)
+
+            return module
+
+    def reset(self):
+        """Wait for any loads in flight, and forget the module in use (for when modules are moved by something else)"""
+        with self._lock:
+            for name in list(self._pending): self._settle(name)
+            self._current = None
+
+    def close(self):
+        self.reset()
+        self._executor.shutdown()
@@ -79,7 +79,6 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         # setable values
         self.num_inference_steps = None
         self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
-        self.derivatives = []
 
         self.tensor_format = tensor_format
         self.set_format(tensor_format=tensor_format)
@@ -102,8 +101,6 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         sigmas = (1 - frac) * sigmas[low_idx] + frac * sigmas[high_idx]
         self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
 
-        self.derivatives = []
-
         self.set_format(tensor_format=self.tensor_format)
 
     def step(
@@ -153,7 +150,6 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
 
         # 2. Convert to an ODE derivative
         derivative = (sample - pred_original_sample) / sigma_hat
-        self.derivatives.append(derivative)
 
         if self.sigmas[timestep + 1] == 0:
             dt = self.sigmas[timestep + 1] - sigma_hat
@@ -0,0 +1,201 @@
+# Copyright 2022 Katherine Crowson, The HuggingFace Team and hlky. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from diffusers.configuration_utils import ConfigMixin, register_to_config
+from diffusers.schedulers.scheduling_utils import SchedulerOutput
+from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
+
+
+class DPMPP2MDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
+    """
+    Implements DPM-Solver++(2M) from Lu et al. (2022) for discrete beta schedules, optionally with the
+    noise schedule from Karras et al. (2022). Based on the original k-diffusion implementation by
+    Katherine Crowson:
+    https://github.com/crowsonkb/k-diffusion/blob/5b3af030dd83e0297272d861c19477735d0317ec/k_diffusion/sampling.py#L585
+
+    Being a second order multistep method, it only needs one model evaluation per step, and gives good
+    results in far fewer steps than the first order samplers.
+
+    [`~ConfigMixin`] takes care of storing all config attributes that are passed in the scheduler's `__init__`
+    function, such as `num_train_timesteps`. They can be accessed via `scheduler.config.num_train_timesteps`.
+    [`~ConfigMixin`] also provides general loading and saving functionality via the [`~ConfigMixin.save_config`] and
+    [`~ConfigMixin.from_config`] functions.
+
+    Args:
+        num_train_timesteps (`int`): number of diffusion steps used to train the model.
+        beta_start (`float`): the starting `beta` value of inference.
+        beta_end (`float`): the final `beta` value.
+        beta_schedule (`str`):
+            the beta schedule, a mapping from a beta range to a sequence of betas for stepping the model. Choose from
+            `linear` or `scaled_linear`.
+        trained_betas (`np.ndarray`, optional):
+            option to pass an array of betas directly to the constructor to bypass `beta_start`, `beta_end` etc.
+        use_karras_sigmas (`bool`):
+            space the sigmas using the schedule from Karras et al. (2022) rather than linearly in timesteps.
+        karras_rho (`float`): the rho parameter of the Karras et al. (2022) schedule.
+        tensor_format (`str`): whether the scheduler expects pytorch or numpy arrays.
+
+    """
+
+    @register_to_config
+    def __init__(
+        self,
+        num_train_timesteps: int = 1000,
+        beta_start: float = 0.00085, #sensible defaults
+        beta_end: float = 0.012,
+        beta_schedule: str = "linear",
+        trained_betas: Optional[np.ndarray] = None,
+        use_karras_sigmas: bool = False,
+        karras_rho: float = 7.,
+        tensor_format: str = "pt",
+    ):
+        if trained_betas is not None:
+            self.betas = np.asarray(trained_betas)
+        if beta_schedule == "linear":
+            self.betas = np.linspace(beta_start, beta_end, num_train_timesteps, dtype=np.float32)
+        elif beta_schedule == "scaled_linear":
+            # this schedule is very specific to the latent diffusion model.
+            self.betas = np.linspace(beta_start**0.5, beta_end**0.5, num_train_timesteps, dtype=np.float32) ** 2
+        else:
+            raise NotImplementedError(f"{beta_schedule} does is not implemented for {self.__class__}")
+
+        self.alphas = 1.0 - self.betas
+        self.alphas_cumprod = np.cumprod(self.alphas, axis=0)
+
+        self.sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5
+
+        # setable values
+        self.num_inference_steps = None
+        self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
+        # The denoised prediction from the previous step. Only the most recent one is ever read back
+        self.denoised = []
+
+        self.tensor_format = tensor_format
+        self.set_format(tensor_format=tensor_format)
+
+    def _karras_sigmas(self, num_inference_steps, train_sigmas):
+        rho = self.config.karras_rho
+        ramp = np.linspace(0, 1, num_inference_steps)
+        min_inv_rho = train_sigmas[0] ** (1 / rho)
+        max_inv_rho = train_sigmas[-1] ** (1 / rho)
+        sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+
+        # Map each sigma back to a (fractional) timestep, interpolating in log-sigma space
+        timesteps = np.interp(np.log(sigmas), np.log(train_sigmas), np.arange(len(train_sigmas)))
+
+        return sigmas, timesteps
+
+    def set_timesteps(self, num_inference_steps: int):
+        """
+        Sets the timesteps used for the diffusion chain. Supporting function to be run before inference.
+
+        Args:
+            num_inference_steps (`int`):
+                the number of diffusion steps used when generating samples with a pre-trained model.
+        """
+        self.num_inference_steps = num_inference_steps
+
+        train_sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+
+        if self.config.use_karras_sigmas:
+            sigmas, self.timesteps = self._karras_sigmas(num_inference_steps, train_sigmas)
+        else:
+            self.timesteps = np.linspace(self.config.num_train_timesteps - 1, 0, num_inference_steps, dtype=float)
+
+            low_idx = np.floor(self.timesteps).astype(int)
+            high_idx = np.ceil(self.timesteps).astype(int)
+            frac = np.mod(self.timesteps, 1.0)
+            sigmas = (1 - frac) * train_sigmas[low_idx] + frac * train_sigmas[high_idx]
+
+        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
+
+        self.denoised = []
+
+        self.set_format(tensor_format=self.tensor_format)
+
+    def step(
+        self,
+        model_output: Union[torch.FloatTensor, np.ndarray],
+        timestep: int,
+        sample: Union[torch.FloatTensor, np.ndarray],
+        return_dict: bool = True,
+    ) -> Union[SchedulerOutput, Tuple]:
+        """
+        Predict the sample at the previous timestep by solving the diffusion ODE. Core function to propagate the
+        diffusion process from the learned model outputs (most often the predicted noise).
+
+        Args:
+            model_output (`torch.FloatTensor` or `np.ndarray`): direct output from learned diffusion model.
+            timestep (`int`): current discrete timestep in the diffusion chain.
+            sample (`torch.FloatTensor` or `np.ndarray`):
+                current instance of sample being created by diffusion process.
+            return_dict (`bool`): option for returning tuple rather than SchedulerOutput class
+
+        Returns:
+            [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`:
+            [`~schedulers.scheduling_utils.SchedulerOutput`] if `return_dict` is True, otherwise a `tuple`. When
+            returning a tuple, the first element is the sample tensor.
+
+        """
+        sigma = self.sigmas[timestep]
+        sigma_next = self.sigmas[timestep + 1]
+
+        # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
+        denoised = sample - sigma * model_output
+
+        # 2. Step in log-SNR time (t = -log(sigma)). The first step (and the final one to sigma = 0) is
+        # first order, every other step uses the previous denoised prediction for a second order correction
+        if sigma_next == 0:
+            prev_sample = denoised
+        else:
+            t, t_next = -sigma.log(), -sigma_next.log()
+            h = t_next - t
+
+            if len(self.denoised) == 0 or timestep == 0:
+                denoised_d = denoised
+            else:
+                h_last = t + self.sigmas[timestep - 1].log()
+                r = h_last / h
+                denoised_d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * self.denoised[-1]
+
+            prev_sample = (sigma_next / sigma) * sample - (-h).expm1() * denoised_d
+
+        self.denoised.append(denoised)
+        if len(self.denoised) > 1: self.denoised.pop(0)
+
+        if not return_dict:
+            return (prev_sample,)
+
+        return SchedulerOutput(prev_sample=prev_sample)
+
+    def add_noise(
+        self,
+        original_samples: Union[torch.FloatTensor, np.ndarray],
+        noise: Union[torch.FloatTensor, np.ndarray],
+        timesteps: Union[torch.IntTensor, np.ndarray],
+    ) -> Union[torch.FloatTensor, np.ndarray]:
+        if self.tensor_format == "pt":
+            timesteps = timesteps.to(self.sigmas.device)
+        sigmas = self.match_shape(self.sigmas[timesteps], noise)
+        noisy_samples = original_samples + noise * sigmas
+
+        return noisy_samples
+
+    def __len__(self):
+        return self.config.num_train_timesteps
@@ -0,0 +1,97 @@
+import torch
+
+from diffusers import LMSDiscreteScheduler, PNDMScheduler
+
+from sdgrpcserver.pipeline.schedulers.scheduling_dpmpp_2m_discrete import DPMPP2MDiscreteScheduler
+
+class TensorRingBuffer(object):
+    """A fixed capacity, list-like history of same-shaped tensors
+
+    Storage for all the slots is allocated on the first append and then reused, with each append
+    copying into the slot of the oldest entry once the buffer is full. Indexing and iteration return
+    views into that storage, oldest first, so callers that only ever look at the last few entries
+    (like the multistep schedulers) can use it as a drop-in replacement for a list.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._storage = None
+        self._start = 0
+        self._len = 0
+
+    def clear(self):
+        self._start = 0
+        self._len = 0
+
+    def _allocate(self, like):
+        if self._storage is not None and self._storage.shape[1:] == like.shape and self._storage.dtype == like.dtype and self._storage.device == like.device:
+            return
+
+        self._storage = torch.empty((self.capacity, *like.shape), dtype=like.dtype, device=like.device)
+        self.clear()
+
+    def append(self, tensor):
+        if self.capacity == 0: return
+
+        self._allocate(tensor)
+
+        if self._len < self.capacity:
+            slot = (self._start + self._len) % self.capacity
+            self._len += 1
+        else:
+            slot = self._start
+            self._start = (self._start + 1) % self.capacity
+
+        self._storage[slot].copy_(tensor)
+
+    def pop(self, index=-1):
+        if self._len == 0: raise IndexError("pop from empty TensorRingBuffer")
+        if index not in (0, -1, self._len - 1): raise IndexError("TensorRingBuffer can only pop from either end")
+
+        if index == 0:
+            result = self._storage[self._start]
+            self._start = (self._start + 1) % self.capacity
+        else:
+            result = self._storage[(self._start + self._len - 1) % self.capacity]
+
+        self._len -= 1
+        return result
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if index < 0: index += self._len
+        if index < 0 or index >= self._len: raise IndexError("TensorRingBuffer index out of range")
+        return self._storage[(self._start + index) % self.capacity]
+
+    def __iter__(self):
+        for i in range(self._len): yield self[i]
+
+    def __reversed__(self):
+        for i in reversed(range(self._len)): yield self[i]
+
+# The scheduler attributes that hold a history of model outputs across steps, and how many entries of that
+# history each scheduler actually reads back
+SCHEDULER_HISTORY = [
+    (LMSDiscreteScheduler, "derivatives", 4),
+    (PNDMScheduler, "ets", 4),
+    (DPMPP2MDiscreteScheduler, "denoised", 1),
+]
+
+def bound_scheduler_history(scheduler, buffers):
+    """Replace any unbounded history lists on the scheduler with ring buffers
+
+    Call this after `scheduler.set_timesteps` (which resets the history to a fresh list). `buffers`
+    is a dict owned by the caller, so the buffers (and their storage) are reused for every step of
+    a request, and only allocated once per request.
+    """
+    for klass, attr, order in SCHEDULER_HISTORY:
+        if isinstance(scheduler, klass):
+            buffer = buffers.get(attr)
+            if buffer is None: buffer = buffers[attr] = TensorRingBuffer(order)
+
+            buffer.clear()
+            setattr(scheduler, attr, buffer)
+
+    return scheduler
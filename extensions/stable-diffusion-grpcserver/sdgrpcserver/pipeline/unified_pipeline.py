@@ -1,10 +1,14 @@
-import inspect, traceback
-import time
+import inspect, traceback, gc
+import time, hashlib, threading, uuid
+from collections import OrderedDict
 from mimetypes import init
 from typing import Callable, List, Optional, Union
+from types import SimpleNamespace
 
 import numpy as np
 from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
+from sdgrpcserver.pipeline.schedulers.scheduling_utils import bound_scheduler_history
+from sdgrpcserver.pipeline.module_offload import ModuleScheduler, TorchModuleDevice
 import torch
 import torchvision
 import torchvision.transforms as T
@@ -16,7 +20,7 @@ from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 from diffusers.configuration_utils import FrozenDict
 from diffusers.models import AutoencoderKL, UNet2DConditionModel
 from diffusers.pipeline_utils import DiffusionPipeline
-from diffusers.schedulers import LMSDiscreteScheduler
+from diffusers.schedulers import LMSDiscreteScheduler, PNDMScheduler
 from diffusers.schedulers.scheduling_utils import SchedulerMixin
 from diffusers.utils import deprecate, logging
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
@@ -24,14 +28,55 @@ from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionS
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+class LRUCache(object):
+    """A small, thread safe, least-recently-used cache"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Return the entry for key, calling build() to create it if it isn't in the cache"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None: 
+                self._entries.move_to_end(key)
+                return value
+
+        value = build()
+
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.size: self._entries.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+def content_key(image):
+    """A hashable key that identifies an image (either a tensor or PIL image) by its content and size"""
+    if isinstance(image, PIL.Image.Image):
+        return (hashlib.sha256(image.tobytes()).digest(), (image.mode, *image.size))
+    else:
+        return (hashlib.sha256(image.detach().to("cpu", torch.float32).numpy().tobytes()).digest(), tuple(image.shape))
+
 class UnifiedMode(object):
 
+    # The shape of the initial latents, for modes that know it without building them and whose steps don't depend on 
+    # anything generateLatents sets up. Those modes can skip building them when resuming from a checkpoint
+    latents_shape = None
+
     def __init__(self, **_):
         self.t_start = 0
 
     def generateLatents(self):
         raise NotImplementedError('Subclasses must implement')
 
+    def prepareSteps(self, num_steps):
+        pass
+
     def latentStep(self, latents, i, t, steppos):
         return latents
 
@@ -82,7 +127,7 @@ class Txt2imgMode(UnifiedMode):
 
 class Img2imgMode(UnifiedMode):
 
-    def __init__(self, pipeline, generator, init_image, latents_dtype, batch_total, num_inference_steps, strength, **kwargs):
+    def __init__(self, pipeline, generator, init_image, latents_dtype, batch_total, num_inference_steps, strength, init_latents=None, **kwargs):
         if strength < 0 or strength > 1:
             raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
         
@@ -102,9 +147,12 @@ class Img2imgMode(UnifiedMode):
         self.init_timestep = min(self.init_timestep, num_inference_steps)
         self.t_start = max(num_inference_steps - self.init_timestep + self.offset, 0)
 
+        # Latents from an earlier generation can be used instead of an init image, skipping the VAE encode
+        self.init_latents = init_latents
+
         if isinstance(init_image, PIL.Image.Image):
             self.init_image = self.preprocess(init_image)
-        else:
+        elif init_image is not None:
             self.init_image = self.preprocess_tensor(init_image)
 
     def preprocess(self, image):
@@ -127,8 +175,12 @@ class Img2imgMode(UnifiedMode):
         return tensor
 
     def _buildInitialLatents(self):
+        if self.init_latents is not None:
+            init_latents = self.init_latents.to(device=self.device, dtype=self.latents_dtype)
+            return torch.cat([init_latents] * (self.batch_total // init_latents.shape[0]), dim=0)
+
         init_image = self.init_image.to(device=self.device, dtype=self.latents_dtype)
-        init_latent_dist = self.pipeline.vae.encode(init_image).latent_dist
+        init_latent_dist = self.init_latent_dist = self.pipeline.vae.encode(init_image).latent_dist
         init_latents = init_latent_dist.sample(generator=self.generator)
         init_latents = 0.18215 * init_latents
 
@@ -164,8 +216,67 @@ class Img2imgMode(UnifiedMode):
         init_latents = self._addInitialNoise(init_latents)
         return init_latents
 
+class HiresFixMode(Img2imgMode):
+    """Generate at a lower base resolution, then upscale the latents and refine them at the target resolution
+
+    Much cheaper than sampling at the target resolution directly, and avoids the duplicated subjects 
+    the model tends to generate at sizes it wasn't trained on.
+    """
+
+    def __init__(self, pipeline, generator, height, width, latents_dtype, batch_total, hires_strength, hires_base_size, denoise, strength=None, init_image=None, **kwargs):
+        super().__init__(pipeline=pipeline, generator=generator, init_image=None, latents_dtype=latents_dtype, batch_total=batch_total, strength=hires_strength, **kwargs)
+
+        # Scale so the longest side is the base size, keeping to a multiple of 64
+        scale = hires_base_size / max(height, width)
+        base_height, base_width = [max(64, round(x * scale / 64) * 64) for x in (height, width)]
+
+        self.base_mode = Txt2imgMode(
+            pipeline=pipeline, 
+            generator=generator, 
+            height=base_height, width=base_width, 
+            latents_dtype=latents_dtype, 
+            batch_total=batch_total
+        )
+
+        self.latents_size = (height // 8, width // 8)
+        self.latents_shape = (batch_total, pipeline.unet.in_channels, *self.latents_size)
+        self.denoise = denoise
+
+    def _buildInitialLatents(self):
+        latents = self.denoise(self.base_mode, self.base_mode.generateLatents())
+        return torch.nn.functional.interpolate(latents, size=self.latents_size, mode="bilinear")
+
 class MaskProcessorMixin(object):
 
+    # The latent space masks derived from the last few mask images, shared by all the inpaint modes, since 
+    # clients will often reuse the same mask for many seeds. Keyed by mask content and size, dtype and device
+    latent_mask_cache = LRUCache(8)
+
+    def latent_masks(self, mask_image):
+        """
+        Returns the mask, high_mask and low_mask in latent space for a mask image, each with a batch size of one.
+        They are shared with other requests, so treat them as read only, and expand rather than copy them to the
+        batch size
+        """
+        self.latent_mask_key = (content_key(mask_image), self.latents_dtype, str(self.device))
+        return self.latent_mask_cache.get(self.latent_mask_key, lambda: self._buildLatentMasks(mask_image))
+
+    def _buildLatentMasks(self, mask_image):
+        if isinstance(mask_image, PIL.Image.Image):
+            mask = self.preprocess_mask(mask_image)
+        else:
+            mask = self.preprocess_mask_tensor(mask_image)
+
+        mask = mask.to(device=self.device, dtype=self.latents_dtype)
+
+        return (
+            mask,
+            # A mask which is either 1 (for any pixels that aren't pure black) or 0 (for pure black)
+            (mask * 100000).clamp(0, 1).round(),
+            # A mask which is either 1 (or any pixels that are pure white) or 0 (for any pixels that aren't pure white)
+            1-((1-mask)*100000).clamp(0, 1).round()
+        )
+
     def preprocess_mask(self, mask):
         mask = mask.convert("L")
         w, h = mask.size
@@ -194,13 +305,8 @@ class OriginalInpaintMode(Img2imgMode, MaskProcessorMixin):
     def __init__(self, mask_image, **kwargs):
         super().__init__(**kwargs)
 
-        if isinstance(mask_image, PIL.Image.Image):
-            self.mask_image = self.preprocess_mask(mask_image)
-        else:
-            self.mask_image = self.preprocess_mask_tensor(mask_image)
-
-        self.mask = self.mask_image.to(device=self.device, dtype=self.latents_dtype)
-        self.mask = torch.cat([self.mask] * self.batch_total)
+        self.mask_image, _, _ = self.latent_masks(mask_image)
+        self.mask = self.mask_image.expand(self.batch_total, -1, -1, -1)
 
     def generateLatents(self):
         init_latents = self._buildInitialLatents()
@@ -217,6 +323,10 @@ class OriginalInpaintMode(Img2imgMode, MaskProcessorMixin):
 
 class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
 
+    # The spectrum of the (masked) init latents used to color shaped noise. Keyed by the init image, mask and 
+    # settings, so repeat requests (like a new seed for the same outpaint) can reuse it
+    latent_spectrum_cache = LRUCache(8)
+
     def __init__(self, mask_image, num_inference_steps, strength, **kwargs):
         # Check strength
         if strength < 0 or strength > 2:
@@ -232,25 +342,20 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
 
         self.num_inference_steps = num_inference_steps
 
-        if isinstance(mask_image, PIL.Image.Image):
-            self.mask = self.preprocess_mask(mask_image)
-        else:
-            self.mask = self.preprocess_mask_tensor(mask_image)
+        mask, high_mask, low_mask = self.latent_masks(mask_image)
 
         # check sizes TODO: init_latents isn't stored or available - how to check?
         #if not self.mask.shape == self.init_latents.shape:
         #    raise ValueError("The mask and init_image should be the same size!")
 
+        # The masks are the same for every item in the batch, so expand them (a view) rather than copying
+        batch_shape = (self.batch_total, *mask.shape[1:])
 
-        self.mask = self.mask.to(device=self.device, dtype=self.latents_dtype)
-        self.mask = torch.cat([self.mask] * self.batch_total)
-
-        # Create a mask which is either 1 (for any pixels that aren't pure black) or 0 (for pure black)
-        self.high_mask = (self.mask * 100000).clamp(0, 1).round()
-        # Create a mask which is either 1 (or any pixels that are pure white) or 0 (for any pixels that aren't pure white)
-        self.low_mask = 1-((1-self.mask)*100000).clamp(0, 1).round()
+        self.mask = mask.expand(batch_shape)
+        self.high_mask = high_mask.expand(batch_shape)
+        self.low_mask = low_mask.expand(batch_shape)
         # Create a mask which is scaled to allow protected-area depending on how close mask_scale is to 0
-        self.blend_mask = self.mask * self.mask_scale
+        self.blend_mask = (mask * self.mask_scale).expand(batch_shape)
 
     def _matchToSamplerSD(self, tensor):
         # Normalise tensor to -1..1
@@ -279,6 +384,21 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
         return tensor * norm_range + norm_min
 
 
+    def _latentSpectrum(self, lmask_mode, fft_norm_mode):
+        def build():
+            # The spectrum comes from the mean of the init latent distribution rather than a sample of it, so it
+            # only depends on the init image, and is the same for every item in the batch (it broadcasts over it)
+            latents = 0.18215 * self.init_latent_dist.mean[:1]
+
+            if lmask_mode > 0:
+                latent_mask = self.low_mask if lmask_mode == 1 else self.mask if lmask_mode == 2 else self.high_mask
+                latents = latents * latent_mask[:1]
+
+            return torch.fft.rfft2(latents.to(torch.float32), norm=fft_norm_mode)
+
+        key = (self.pipeline.cache_id, content_key(self.init_image), self.latent_mask_key, lmask_mode, fft_norm_mode)
+        return self.latent_spectrum_cache.get(key, build)
+
     def _fillWithShapedNoise(self, init_latents):
         # HERE ARE ALL THE THINGS THAT GIVE BETTER OR WORSE RESULTS DEPENDING ON THE IMAGE:
         noise_mask_factor=1 # (1) How much to reduce noise during mask transition
@@ -327,11 +447,10 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
             noise_mask = self.low_mask if nmask_mode == 1 else self.mask if nmask_mode == 2 else self.high_mask
             noise = noise.mul(1-(noise_mask * noise_mask_factor))
 
-        # Color the noise by the latent
-        noise_fft = torch.fft.fftn(noise.to(torch.float32), norm=fft_norm_mode)
-        latent_fft = torch.fft.fftn(masked_latents.to(torch.float32), norm=fft_norm_mode)
-        convolve = noise_fft.mul(latent_fft)
-        noise = torch.fft.ifftn(convolve, norm=fft_norm_mode).real.to(self.latents_dtype)
+        # Color the noise by the latent. Everything is real, so use real FFTs, over just the spatial axes
+        noise_fft = torch.fft.rfft2(noise.to(torch.float32), norm=fft_norm_mode)
+        latent_fft = self._latentSpectrum(lmask_mode, fft_norm_mode)
+        noise = torch.fft.irfft2(noise_fft.mul_(latent_fft), s=noise.shape[-2:], norm=fft_norm_mode).to(self.latents_dtype)
 
         # Stretch colored noise to match the image latent
         if match_mode == 0: noise = self._matchToSamplerSD(noise)
@@ -352,20 +471,51 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
         # And return
         return init_latents
 
-    def latentStep(self, latents, i, t, steppos):
-        # The type shifting here is due to note in Img2img._addInitialNoise
-        init_latents_proper = self.scheduler.add_noise(self.init_latents_orig.to(self.image_noise.dtype), self.image_noise, self._getSchedulerNoiseTimestep(i, t))       
-        init_latents_proper = init_latents_proper.to(latents.dtype)
+    def prepareSteps(self, num_steps):
+        super().prepareSteps(num_steps)
+
+        # The blend mask is compared against the position in the schedule (i / (num_steps + 1)) each step. That
+        # position only goes up, so precompute how many steps each latent stays pinned to the init image for
+        # (The masks are the same for each item in the batch, so this only needs doing once and can broadcast)
+        steppos = torch.tensor([i / (num_steps + 1) for i in range(num_steps)], dtype=self.blend_mask.dtype, device=self.blend_mask.device)
+        self.mask_steps = self.blend_mask[:1, ..., None].gt(steppos).sum(dim=-1)
+
+        self.iteration_mask = torch.empty(self.mask_steps.shape, dtype=torch.bool, device=self.mask_steps.device)
+        self.init_latents_proper = None
+
+    def _addNoiseToInit(self, i, t):
+        if not isinstance(self.scheduler, OldSchedulerMixin):
+            # The type shifting here is due to note in Img2img._addInitialNoise
+            return self.scheduler.add_noise(self.init_latents_orig.to(self.image_noise.dtype), self.image_noise, self._getSchedulerNoiseTimestep(i, t))
+
+        # Same as OldSchedulerMixin.add_noise, but into a buffer that is reused for every step
+        sigmas = self.scheduler.match_shape(self.scheduler.sigmas[i], self.image_noise)
 
-        iteration_mask = self.blend_mask.gt(steppos).to(self.blend_mask.dtype)
+        if self.init_latents_proper is None:
+            dtype = torch.promote_types(self.image_noise.dtype, sigmas.dtype)
+            self.init_latents_proper = torch.empty(self.image_noise.shape, dtype=dtype, device=self.image_noise.device)
 
-        return (init_latents_proper * iteration_mask) + (latents * (1 - iteration_mask))       
+        torch.mul(self.image_noise, sigmas, out=self.init_latents_proper)
+        return self.init_latents_proper.add_(self.init_latents_orig)
+
+    def latentStep(self, latents, i, t, steppos):
+        init_latents_proper = self._addNoiseToInit(i, t)
+
+        # The iteration mask is binary, so blending with it is just picking one or the other
+        torch.gt(self.mask_steps, i - self.t_start, out=self.iteration_mask)
+        return torch.where(self.iteration_mask, init_latents_proper.to(latents.dtype), latents, out=latents)
 
 class DynamicModuleDiffusionPipeline(DiffusionPipeline):
 
     def __init__(self, *args, **kwargs):
         self._moduleMode = "all"
         self._moduleDevice = torch.device("cpu")
+        self._moduleScheduler = None
+        self._moduleReserve = 0
+
+        # Identifies this pipeline's modules in caches shared between pipelines. Unlike id() it's never reused, and
+        # unlike the module properties reading it doesn't move anything onto the device
+        self.cache_id = uuid.uuid4().hex
 
     def register_modules(self, **kwargs):
         self._modules = set(kwargs.keys())
@@ -375,7 +525,15 @@ class DynamicModuleDiffusionPipeline(DiffusionPipeline):
         super().register_modules(**kwargs)
 
     def set_module_mode(self, mode):
+        if self._moduleScheduler: self._moduleScheduler.reset()
         self._moduleMode = mode
+
+        # In "one" mode modules are moved to the device as they're needed, so start with them all off it
+        if mode == "one":
+            for name in self._modulesDyn:
+                module = getattr(self, f"_{name}", None)
+                if isinstance(module, torch.nn.Module): module.to("cpu")
+
         self.to(self._moduleDevice)
 
     def to(self, torch_device, forceAll=False):
@@ -384,6 +542,13 @@ class DynamicModuleDiffusionPipeline(DiffusionPipeline):
 
         module_names, _ = self.extract_init_dict(dict(self.config))
 
+        # A scheduler only handles the one device
+        if self._moduleScheduler and self._moduleDevice != torch.device(torch_device):
+            self._moduleScheduler.close()
+            self._moduleScheduler = None
+        elif self._moduleScheduler:
+            self._moduleScheduler.reset()
+
         self._moduleDevice = torch.device(torch_device)
 
         moveNow = self._modules if (self._moduleMode == "all" or forceAll) else self._modulesStat
@@ -399,24 +564,37 @@ class DynamicModuleDiffusionPipeline(DiffusionPipeline):
     def device(self) -> torch.device:
         return self._moduleDevice
 
+    @property
+    def module_scheduler(self):
+        """The ModuleScheduler that moves modules on and off the device in "one" module mode"""
+        if self._moduleScheduler is None:
+            self._moduleScheduler = ModuleScheduler(lambda name: getattr(self, f"_{name}", None), TorchModuleDevice(self._moduleDevice), reserve=self._moduleReserve)
+        return self._moduleScheduler
+
+    @module_scheduler.setter
+    def module_scheduler(self, value):
+        self._moduleScheduler = value
+
+    def __getstate__(self):
+        # The module scheduler (with its thread) and progress bar belong to this process
+        state = self.__dict__.copy()
+        state["_moduleScheduler"] = None
+        state.pop("progress_bar", None)
+        return state
+
+    def set_module_reserve(self, reserve):
+        """Bytes to keep free for activations in "one" module mode. With an infinite reserve only the module in use is kept on the device"""
+        self._moduleReserve = reserve
+        if self._moduleScheduler: self._moduleScheduler.reserve = reserve
+
     def prepmodule(self, name, module):
         if self._moduleMode == "all":
             return module
 
-        # We assume if this module is on a device of the right type we put it there
-        # (How else would it get there?)
-        if self._moduleDevice.type == module.device.type:
+        if name in self._modulesStat or not isinstance(module, torch.nn.Module):
             return module
 
-        if name in self._modulesStat:
-            return module
-
-        for name in self._modulesDyn:
-            other = getattr(self, f"_{name}")
-            if other is not module: other.to("cpu")
-        
-        module.to(self._moduleDevice)
-        return module
+        return self.module_scheduler.acquire(name)
 
     @property 
     def vae(self):
@@ -451,35 +629,360 @@ class DynamicModuleDiffusionPipeline(DiffusionPipeline):
         self._safety_checker = value
 
 
+def tile_starts(size, tile_size, tile_overlap):
+    """The start of each of the overlapping tiles needed to cover size, with the last tile flush with the end"""
+    if size <= tile_size: return [0]
+    stride = max(tile_size - tile_overlap, 1)
+    starts = list(range(0, size - tile_size, stride))
+    return starts + [size - tile_size]
+
+def tile_weight(size, full, tile_overlap, device, dtype):
+    """Ramp up from the edges of a tile over the overlap, so overlapping tiles cross-fade"""
+    ramp = torch.arange(size, device=device, dtype=dtype)
+    ramp = torch.minimum(ramp + 1, size - ramp).clamp(max=max(tile_overlap, 1))
+    return ramp if size < full else torch.ones_like(ramp)
+
 class NoisePredictor:
 
-    def __init__(self, pipeline, text_embeddings, do_classifier_free_guidance, guidance_scale):
+    def __init__(self, pipeline, text_embeddings, do_classifier_free_guidance, guidance_scale, guidance_interval=1.0, guidance_threshold=0, batch_splitter=None, batch_limit=None):
         self.pipeline = pipeline
+        self.batch_splitter = batch_splitter
+        self.batch_limit = batch_limit
         self.text_embeddings = text_embeddings
         self.do_classifier_free_guidance = do_classifier_free_guidance
         self.guidance_scale = guidance_scale
 
+        # Classifier free guidance is only applied for the first guidance_interval fraction of the steps, and until the
+        # relative difference between the conditional and unconditional predictions drops below guidance_threshold
+        self.guidance_interval = guidance_interval
+        self.guidance_threshold = guidance_threshold
+        self.guidance_until = None
+        self.guidance_converged = False
+
+        # Outside of the guidance interval we only need the text half of the embeddings
+        self.cond_embeddings = text_embeddings.chunk(2)[1] if do_classifier_free_guidance else text_embeddings
+
+        # The model input buffer, allocated on the first step and reused for the rest of the request
+        self.latent_model_input = None
+
+    def prepareSteps(self, t_start, num_steps):
+        self.guidance_until = t_start + round(num_steps * self.guidance_interval) if self.guidance_interval < 1 else None
+        self.guidance_converged = False
+
+    def _useGuidance(self, i):
+        if not self.do_classifier_free_guidance or self.guidance_converged: return False
+        return self.guidance_until is None or i < self.guidance_until
+
+    def _buildModelInput(self, latents, copies):
+        # Copy the latents into the model input buffer, twice if we are doing classifier free guidance
+        capacity = 2 if self.do_classifier_free_guidance else 1
+        shape = (latents.shape[0] * capacity, *latents.shape[1:])
+
+        buffer = self.latent_model_input
+        if buffer is None or buffer.shape != shape or buffer.dtype != latents.dtype or buffer.device != latents.device:
+            buffer = self.latent_model_input = torch.empty(shape, dtype=latents.dtype, device=latents.device)
+
+        buffer = buffer[:latents.shape[0] * copies]
+        for chunk in buffer.chunk(copies): chunk.copy_(latents)
+        return buffer
+
+    def _predict(self, latent_model_input, t, text_embeddings):
+        if self.batch_splitter is None: 
+            return self.pipeline.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+
+        # The unconditional and text halves (and any tiles) are independent, so the batch can be split anywhere
+        return self.batch_splitter.run(
+            tuple(latent_model_input.shape[-2:]), 
+            latent_model_input.shape[0], 
+            lambda start, end: self.pipeline.unet(latent_model_input[start:end], t, encoder_hidden_states=text_embeddings[start:end]).sample,
+            latent_model_input.device,
+            limit=self.batch_limit
+        )
+
     def step(self, latents, i, t, sigma = None):
+        use_guidance = self._useGuidance(i)
+
         # expand the latents if we are doing classifier free guidance
-        latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
+        latent_model_input = self._buildModelInput(latents, 2 if use_guidance else 1)
 
         if isinstance(self.pipeline.scheduler, OldSchedulerMixin): 
             if not sigma: sigma = self.pipeline.scheduler.sigmas[i] 
             # the model input needs to be scaled to match the continuous ODE formulation in K-LMS
-            latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
+            latent_model_input.div_((sigma**2 + 1) ** 0.5)
         else:
             latent_model_input = self.pipeline.scheduler.scale_model_input(latent_model_input, t)
 
         # predict the noise residual
-        noise_pred = self.pipeline.unet(latent_model_input, t, encoder_hidden_states=self.text_embeddings).sample
+        text_embeddings = self.text_embeddings if use_guidance else self.cond_embeddings
+        noise_pred = self._predict(latent_model_input, t, text_embeddings)
 
-        # perform guidance
-        if self.do_classifier_free_guidance:
+        # perform guidance, in place in the text half of the prediction
+        if use_guidance:
             noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+            if self.guidance_threshold:
+                text_norm = noise_pred_text.norm()
+                noise_pred_text.sub_(noise_pred_uncond)
+                # Once the predictions have converged guidance has little left to add, so stop paying for it
+                if noise_pred_text.norm() < self.guidance_threshold * text_norm: self.guidance_converged = True
+            else:
+                noise_pred_text.sub_(noise_pred_uncond)
+
+            noise_pred = noise_pred_text.mul_(self.guidance_scale).add_(noise_pred_uncond)
 
         return noise_pred
 
+class TiledNoisePredictor(NoisePredictor):
+    """A NoisePredictor that runs the unet over overlapping tiles of the latents (MultiDiffusion)
+
+    Each step the tiles are batched through the unet together (up to tile_batch_size tiles at a time), and 
+    the predictions are averaged where they overlap, weighted towards the center of each tile so the seams
+    blend. The scheduler only ever sees the whole canvas, so its state is shared across all the tiles, and 
+    peak unet memory depends on the tile size rather than the canvas size.
+    """
+
+    def __init__(self, *args, tile_size, tile_overlap, tile_batch_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Sizes are in latent pixels
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+
+        self.tiles = None
+        self.weights = None
+
+    def _prepareTiles(self, latents):
+        _, _, height, width = latents.shape
+
+        if self.tiles is not None and self.weights.shape[-2:] == (height, width): return
+
+        tile_height, tile_width = min(self.tile_size, height), min(self.tile_size, width)
+        weight = (
+            tile_weight(tile_height, height, self.tile_overlap, latents.device, latents.dtype)[:, None] * 
+            tile_weight(tile_width, width, self.tile_overlap, latents.device, latents.dtype)[None, :]
+        )
+
+        self.tiles = [
+            (top, left, top + tile_height, left + tile_width) 
+            for top in tile_starts(height, self.tile_size, self.tile_overlap) 
+            for left in tile_starts(width, self.tile_size, self.tile_overlap)
+        ]
+
+        self.tile_weight = weight
+        self.weights = torch.zeros((height, width), device=latents.device, dtype=latents.dtype)
+        for top, left, bottom, right in self.tiles: self.weights[top:bottom, left:right] += weight
+
+    def _predict(self, latent_model_input, t, text_embeddings):
+        self._prepareTiles(latent_model_input)
+
+        if len(self.tiles) == 1: return super()._predict(latent_model_input, t, text_embeddings)
+
+        noise_pred = torch.zeros_like(latent_model_input)
+        batch_size = self.tile_batch_size or len(self.tiles)
+
+        for start in range(0, len(self.tiles), batch_size):
+            tiles = self.tiles[start:start+batch_size]
+
+            tile_input = torch.cat([latent_model_input[:, :, top:bottom, left:right] for top, left, bottom, right in tiles])
+            tile_embeddings = torch.cat([text_embeddings] * len(tiles))
+
+            tile_preds = super()._predict(tile_input, t, tile_embeddings).chunk(len(tiles))
+
+            for (top, left, bottom, right), tile_pred in zip(tiles, tile_preds):
+                noise_pred[:, :, top:bottom, left:right].addcmul_(tile_pred, self.tile_weight)
+
+        return noise_pred.div_(self.weights)
+
+class ConvergenceMonitor:
+    """Tracks the relative change in the predicted original sample (x0) between steps
+
+    Once that change has stayed below `tolerance` for `patience` steps in a row the remaining steps have little
+    left to do, so the pipeline can stop early and use the predicted x0 as the final (sigma = 0) latents.
+    After the pipeline has run, `steps_used` holds the number of denoising steps that were actually run (in all passes).
+    """
+
+    def __init__(self, tolerance, patience=3):
+        self.tolerance = tolerance
+        self.patience = patience
+
+        self.original = None
+        self.steps_below = 0
+        self.steps_used = 0
+
+    def restart(self):
+        """Forget the predictions from any previous pass (the step count keeps accumulating)"""
+        self.original = None
+        self.steps_below = 0
+
+    def predictOriginal(self, scheduler, latents, noise_pred, i, t):
+        if isinstance(scheduler, (OldSchedulerMixin, LMSDiscreteScheduler)):
+            return latents - scheduler.sigmas[i] * noise_pred
+
+        alpha_prod_t = scheduler.alphas_cumprod[int(t)]
+        return (latents - (1 - alpha_prod_t) ** 0.5 * noise_pred) / alpha_prod_t ** 0.5
+
+    def step(self, scheduler, latents, noise_pred, i, t):
+        """Record the prediction for this step, and return True if the loop has converged"""
+        original = self.predictOriginal(scheduler, latents, noise_pred, i, t)
+
+        if self.original is not None:
+            change = (original - self.original).norm() / self.original.norm()
+            self.steps_below = self.steps_below + 1 if change < self.tolerance else 0
+
+        self.original = original
+        return self.steps_below >= self.patience
+
+def is_out_of_memory(e):
+    """True if an exception is an allocation failure, on the device (CUDA or MPS) or in host memory"""
+    if isinstance(e, MemoryError): return True
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(e, torch.cuda.OutOfMemoryError): return True
+    if not isinstance(e, RuntimeError): return False
+
+    message = str(e)
+    return "out of memory" in message or "can't allocate memory" in message or "Out of memory" in message
+
+def free_memory(device):
+    """Release whatever cached memory we can after an allocation failure"""
+    gc.collect()
+    device = torch.device(device)
+    if device.type == "cuda": torch.cuda.empty_cache()
+    elif device.type == "mps" and hasattr(torch, "mps") and hasattr(torch.mps, "empty_cache"): torch.mps.empty_cache()
+
+class BatchSplitter:
+    """Runs batches through a model, splitting them in half (down to a batch of one) whenever they run out of memory
+
+    Remembers the largest batch that fit for each input size, and starts later batches of that size there rather than
+    failing all over again. One of these is kept per engine, so the limits are per (engine, resolution). So that one
+    passing shortage (like a fragmentation spike) doesn't slow an engine down for good, a limit is doubled again after
+    `recover_after` batches in a row run at it without failing. Inputs are only ever split along the batch, so the 
+    results are the same as running the whole batch at once.
+    """
+
+    def __init__(self, recover_after=100):
+        self.recover_after = recover_after
+        self.limits = {}
+        self._successes = {}
+        self._lock = threading.Lock()
+
+    def limit(self, key):
+        with self._lock: return self.limits.get(key)
+
+    def run(self, key, total, predict, device="cpu", limit=None):
+        """
+        Call predict(start, end) for slices of a batch of size total (as big as currently fit for key, and no bigger 
+        than limit), returning their outputs concatenated along the batch. Allocation failures at a batch of one are 
+        raised as usual
+        """
+        size = min(self.limit(key) or total, limit or total, total)
+        outputs, start = [], 0
+
+        while start < total:
+            end = min(start + size, total)
+
+            try:
+                outputs.append(predict(start, end))
+            except Exception as e:
+                if not is_out_of_memory(e) or end - start == 1: raise
+
+                free_memory(device)
+                size = (end - start) // 2
+                logger.warning(f"Out of memory with a batch of {end - start} at {key}, retrying with {size}")
+
+                with self._lock:
+                    self.limits[key] = size
+                    self._successes[key] = 0
+                continue
+
+            # Only a full batch at the limit says anything about whether the limit still needs to be that low
+            full, start = end - start == size, end
+            if not full: continue
+
+            # Batches at the limit are fitting again, so try a bigger one next time (if it fails, it's just halved again)
+            with self._lock:
+                if self.limits.get(key) != size: continue
+                self._successes[key] = self._successes.get(key, 0) + 1
+                if self._successes[key] >= self.recover_after:
+                    self.limits[key] = size * 2
+                    self._successes[key] = 0
+
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+
+class LatentCheckpoints:
+    """Saves the latents at chosen steps of the denoising loop, so a later run can resume from them
+
+    Checkpoints are kept on the CPU in k-diffusion form (x0 + sigma * noise) along with their sigma. So a run with a
+    different scheduler, number of steps, guidance or eta can resume from whichever checkpoint leaves it the fewest
+    steps: it starts at the last step of its own schedule that is at least as noisy as the checkpoint, adding just 
+    enough fresh noise to make up any difference. Multistep schedulers (K_LMS, DPM++ 2M) restart their history there, 
+    and PLMS repeats its warm-up step there, so the remaining steps are a close, but not bit identical, continuation 
+    of the original run.
+    After the pipeline has run, `saved` holds the checkpoints of this run (including the ones it shares with the run it
+    resumed from), and `resumed_from` the step it resumed at (or None).
+    """
+
+    def __init__(self, save_steps=(), checkpoints=()):
+        self.save_steps = set(save_steps)
+        self.checkpoints = list(checkpoints)
+
+        self.saved = []
+        self.resumed_from = None
+
+    def _sigma(self, scheduler, i):
+        if isinstance(scheduler, (OldSchedulerMixin, LMSDiscreteScheduler)): return float(scheduler.sigmas[i])
+        if i >= len(scheduler.timesteps): return 0.0
+
+        alpha_prod_t = scheduler.alphas_cumprod[int(scheduler.timesteps[i])]
+        return float(((1 - alpha_prod_t) / alpha_prod_t) ** 0.5)
+
+    def _scale(self, scheduler, sigma):
+        # The other schedulers (DDIM and PLMS) work on the k-diffusion latents scaled by sqrt(alpha_prod_t)
+        if isinstance(scheduler, (OldSchedulerMixin, LMSDiscreteScheduler)): return 1.0
+        return 1 / (1 + sigma ** 2) ** 0.5
+
+    def save(self, scheduler, i, latents, generator):
+        """Save the latents after step i of the schedule (so the latents step i + 1 starts from), if it's a save step"""
+        if i + 1 not in self.save_steps: return
+
+        sigma = self._sigma(scheduler, i + 1)
+        self.saved.append(SimpleNamespace(
+            step=i + 1, 
+            sigma=sigma, 
+            latents=(latents / self._scale(scheduler, sigma)).cpu(), 
+            generator_state=generator.get_state() if generator is not None else None
+        ))
+
+    def resume(self, scheduler, t_start, shape, generator, device, dtype):
+        """Return the step to resume the current schedule at and the latents to resume it with, or None if no 
+        checkpoint can be used"""
+        sigmas = [self._sigma(scheduler, i) for i in range(len(scheduler.timesteps))]
+
+        best, best_step = None, None
+        for checkpoint in self.checkpoints:
+            if tuple(checkpoint.latents.shape) != tuple(shape): continue
+
+            steps = [i for i in range(t_start, len(sigmas)) if sigmas[i] >= checkpoint.sigma * (1 - 1e-4)]
+            if steps and (best is None or steps[-1] > best_step): best, best_step = checkpoint, steps[-1]
+
+        if best is None: return None
+
+        sigma = sigmas[best_step]
+        latents = best.latents.to(device=device, dtype=torch.float32)
+
+        if sigma > best.sigma * (1 + 1e-4):
+            # Top the noise up to the level of the step we're resuming at
+            noise_device = generator.device if generator is not None else device
+            noise = torch.randn(latents.shape, generator=generator, device=noise_device).to(device)
+            latents = latents + noise * (sigma ** 2 - best.sigma ** 2) ** 0.5
+        elif best.generator_state is not None and generator is not None:
+            # Resuming exactly where the checkpoint was saved, so pick the random sequence up from there too
+            generator.set_state(best.generator_state)
+
+        # The checkpoints up to the one resumed from are shared with this run, so it can be resumed from them too
+        self.saved = [checkpoint for checkpoint in self.checkpoints if checkpoint.sigma >= best.sigma]
+        self.resumed_from = best_step
+        return best_step, (latents * self._scale(scheduler, sigma)).to(dtype)
+
 class UnifiedPipeline(DynamicModuleDiffusionPipeline):
     r"""
     Pipeline for unified image generation using Stable Diffusion.
@@ -572,6 +1075,107 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         # set slice_size = `None` to disable `attention slicing`
         self.enable_attention_slicing(None)
 
+    def _denoise(self, mode, latents, noise_predictor, num_inference_steps, eta, generator, convergence_monitor, callback, callback_steps, resume_step=None, latent_checkpoints=None):
+        # reset the scheduler, and swap any multistep history in the scheduler for a fixed size buffer
+        self.scheduler.set_timesteps(num_inference_steps)
+        bound_scheduler_history(self.scheduler, {})
+
+        t_start = mode.t_start
+
+        timesteps_tensor = self.scheduler.timesteps[t_start:].to(self.device)
+        mode.prepareSteps(timesteps_tensor.shape[0])
+        noise_predictor.prepareSteps(t_start, timesteps_tensor.shape[0])
+        if convergence_monitor: convergence_monitor.restart()
+
+        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
+        # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
+        # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
+        # and should be between [0, 1]
+        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_noise_predictor = "noise_predictor" in set(inspect.signature(self.scheduler.step).parameters.keys())
+
+        extra_step_kwargs = {}
+        if accepts_eta: extra_step_kwargs["eta"] = eta
+        if accepts_generator: extra_step_kwargs["generator"] = generator
+        if accepts_noise_predictor: extra_step_kwargs["noise_predictor"] = noise_predictor.step
+
+        steps_used = 0
+
+        # When resuming from a checkpoint, skip the steps before it (step positions stay relative to the whole schedule)
+        skip = resume_step - t_start if resume_step is not None else 0
+        steps = list(enumerate(timesteps_tensor))[skip:]
+
+        # PLMS warms up by running the timestep after its first one twice, the second time redoing the first step as 
+        # a second order one. Its schedule only repeats that timestep at the very start, so repeat it for a resumed run
+        if skip and isinstance(self.scheduler, PNDMScheduler) and self.scheduler.config.skip_prk_steps:
+            if len(steps) > 1 and int(steps[0][1]) == int(steps[1][1]): del steps[1]
+            if len(steps) > 1: steps.insert(1, steps[1])
+
+        for j, (i, t) in enumerate(self.progress_bar(steps)):
+            t_index = t_start + i
+            steps_used = j + 1
+
+            # predict the noise residual
+            noise_pred = noise_predictor.step(latents, t_index, t)
+
+            # if the prediction has converged, jump straight to the end of the schedule
+            if convergence_monitor and convergence_monitor.step(self.scheduler, latents, noise_pred, t_index, t):
+                latents = convergence_monitor.original.to(latents.dtype)
+                latents = mode.latentStep(latents, t_start + len(timesteps_tensor) - 1, timesteps_tensor[-1], (len(timesteps_tensor) - 1) / (len(timesteps_tensor) + 1))
+                break
+
+            # compute the previous noisy sample x_t -> x_t-1
+
+            if isinstance(self.scheduler, OldSchedulerMixin): 
+                latents = self.scheduler.step(noise_pred, t_index, latents, **extra_step_kwargs).prev_sample
+            else:
+                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+            latents = mode.latentStep(latents, t_index, t, i / (timesteps_tensor.shape[0] + 1))
+
+            # the first run of a repeated timestep isn't finished yet, so it isn't saved or reported
+            if j + 1 < len(steps) and steps[j + 1][0] == i: continue
+
+            if latent_checkpoints: latent_checkpoints.save(self.scheduler, t_index, latents, generator)
+
+            # call the callback, if provided
+            if callback is not None and i % callback_steps == 0:
+                callback(i, t, latents)
+
+        if convergence_monitor: convergence_monitor.steps_used += steps_used
+
+        return latents
+
+    def _inpaintCrop(self, mask, margin):
+        """Find the area of the image that a mask allows to change, plus a margin of context
+
+        Returns (top, left, bottom, right), rounded out to a size the unet can handle, or None if 
+        that would be the whole image anyway.
+        """
+        # The unet halves the latents (which are 1/8th the image size) for each block after the first
+        granularity = 8 * 2 ** (len(self._unet.config.block_out_channels) - 1)
+
+        _, _, height, width = mask.shape
+        covered = mask[:, 0] > 0
+        rows = covered.any(dim=2).any(dim=0).nonzero()
+        cols = covered.any(dim=1).any(dim=0).nonzero()
+
+        if len(rows) == 0: return None
+
+        def span(start, end, size):
+            start, end = max(start - margin, 0), min(end + margin, size)
+            length = min(-(-(end - start) // granularity) * granularity, size)
+            # Grow evenly on both sides, but keep within the image
+            start = min(max(start - (length - (end - start)) // 2, 0), size - length)
+            return start, start + length
+
+        top, bottom = span(rows[0].item(), rows[-1].item() + 1, height)
+        left, right = span(cols[0].item(), cols[-1].item() + 1, width)
+
+        if bottom - top == height and right - left == width: return None
+        return top, left, bottom, right
+
     @torch.no_grad()
     def __call__(
         self,
@@ -581,9 +1185,12 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         init_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
         mask_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
         outmask_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
+        init_latents: Optional[torch.FloatTensor] = None,
         strength: float = 0.0,
         num_inference_steps: int = 50,
         guidance_scale: float = 7.5,
+        guidance_interval: float = 1.0,
+        guidance_threshold: float = 0.0,
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
@@ -592,8 +1199,20 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
         run_safety_checker: bool = True,
+        convergence_monitor: Optional[ConvergenceMonitor] = None,
+        inpaint_crop_margin: Optional[int] = None,
+        hires_fix_strength: Optional[float] = None,
+        hires_fix_base_size: int = 512,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = 128,
+        tile_batch_size: Optional[int] = None,
+        latent_checkpoints: Optional[LatentCheckpoints] = None,
+        batch_splitter: Optional[BatchSplitter] = None,
+        unet_batch_limit: Optional[int] = None,
+        vae_tile_size: Optional[int] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        latents_callback: Optional[Callable[[torch.FloatTensor], None]] = None,
         **kwargs,
     ):
         r"""
@@ -615,6 +1234,12 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
                 Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
                 1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
                 usually at the expense of lower image quality.
+            guidance_interval (`float`, *optional*, defaults to 1.0):
+                The fraction of the denoising steps, from the start, that classifier free guidance is applied for. The
+                remaining steps only run the text conditioned half of the batch through the unet.
+            guidance_threshold (`float`, *optional*, defaults to 0.0):
+                If set, stop applying classifier free guidance once the relative difference between the text conditioned
+                and unconditioned noise predictions drops below this value.
             negative_prompt (`str` or `List[str]`, *optional*):
                 The prompt or prompts not to guide the image generation. Ignored when not using guidance (i.e., ignored
                 if `guidance_scale` is less than `1`).
@@ -630,18 +1255,54 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
                 tensor will ge generated by sampling using the supplied random `generator`.
+            init_latents (`torch.FloatTensor`, *optional*):
+                Latents from an earlier generation (with `output_type="latent"`) to use instead of an init image. The
+                output is the same size as the latents.
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
-                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`, or `"latent"`
+                for the final latents (undecoded, and not safety checked), which can be passed back as `init_latents`.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
+            convergence_monitor (`ConvergenceMonitor`, *optional*):
+                If provided, stop the denoising loop early once the predicted final latents have converged. The number
+                of steps actually run is recorded in the monitor.
+            inpaint_crop_margin (`int`, *optional*):
+                If provided when inpainting with a tensor mask, only diffuse the area around the mask (plus this many
+                pixels of context on each side), and paste the result back into the init image.
+            hires_fix_strength (`float`, *optional*):
+                If provided when generating an image larger than `hires_fix_base_size` from just a prompt, generate at
+                the base size first, then upscale the latents and refine them at full size with this strength.
+            hires_fix_base_size (`int`, *optional*, defaults to 512):
+                The size of the longest side of the image generated in the first pass of hires fix.
+            tile_size (`int`, *optional*):
+                If provided and the image is larger than this in either dimension, run the unet over overlapping tiles
+                of this size and blend the results, so unet memory use depends on the tile size not the image size.
+            tile_overlap (`int`, *optional*, defaults to 128):
+                The number of pixels that neighbouring tiles overlap by.
+            tile_batch_size (`int`, *optional*):
+                The maximum number of tiles to pass through the unet at once. Defaults to all of them.
+            latent_checkpoints (`LatentCheckpoints`, *optional*):
+                If provided, save the latents at its save steps, and resume from the best of its checkpoints (if any 
+                can be used) instead of running the whole schedule.
+            batch_splitter (`BatchSplitter`, *optional*):
+                If provided, batches through the unet that run out of memory are split and retried rather than failing.
+            unet_batch_limit (`int`, *optional*):
+                The most latents to pass through the unet at once (counting the unconditional half and tiles). Only 
+                used with a `batch_splitter`.
+            vae_tile_size (`int`, *optional*):
+                If provided and the image is larger than this in either dimension, decode the latents in overlapping
+                tiles of this size, so VAE memory use depends on the tile size not the image size.
             callback (`Callable`, *optional*):
                 A function that will be called every `callback_steps` steps during inference. The function will be
                 called with the following arguments: `callback(step: int, timestep: int, latents: torch.FloatTensor)`.
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            latents_callback (`Callable`, *optional*):
+                A function that will be called with the final latents (before decoding), for callers that want to
+                keep them. Not called when only a crop of the image was diffused (see `inpaint_crop_margin`).
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -651,6 +1312,9 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
             (nsfw) content, according to the `safety_checker`.
         """
 
+        # Everything we were called with, so the inpaint crop path can pass it all on
+        call_args = {name: value for name, value in locals().items() if name not in ("self", "kwargs")}
+
         if isinstance(prompt, str):
             batch_size = 1
         elif isinstance(prompt, list):
@@ -672,7 +1336,44 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         if (outmask_image != None and init_image == None):
             raise ValueError(f"Can't pass a outmask without an image")
 
-        # set timesteps
+        if init_latents is not None:
+            if init_image != None: raise ValueError(f"Can't pass both an image and init latents")
+            # The output is the same size as the init latents
+            height, width = init_latents.shape[-2] * 8, init_latents.shape[-1] * 8
+
+        if output_type == "latent" and outmask_image != None and strength <= 1:
+            raise ValueError(f"Can't return latents when an outmask needs to be applied to the image")
+
+        if inpaint_crop_margin is not None and mask_image != None and strength <= 1 and isinstance(mask_image, torch.Tensor):
+            # Only the area covered by the outmask can change, so just diffuse a crop around that
+            crop = self._inpaintCrop(outmask_image if outmask_image != None else mask_image, inpaint_crop_margin)
+
+            if crop is not None:
+                top, left, bottom, right = crop
+                cropped = lambda tensor: tensor[:, :, top:bottom, left:right] if tensor != None else None
+
+                # Everything else (memory settings, tiling, checkpoints and so on) is passed on as is
+                image, _ = self(**{
+                    **kwargs, **call_args,
+                    "height": bottom-top, "width": right-left,
+                    "init_image": cropped(init_image), "mask_image": cropped(mask_image), 
+                    "outmask_image": cropped(outmask_image if outmask_image != None else mask_image),
+                    "inpaint_crop_margin": None,
+                    "output_type": "tensor",
+                    "return_dict": False,
+                    "run_safety_checker": False,
+                    # The crop's latents would only cover the crop, so latents_callback isn't called
+                    "latents_callback": None,
+                })
+
+                # Paste the result back into the rest of the (untouched) init image
+                source = init_image[:, [0,1,2]].to(self.device)
+                source = torch.cat([source] * (image.shape[0] // source.shape[0]))
+                source[:, :, top:bottom, left:right] = image.to(source)
+
+                return self._postprocessImage(source, self._unet.dtype, run_safety_checker, output_type, return_dict)
+
+        # set timesteps, so the modes can work out their starting latents
         self.scheduler.set_timesteps(num_inference_steps)
 
         # get prompt text embeddings
@@ -744,72 +1445,76 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         batch_total = batch_size * num_images_per_prompt
 
 
+        # Build the noise predictor. We move this into it's own class so it can be
+        # passed into a scheduler if they need to re-call
+        noise_predictor_kwargs = dict(
+            pipeline=self, 
+            text_embeddings=text_embeddings, 
+            do_classifier_free_guidance=do_classifier_free_guidance, guidance_scale=guidance_scale,
+            guidance_interval=guidance_interval, guidance_threshold=guidance_threshold,
+            batch_splitter=batch_splitter, batch_limit=unet_batch_limit
+        )
+
+        if tile_size and max(height, width) > tile_size:
+            if tile_size % 64 != 0 or tile_overlap % 8 != 0:
+                raise ValueError(f"`tile_size` has to be divisible by 64 and `tile_overlap` by 8 but are {tile_size} and {tile_overlap}.")
+
+            noise_predictor = TiledNoisePredictor(
+                tile_size=tile_size // 8, tile_overlap=tile_overlap // 8, tile_batch_size=tile_batch_size,
+                **noise_predictor_kwargs
+            )
+        else:
+            noise_predictor = NoisePredictor(**noise_predictor_kwargs)
+
+        # Runs the denoising loop for a mode. Modes that need more than one pass (like HiresFixMode) also call this themselves
+        denoise = lambda mode, latents, **kwargs: self._denoise(mode, latents, noise_predictor, num_inference_steps, eta, generator, convergence_monitor, callback, callback_steps, **kwargs)
+
         if mask_image != None: mode_class = EnhancedInpaintMode
-        elif init_image != None: mode_class = Img2imgMode
+        elif init_image != None or init_latents is not None: mode_class = Img2imgMode
+        elif hires_fix_strength and max(width, height) > hires_fix_base_size: mode_class = HiresFixMode
         else: mode_class = Txt2imgMode
 
         mode = mode_class(
             pipeline=self, 
             generator=generator,
             width=width, height=height,
-            init_image=init_image, mask_image=mask_image,
+            init_image=init_image, mask_image=mask_image, init_latents=init_latents,
             latents_dtype=latents_dtype,
             batch_total=batch_total,
             num_inference_steps=num_inference_steps,
-            strength=strength
+            strength=strength,
+            hires_strength=hires_fix_strength, hires_base_size=hires_fix_base_size,
+            denoise=denoise
         ) 
 
         print(f"Mode {mode.__class__} with strength {strength}")
 
-        # Build the noise predictor. We move this into it's own class so it can be
-        # passed into a scheduler if they need to re-call
-        noise_predictor = NoisePredictor(
-            pipeline=self, 
-            text_embeddings=text_embeddings, 
-            do_classifier_free_guidance=do_classifier_free_guidance, guidance_scale=guidance_scale
-        )
-
-        # Get the initial starting point - either pure random noise, or the source image with some noise depending on mode
-        latents = mode.generateLatents()
-
-        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-        # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-        # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-        # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        accepts_noise_predictor = "noise_predictor" in set(inspect.signature(self.scheduler.step).parameters.keys())
-
-        extra_step_kwargs = {}
-        if accepts_eta: extra_step_kwargs["eta"] = eta
-        if accepts_generator: extra_step_kwargs["generator"] = generator
-        if accepts_noise_predictor: extra_step_kwargs["noise_predictor"] = noise_predictor.step
-
-        t_start = mode.t_start
-
-        timesteps_tensor = self.scheduler.timesteps[t_start:].to(self.device)
-
-        for i, t in enumerate(self.progress_bar(timesteps_tensor)):
-            t_index = t_start + i
+        # When resuming, modes that don't need their initial latents can skip building them (a whole extra pass for HiresFixMode)
+        resume = None
+        resume_args = lambda shape: (self.scheduler, mode.t_start, shape, generator, self.device, latents_dtype)
+        if latent_checkpoints and mode.latents_shape is not None: resume = latent_checkpoints.resume(*resume_args(mode.latents_shape))
 
-            # predict the noise residual
-            noise_pred = noise_predictor.step(latents, t_index, t)
+        if resume is None:
+            # Get the initial starting point - either pure random noise, or the source image with some noise depending on mode
+            latents = mode.generateLatents()
+            if latent_checkpoints and mode.latents_shape is None: resume = latent_checkpoints.resume(*resume_args(latents.shape))
 
-            # compute the previous noisy sample x_t -> x_t-1
+        if resume is not None: 
+            resume_step, latents = resume
+        else:
+            resume_step = None
 
-            if isinstance(self.scheduler, OldSchedulerMixin): 
-                latents = self.scheduler.step(noise_pred, t_index, latents, **extra_step_kwargs).prev_sample
-            else:
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+        latents = denoise(mode, latents, resume_step=resume_step, latent_checkpoints=latent_checkpoints)
 
-            latents = mode.latentStep(latents, t_index, t, i / (timesteps_tensor.shape[0] + 1))
+        if latents_callback is not None: latents_callback(latents)
 
-            # call the callback, if provided
-            if callback is not None and i % callback_steps == 0:
-                callback(i, t, latents)
+        # Latents are returned as is, without decoding or a safety check
+        if output_type == "latent":
+            if not return_dict: return (latents, [False] * latents.shape[0])
+            return StableDiffusionPipelineOutput(images=latents, nsfw_content_detected=[False] * latents.shape[0])
 
         latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents).sample
+        image = self._decodeLatents(latents, vae_tile_size)
 
         image = (image / 2 + 0.5).clamp(0, 1)
 
@@ -824,12 +1529,41 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
 
             image = source * (1-outmask) + image * outmask
 
+        return self._postprocessImage(image, text_embeddings.dtype, run_safety_checker, output_type, return_dict)
+
+    def _decodeLatents(self, latents, tile_size=None, tile_overlap=64):
+        _, _, height, width = latents.shape
+        if not tile_size or max(height, width) * 8 <= tile_size: return self.vae.decode(latents).sample
+
+        # Sizes in latent pixels
+        tile, overlap = tile_size // 8, tile_overlap // 8
+        tile_height, tile_width = min(tile, height), min(tile, width)
+
+        image, weights = None, None
+        for top in tile_starts(height, tile, overlap):
+            for left in tile_starts(width, tile, overlap):
+                decoded = self.vae.decode(latents[:, :, top:top+tile_height, left:left+tile_width]).sample
+
+                if image is None:
+                    image = torch.zeros((*decoded.shape[:2], height * 8, width * 8), device=decoded.device, dtype=decoded.dtype)
+                    weights = torch.zeros((height * 8, width * 8), device=decoded.device, dtype=decoded.dtype)
+                    weight = (
+                        tile_weight(tile_height * 8, height * 8, tile_overlap, decoded.device, decoded.dtype)[:, None] *
+                        tile_weight(tile_width * 8, width * 8, tile_overlap, decoded.device, decoded.dtype)[None, :]
+                    )
+
+                image[:, :, top*8:(top+tile_height)*8, left*8:(left+tile_width)*8].addcmul_(decoded, weight)
+                weights[top*8:(top+tile_height)*8, left*8:(left+tile_width)*8] += weight
+
+        return image.div_(weights)
+
+    def _postprocessImage(self, image, dtype, run_safety_checker, output_type, return_dict):
         numpyImage = image.cpu().permute(0, 2, 3, 1).numpy()
 
         if run_safety_checker:
             # run safety checker
             safety_cheker_input = self.feature_extractor(self.numpy_to_pil(numpyImage), return_tensors="pt").to(self.device)
-            numpyImage, has_nsfw_concept = self.safety_checker(images=numpyImage, clip_input=safety_cheker_input.pixel_values.to(text_embeddings.dtype))
+            numpyImage, has_nsfw_concept = self.safety_checker(images=numpyImage, clip_input=safety_cheker_input.pixel_values.to(dtype))
         else:
             has_nsfw_concept = [False] * numpyImage.shape[0]
 
@@ -26,6 +26,7 @@ sys.path.append(generatedPath)
 import generation_pb2_grpc, dashboard_pb2_grpc, engines_pb2_grpc
 
 from sdgrpcserver.manager import EngineMode, EngineManager
+from sdgrpcserver.admission import AdmissionController
 from sdgrpcserver.services.dashboard import DashboardServiceServicer
 from sdgrpcserver.services.generate import GenerationServiceServicer
 from sdgrpcserver.services.engines import EnginesServiceServicer
@@ -83,7 +84,8 @@ class GrpcServer(object):
         interceptors = []        
         if args.access_token: interceptors.append(GrpcServerTokenChecker(args.access_token))
 
-        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors)
+        # Queued generation requests each hold a worker while they wait, so leave some spare for everything else
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max(4, args.max_queue + 4)), interceptors=interceptors)
         self._server.add_insecure_port(f"{host}:{port}")
 
     @property
@@ -244,6 +246,18 @@ class RoutingController(resource.Resource, CheckAuthHeaderMixin):
 
         return self.files.render(request) if self.files else self.wsgi.render(request)
 
+def build_manager(args):
+    with open(os.path.normpath(args.enginecfg), 'r') as cfg:
+        engines = yaml.load(cfg, Loader=Loader)
+
+    return EngineManager(
+        engines, 
+        weight_root=args.weight_root,
+        mode=EngineMode(vram_optimisation_level=args.vram_optimisation_level, enable_cuda=True, enable_mps=args.enable_mps), 
+        nsfw_behaviour=args.nsfw_behaviour,
+        snapshot_root=args.snapshot_root or None
+    )
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -265,11 +279,29 @@ def main():
         "--enable_mps", action="store_true", help="Use MPS on MacOS where available"
     )
     parser.add_argument(
-        "--vram_optimisation_level", "-V", type=int, default=os.environ.get("SD_VRAM_OPTIMISATION_LEVEL", 2), help="How much to trade off performance to reduce VRAM usage (0 = none, 2 = max)"
+        "--vram_optimisation_level", "-V", type=lambda value: value if value == "auto" else int(value), default=os.environ.get("SD_VRAM_OPTIMISATION_LEVEL", "auto"), help="How much to trade off performance to reduce VRAM usage (0 = none, 3 = max), or auto to plan it per request from the memory available"
     )
     parser.add_argument(
         "--nsfw_behaviour", "-N", type=str, default=os.environ.get("SD_NSFW_BEHAVIOUR", "block"), choices=["block", "flag"], help="What to do with images detected as NSFW"
     )
+    parser.add_argument(
+        "--max_queue", type=int, default=os.environ.get("SD_MAX_QUEUE", 16), help="How many generation requests can be queued (including the running one) before more are rejected"
+    )
+    parser.add_argument(
+        "--max_outstanding_cost", type=float, default=os.environ.get("SD_MAX_OUTSTANDING_COST", 600), help="Reject generation requests once the estimated time to run everything queued would be more than this many seconds"
+    )
+    parser.add_argument(
+        "--batch_aging", type=float, default=os.environ.get("SD_BATCH_AGING", 120), help="Seconds a batch priority request can wait before it's treated as interactive"
+    )
+    parser.add_argument(
+        "--user_weights", type=str, default=os.environ.get("SD_USER_WEIGHTS", ""), help="Comma separated user=weight list, for users (or access tokens) that should get a bigger (or smaller) share of the server than the default of 1"
+    )
+    parser.add_argument(
+        "--snapshot_root", type=str, default=os.environ.get("SD_SNAPSHOT_ROOT", ""), help="Path to keep engine snapshots in. Engines are restored from a matching snapshot there if there is one, rather than built from their weights"
+    )
+    parser.add_argument(
+        "--snapshot", action="store_true", help="Load the engines, save snapshots of them to --snapshot_root and exit, rather than serving"
+    )
     parser.add_argument(
         "--reload", action="store_true", help="Auto-reload on source change"
     )
@@ -295,6 +327,14 @@ def main():
     if args.localtunnel and not args.access_token:
         args.access_token = secrets.token_urlsafe(16)
 
+    if args.snapshot:
+        if not args.snapshot_root: parser.error("--snapshot needs a --snapshot_root")
+
+        manager = build_manager(args)
+        manager.loadPipelines()
+        for path in manager.snapshotPipelines(): print(f"Saved snapshot {path}")
+        return
+
     if args.reload:
         # start_reloader will only return in a monitored subprocess
         reloader = hupper.start_reloader('sdgrpcserver.server.main', reload_interval=10)
@@ -321,35 +361,38 @@ def main():
 
     prevHandler = signal.signal(signal.SIGINT, shutdown_reactor_handler)
 
-    with open(os.path.normpath(args.enginecfg), 'r') as cfg:
-        engines = yaml.load(cfg, Loader=Loader)
+    manager = build_manager(args)
+
+    print("Manager loaded")
 
-        manager = EngineManager(
-            engines, 
-            weight_root=args.weight_root,
-            mode=EngineMode(vram_optimisation_level=args.vram_optimisation_level, enable_cuda=True, enable_mps=args.enable_mps), 
-            nsfw_behaviour=args.nsfw_behaviour
+    # Both servers share the one generation servicer, so they share its queue (and caches)
+    generation_servicer = GenerationServiceServicer(
+        manager, 
+        admission=AdmissionController(
+            max_queue=args.max_queue, 
+            max_outstanding_cost=args.max_outstanding_cost,
+            aging_seconds=args.batch_aging,
+            weights={user.strip(): float(weight) for user, weight in (item.rsplit("=", 1) for item in args.user_weights.split(",") if item.strip())}
         )
+    )
 
-        print("Manager loaded")
+    generation_pb2_grpc.add_GenerationServiceServicer_to_server(generation_servicer, grpc.grpc_server)
+    dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), grpc.grpc_server)
+    engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), grpc.grpc_server)
 
-        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager), grpc.grpc_server)
-        dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), grpc.grpc_server)
-        engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), grpc.grpc_server)
+    generation_pb2_grpc.add_GenerationServiceServicer_to_server(generation_servicer, http.grpc_server)
+    dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), http.grpc_server)
+    engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), http.grpc_server)
 
-        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager), http.grpc_server)
-        dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), http.grpc_server)
-        engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), http.grpc_server)
+    print(f"GRPC listening on port {args.grpc_port}, HTTP listening on port {args.http_port}. Start your engines....")
 
-        print(f"GRPC listening on port {args.grpc_port}, HTTP listening on port {args.http_port}. Start your engines....")
+    manager.loadPipelines()
 
-        manager.loadPipelines()
+    print("All engines ready")
 
-        print("All engines ready")
+    # Block until termination
+    grpc.block()
 
-        # Block until termination
-        grpc.block()
 
-
-        
+    
 
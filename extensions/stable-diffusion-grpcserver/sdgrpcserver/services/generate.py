@@ -1,15 +1,18 @@
 
-from math import sqrt
-import random, traceback, threading
+import random, traceback, threading, hashlib, time
+from collections import OrderedDict
+from contextlib import contextmanager
 from types import SimpleNamespace as SN
 import torch
 
 import grpc
 import generation_pb2, generation_pb2_grpc
 
-from sdgrpcserver.utils import image_to_artifact, artifact_to_image
+from sdgrpcserver.utils import image_to_artifact, artifact_to_image, latents_to_artifact, artifact_to_latents
 
 from sdgrpcserver import images
+from sdgrpcserver.admission import PRIORITIES, AdmissionController, AdmissionRejectedError, CostModel
+from sdgrpcserver.pipeline.unified_pipeline import LatentCheckpoints, is_out_of_memory
 
 def buildDefaultMaskPostAdjustments():
     hardenMask = generation_pb2.ImageAdjustment()
@@ -32,11 +35,60 @@ def buildDefaultMaskPostAdjustments():
 
 defaultMaskPostAdjustments = buildDefaultMaskPostAdjustments();
 
+RESCALE_MODES = {
+    generation_pb2.RESCALE_STRICT: "strict",
+    generation_pb2.RESCALE_CROP: "crop",
+    generation_pb2.RESCALE_FIT: "fit",
+}
+
+# How many masks (after their post adjustments) to keep around, for clients that resend the same mask
+MASK_CACHE_SIZE = 16
+
+# How many answers to keep the final latents of, for variations (about 32KB each at 512x512)
+LATENT_CACHE_SIZE = 128
+
+# How many intermediate latents (across all requests) to keep for requests that asked for checkpoints
+CHECKPOINT_CACHE_SIZE = 256
+
+# When degrading a request to meet its deadline, aim to use this much of the time left (the rest is slack for
+# estimation error), and don't go below this many steps
+DEADLINE_HEADROOM = 0.8
+MIN_DEADLINE_STEPS = 4
+
+class EngineNotFoundError(Exception):
+    pass
+
+class InvalidChainError(Exception):
+    pass
+
+class InvalidArtifactError(Exception):
+    pass
+
+class InvalidParameterError(Exception):
+    pass
+
+class AnswerNotFoundError(Exception):
+    pass
+
+class CheckpointsNotFoundError(Exception):
+    pass
+
+class DeadlineExceededError(Exception):
+    pass
+
 debugCtr=0
 
 class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
-    def __init__(self, manager):
+    def __init__(self, manager, admission=None):
         self._manager = manager
+        self._admission = admission if admission is not None else AdmissionController()
+        self._mask_cache = OrderedDict()
+        self._mask_cache_lock = threading.Lock()
+        self._latent_cache = OrderedDict()
+        self._latent_cache_lock = threading.Lock()
+        self._checkpoint_cache = OrderedDict()
+        self._checkpoint_cache_lock = threading.Lock()
+        self._cost_model = CostModel()
 
     def saveDebugTensor(self, tensor):
         global debugCtr
@@ -48,163 +100,710 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
     def unimp(self, what):
         raise NotImplementedError(f"{what} not implemented")
 
-    def _handleImageAdjustment(self, tensor, adjustments):
-        if type(tensor) is bytes: tensor = images.fromPngBytes(tensor)
+    def _getUpscaler(self, upscaler):
+        # Upscalers can be passed by Upscaler enum value, or by name (with or without the UPSCALER_ prefix)
+        if isinstance(upscaler, str):
+            name = upscaler.upper()
+            if not name.startswith("UPSCALER_"): name = "UPSCALER_" + name
+            if name not in generation_pb2.Upscaler.keys(): self.unimp(f"Upscaler {upscaler}")
+            upscaler = generation_pb2.Upscaler.Value(name)
 
-        #self.saveDebugTensor(tensor)
+        try:
+            return self._manager.getUpscaler(upscaler)
+        except KeyError:
+            self.unimp(f"Upscaler {generation_pb2.Upscaler.Name(upscaler)}")
+
+    def _rescale(self, tensor, height, width, mode="strict", upscaler=generation_pb2.UPSCALER_RGB, hints=None):
+        upscaler = self._getUpscaler(upscaler)
+        algorithm = None
+
+        # Hints can pick a resampling algorithm, or a learned upscaler if one is available
+        for hint in hints or []:
+            if hint.lower() in images.RESIZE_ALGORITHMS: 
+                algorithm = hint.lower()
+            else:
+                try: upscaler = self._getUpscaler(hint)
+                except NotImplementedError: pass
+
+        return images.rescale(tensor.to(self._manager.mode.device), height, width, mode, lambda tensor, height, width: upscaler(tensor, height, width, algorithm))
+
+    def _compileImageAdjustments(self, adjustments, channels):
+        """
+        Turn a list of adjustments into a list of operations that give the same result when applied in order,
+        but with runs of pointwise adjustments (levels, invert, channels) fused into a single operation, and
+        crops moved ahead of them so they only touch the pixels that will be kept
+        """
+        ops = []
+        pointwise = None
 
         for adjustment in adjustments:
             which = adjustment.WhichOneof("adjustment")
 
+            if which in {"invert", "levels", "channels"}:
+                if pointwise is None: pointwise = images.PointwiseAdjustment(channels)
+
+                if which == "invert":
+                    pointwise.invert()
+                elif which == "levels":
+                    pointwise.levels(adjustment.levels.input_low, adjustment.levels.input_high, adjustment.levels.output_low, adjustment.levels.output_high)
+                else:
+                    pointwise.channelmap([adjustment.channels.r,  adjustment.channels.g,  adjustment.channels.b,  adjustment.channels.a])
+
+                channels = len(pointwise.sources)
+                continue
+
+            if which == "crop":
+                # Crops commute with pointwise adjustments, so go ahead of any pending ones
+                crop = adjustment.crop
+                ops.append(lambda tensor, crop=crop: images.crop(tensor, crop.top, crop.left, crop.height, crop.width))
+                continue
+
+            if pointwise: ops.append(pointwise)
+            pointwise = None
+
             if which == "blur":
                 sigma = adjustment.blur.sigma
                 direction = adjustment.blur.direction
 
                 if direction == generation_pb2.DIRECTION_DOWN or direction == generation_pb2.DIRECTION_UP:
-                    orig = tensor
-                    repeatCount=256
-                    sigma /= sqrt(repeatCount)
-
-                    for _ in range(repeatCount):
-                        tensor = images.gaussianblur(tensor, sigma)
-                        if direction == generation_pb2.DIRECTION_DOWN:
-                            tensor = torch.minimum(tensor, orig)
-                        else:
-                            tensor = torch.maximum(tensor, orig)
+                    direction = "up" if direction == generation_pb2.DIRECTION_UP else "down"
+                    ops.append(lambda tensor, sigma=sigma, direction=direction: images.directionalblur(tensor, sigma, direction))
                 else:
-                    tensor = images.gaussianblur(tensor, adjustment.blur.sigma)
-            elif which == "invert":
-                tensor = images.invert(tensor)
-            elif which == "levels":
-                tensor = images.levels(tensor, adjustment.levels.input_low, adjustment.levels.input_high, adjustment.levels.output_low, adjustment.levels.output_high)
-            elif which == "channels":
-                tensor = images.channelmap(tensor, [adjustment.channels.r,  adjustment.channels.g,  adjustment.channels.b,  adjustment.channels.a])
+                    ops.append(lambda tensor, sigma=sigma: images.gaussianblur(tensor, sigma))
             elif which == "rescale":
-                self.unimp("Rescale")
-            elif which == "crop":
-                tensor = images.crop(tensor, adjustment.crop.top, adjustment.crop.left, adjustment.crop.height, adjustment.crop.width)
-            
+                rescale = adjustment.rescale
+                ops.append(lambda tensor, rescale=rescale: self._rescale(tensor, rescale.height, rescale.width, RESCALE_MODES[rescale.mode], hints=rescale.algorithm_hint))
+
+        if pointwise: ops.append(pointwise)
+
+        return ops
+
+    def _handleImageAdjustment(self, tensor, adjustments):
+        if type(tensor) is bytes: tensor = images.fromPngBytes(tensor, self._manager.mode.device)
+
+        tensor = tensor.to(self._manager.mode.device)
+
+        #self.saveDebugTensor(tensor)
+
+        for op in self._compileImageAdjustments(adjustments, tensor.shape[1]):
+            tensor = op(tensor)
             #self.saveDebugTensor(tensor)
         
         return tensor
 
-    def Generate(self, request, context):
+    def _handleMask(self, binary, adjustments, postAdjustments):
+        key = hashlib.sha256(binary)
+        for adjustment in [*adjustments, None, *postAdjustments]: 
+            key.update(adjustment.SerializeToString() if adjustment else b"|")
+        key = key.digest()
+
+        with self._mask_cache_lock:
+            masks = self._mask_cache.get(key)
+            if masks: self._mask_cache.move_to_end(key)
+
+        if not masks:
+            mask = images.fromPngBytes(binary, self._manager.mode.device)
+            inMask = self._handleImageAdjustment(mask, adjustments)
+            outMask = self._handleImageAdjustment(inMask, postAdjustments)
+
+            # Cache on the CPU, so cached masks don't hold onto device memory
+            masks = (inMask.cpu(), outMask.cpu())
+
+            with self._mask_cache_lock:
+                self._mask_cache[key] = masks
+                while len(self._mask_cache) > MASK_CACHE_SIZE: self._mask_cache.popitem(last=False)
+
+        return [mask.to(self._manager.mode.device) for mask in masks]
+
+    def _cacheLatents(self, answer_id, latents):
+        # Cache on the CPU, so cached latents don't hold onto device memory
+        latents = latents.cpu()
+
+        with self._latent_cache_lock:
+            self._latent_cache[answer_id] = latents
+            self._latent_cache.move_to_end(answer_id)
+            while len(self._latent_cache) > LATENT_CACHE_SIZE: self._latent_cache.popitem(last=False)
+
+    def _cachedLatents(self, answer_id):
+        with self._latent_cache_lock:
+            latents = self._latent_cache.get(answer_id)
+            if latents is None: raise AnswerNotFoundError(answer_id)
+            self._latent_cache.move_to_end(answer_id)
+
+        return latents[None].to(self._manager.mode.device)
+
+    def _saveCheckpoints(self, request_id, seed, checkpoints):
+        with self._checkpoint_cache_lock:
+            samples = self._checkpoint_cache.setdefault(request_id, OrderedDict())
+            samples[seed] = checkpoints
+            self._checkpoint_cache.move_to_end(request_id)
+
+            # Evict the oldest requests, but never the one just saved (it's the newest, so it's the last one left)
+            while len(self._checkpoint_cache) > 1 and sum(len(checkpoints) for samples in self._checkpoint_cache.values() for checkpoints in samples.values()) > CHECKPOINT_CACHE_SIZE:
+                self._checkpoint_cache.popitem(last=False)
+
+    def _cachedCheckpoints(self, request_id):
+        # Returns a list of (seed, checkpoints) for each sample of the request, in order. Checkpoints aren't scoped to 
+        # a user, anyone who knows the request_id can resume from them
+        with self._checkpoint_cache_lock:
+            samples = self._checkpoint_cache.get(request_id)
+            if samples is None: raise CheckpointsNotFoundError(request_id)
+            self._checkpoint_cache.move_to_end(request_id)
+            return list(samples.items())
+
+    def _checkpointSteps(self, checkpoint_steps):
+        # Passed as a comma separated string, or an int if there's just one
         try:
-            # Assume that "None" actually means "Image" (stability-sdk/client.py doesn't set it)
-            if request.requested_type != generation_pb2.ARTIFACT_NONE and request.requested_type != generation_pb2.ARTIFACT_IMAGE:
-                self.unimp('Generation of anything except images')
-
-            # Extract prompt inputs
-            image=None
-            inMask=None
-            outMask=None
-            text=""
-            negative=""
-
-            for prompt in request.prompt:
-                which = prompt.WhichOneof("prompt")
-                if which == "text": 
-                    print(prompt, prompt.HasField("parameters"), prompt.parameters.HasField("weight") if prompt.HasField("parameters") else "")
-                    if prompt.HasField("parameters") and prompt.parameters.HasField("weight") and prompt.parameters.weight < 0:
-                        negative += prompt.text
-                    else:
-                        text += prompt.text
-                elif which == "sequence": 
-                    self.unimp("Sequence prompts")
+            return [int(step) for step in str(checkpoint_steps).split(",") if step.strip()]
+        except ValueError:
+            raise InvalidParameterError(f"checkpoint_steps should be a comma separated list of step numbers, not {checkpoint_steps}")
+
+    def _expectedSteps(self, params, has_init):
+        # img2img only runs the strength fraction of the schedule. Drafts are counted in full, even though the
+        # full quality pass resumes from partway through them
+        steps = params.steps * min(params.strength, 1) if has_init else params.steps
+        return steps + (params.draft_steps or 0)
+
+    def _estimateSeconds(self, engine_id, params, has_init, learned_only=False, pixels=None):
+        seconds = self._cost_model.estimate(
+            engine_id, params.sampler, pixels or params.height * params.width, self._expectedSteps(params, has_init), learned_only=learned_only
+        )
+        return None if seconds is None else seconds * params.samples
+
+    def _requestCost(self, request):
+        """Estimated seconds to generate a request, once it starts"""
+        if request.image.HasField("transform") and request.image.transform.WhichOneof("type") == "upscaler": return 0
+
+        params = self._parseParams(request)
+        has_init = bool(params.init_answer) or any(
+            prompt.WhichOneof("prompt") == "artifact" and prompt.artifact.type in {generation_pb2.ARTIFACT_IMAGE, generation_pb2.ARTIFACT_LATENT}
+            for prompt in request.prompt
+        )
+
+        return self._estimateSeconds(request.engine_id, params, has_init)
+
+    def _fitDeadline(self, engine_id, params, init_size, remaining, output_latents):
+        """
+        Check the request can finish in the time remaining, going by how long steps have taken on this engine so far. If
+        not, either reduce the steps or the resolution to fit (as set by the deadline_degrade parameter), or raise
+        DeadlineExceededError. init_size is the (height, width) of the init image or latents in pixels, or None
+        """
+        if params.deadline_degrade not in (None, "steps", "resolution"):
+            raise InvalidParameterError(f"deadline_degrade should be steps or resolution, not {params.deadline_degrade}")
+
+        has_init = init_size is not None
+        pixels = init_size[0] * init_size[1] if has_init else None
+
+        estimate = self._estimateSeconds(engine_id, params, has_init, learned_only=True, pixels=pixels)
+        if estimate is None or estimate <= remaining: return
+
+        fraction = remaining / estimate * DEADLINE_HEADROOM
+
+        if params.deadline_degrade == "steps":
+            steps = int(params.steps * fraction)
+            if steps >= MIN_DEADLINE_STEPS:
+                print(f"Reducing steps from {params.steps} to {steps} to meet the deadline")
+                params.steps = steps
+                return
+
+        # Images are generated smaller and then resized to the requested size, so that's not possible for latents. Nor 
+        # with an init, as the pipeline generates at the size of the init, not the requested size
+        elif params.deadline_degrade == "resolution" and not output_latents and not has_init:
+            height, width = int(params.height * fraction ** 0.5) // 64 * 64, int(params.width * fraction ** 0.5) // 64 * 64
+            if height >= 64 and width >= 64:
+                print(f"Reducing resolution from {params.width}x{params.height} to {width}x{height} to meet the deadline")
+                params.height, params.width = height, width
+                return
+
+        raise DeadlineExceededError(f"Request would take about {estimate:.1f}s, but only {remaining:.1f}s remain")
+
+    def _checkDeadline(self, deadline):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceededError("Deadline passed while generating")
+
+    def _generateDraft(self, pipe, params, output_size, **kwargs):
+        """
+        Generate a quick preview of a sample, with few steps of a cheap sampler and optionally at a lower resolution.
+        Returns the draft result, and the checkpoint halfway through the draft for the full quality pass to resume 
+        from (if the draft ran at full resolution, and the full quality pass doesn't use PLMS)
+        """
+        draft_params = SN(**vars(params))
+        draft_params.steps = params.draft_steps
+        draft_params.sampler = generation_pb2.SAMPLER_K_EULER
+        draft_params.convergence_tolerance = 0
+
+        if params.draft_scale and params.draft_scale < 1:
+            draft_params.height = max(64, round(params.height * params.draft_scale / 64) * 64)
+            draft_params.width = max(64, round(params.width * params.draft_scale / 64) * 64)
+
+        latent_checkpoints = LatentCheckpoints(range(1, params.draft_steps + 1))
+
+        # A draft is only a preview, so it skips the safety checker unless the server blocks NSFW images outright
+        results = pipe.generate(
+            params=draft_params, latent_checkpoints=latent_checkpoints, 
+            run_safety_checker=self._manager.nsfw_behaviour == "block", **kwargs
+        )
+
+        # Drafts are returned at the same size as the final result
+        height, width = output_size
+
+        draft_images = results[0]
+        if (draft_params.height, draft_params.width) != (height, width):
+            draft_images = self._rescale(draft_images, height, width)
+
+        result = SN(image=draft_images[0], latents=None, finish_reason=generation_pb2.FILTER if results[1][0] else generation_pb2.NULL, seed=params.seed, steps=results[2], draft=True)
+
+        # Hires fix composes the image in its base pass, so resuming its full size pass from the draft would skip that.
+        # And PLMS (the default sampler) only gets its warm-up back when resuming, so it runs the whole schedule instead
+        saved = latent_checkpoints.saved
+        if params.hires_fix_strength or len(saved) < 2: return result, []
+        if params.sampler is None or params.sampler == generation_pb2.SAMPLER_DDPM: return result, []
+        return result, [saved[len(saved) // 2 - 1]]
+
+    def _parseParams(self, request):
+        """Collect the generation parameters of a request, from the standard fields and any local extensions"""
+        params=SN(
+            height=512,
+            width=512,
+            cfg_scale=7.5,
+            cfg_interval=1.0,
+            cfg_threshold=0.0,
+            convergence_tolerance=0.0,
+            convergence_patience=3,
+            inpaint_crop_margin=None,
+            hires_fix_strength=None,
+            hires_fix_base_size=512,
+            tile_size=None,
+            tile_overlap=128,
+            tile_batch_size=None,
+            upscaler=generation_pb2.UPSCALER_RGB,
+            upscale_factor=None,
+            init_answer=None,
+            checkpoint_steps=None,
+            resume_from=None,
+            draft_steps=None,
+            draft_scale=None,
+            deadline_degrade=None,
+            eta=0,
+            sampler=None,
+            steps=50,
+            seed=-1,
+            samples=1,
+            strength=0.8
+        )
+
+        for field in vars(params):
+            try:
+                if request.image.HasField(field):
+                    setattr(params, field, getattr(request.image, field))
+            except Exception as e:
+                pass
+
+        for extras in request.image.parameters:
+            if extras.HasField("sampler"):
+                if extras.sampler.HasField("cfg_scale"): params.cfg_scale = extras.sampler.cfg_scale
+                if extras.sampler.HasField("eta"): params.eta = extras.sampler.eta
+                if extras.sampler.HasField("cfg_interval"): params.cfg_interval = extras.sampler.cfg_interval
+                if extras.sampler.HasField("cfg_threshold"): params.cfg_threshold = extras.sampler.cfg_threshold
+                if extras.sampler.HasField("convergence_tolerance"): params.convergence_tolerance = extras.sampler.convergence_tolerance
+                if extras.sampler.HasField("convergence_patience"): params.convergence_patience = extras.sampler.convergence_patience
+            if extras.HasField("schedule"):
+                if extras.schedule.HasField("start"): params.strength = extras.schedule.start            
+
+        # Local extensions are passed by name, and override any param with the same name
+        if request.image.HasField("extension"):
+            for extension in request.image.extension.parameters:
+                if extension.name not in vars(params): self.unimp(f"Extended parameter {extension.name}")
+                setattr(params, extension.name, getattr(extension, extension.WhichOneof("value")))
+
+        if request.image.HasField("transform") and request.image.transform.WhichOneof("type") == "diffusion": params.sampler = request.image.transform.diffusion
+
+        return params
+
+    def _generateResults(self, request, stop_event, deadline=None, init_image=None, init_latents=None, drafts=False):
+        """
+        Run a single Request, yielding each result as a SimpleNamespace of image (a CHW tensor, or None if the 
+        request asked for ARTIFACT_LATENT), latents (the final CHW latents, or None if not available), finish_reason, 
+        seed and steps (or None if unknown), without encoding it. If init_image or init_latents is passed it is 
+        used as the init, and any image, latent artifact or init_answer in the request is ignored
+        """
+        # Assume that "None" actually means "Image" (stability-sdk/client.py doesn't set it)
+        if request.requested_type not in {generation_pb2.ARTIFACT_NONE, generation_pb2.ARTIFACT_IMAGE, generation_pb2.ARTIFACT_LATENT}:
+            self.unimp('Generation of anything except images or latents')
+
+        output_latents = request.requested_type == generation_pb2.ARTIFACT_LATENT
+
+        # Latents skip the safety checker, so only hand them out if the server would hand out NSFW images anyway
+        if output_latents and self._manager.nsfw_behaviour == "block":
+            self.unimp("Latent output when NSFW images are blocked")
+
+        passed_init = init_image is not None or init_latents is not None
+
+        # Extract prompt inputs
+        image=init_image
+        latents=init_latents
+        inMask=None
+        outMask=None
+        text=""
+        negative=""
+
+        for prompt in request.prompt:
+            which = prompt.WhichOneof("prompt")
+            if which == "text": 
+                print(prompt, prompt.HasField("parameters"), prompt.parameters.HasField("weight") if prompt.HasField("parameters") else "")
+                if prompt.HasField("parameters") and prompt.parameters.HasField("weight") and prompt.parameters.weight < 0:
+                    negative += prompt.text
+                else:
+                    text += prompt.text
+            elif which == "sequence": 
+                self.unimp("Sequence prompts")
+            else:
+                if prompt.artifact.type == generation_pb2.ARTIFACT_IMAGE:
+                    # An init image passed in from an earlier stage takes the place of any in the request
+                    if passed_init: continue
+
+                    image = images.fromPngBytes(prompt.artifact.binary, self._manager.mode.device)
+                    image = self._handleImageAdjustment(image, prompt.artifact.adjustments)
+                elif prompt.artifact.type == generation_pb2.ARTIFACT_LATENT:
+                    if passed_init: continue
+
+                    try:
+                        latents = artifact_to_latents(prompt.artifact, self._manager.mode.device)
+                    except ValueError as e:
+                        raise InvalidArtifactError(str(e))
+                elif prompt.artifact.type == generation_pb2.ARTIFACT_MASK:
+                    postAdjustments = prompt.artifact.postAdjustments
+                    if not postAdjustments: postAdjustments = defaultMaskPostAdjustments
+
+                    inMask, outMask = self._handleMask(prompt.artifact.binary, prompt.artifact.adjustments, postAdjustments)
                 else:
-                    if prompt.artifact.type == generation_pb2.ARTIFACT_IMAGE:
-                        image = images.fromPngBytes(prompt.artifact.binary).to(self._manager.mode.device)
-                        image = self._handleImageAdjustment(image, prompt.artifact.adjustments)
-                    elif prompt.artifact.type == generation_pb2.ARTIFACT_MASK:
-                        mask = images.fromPngBytes(prompt.artifact.binary).to(self._manager.mode.device)
-                        inMask = self._handleImageAdjustment(mask, prompt.artifact.adjustments)
+                    self.unimp(f"Artifact prompts of type {prompt.artifact.type}")
 
-                        postAdjustments = prompt.artifact.postAdjustments
-                        if not postAdjustments: postAdjustments = defaultMaskPostAdjustments
+        params = self._parseParams(request)
+        seeds = list(request.image.seed)
 
-                        outMask = self._handleImageAdjustment(inMask, postAdjustments)
-                    else:
-                        self.unimp(f"Artifact prompts of type {prompt.artifact.type}")
-
-            params=SN(
-                height=512,
-                width=512,
-                cfg_scale=7.5,
-                eta=0,
-                sampler=None,
-                steps=50,
-                seed=-1,
-                samples=1,
-                strength=0.8
-            )
-
-            for field in vars(params):
-                try:
-                    if request.image.HasField(field):
-                        setattr(params, field, getattr(request.image, field))
-                except Exception as e:
-                    pass
-            
-            seeds = list(request.image.seed)
-
-            for extras in request.image.parameters:
-                if extras.HasField("sampler"):
-                    if extras.sampler.HasField("cfg_scale"): params.cfg_scale = extras.sampler.cfg_scale
-                    if extras.sampler.HasField("eta"): params.eta = extras.sampler.eta
-                if extras.HasField("schedule"):
-                    if extras.schedule.HasField("start"): params.strength = extras.schedule.start            
-            
-            if request.image.HasField("transform") and request.image.transform.WhichOneof("type") == "diffusion": params.sampler = request.image.transform.diffusion
+        # Variations start from the cached final latents of an earlier answer, rather than an uploaded image
+        if params.init_answer and not passed_init:
+            if latents is not None: self.unimp("Both init latents and an init_answer")
+            latents = self._cachedLatents(params.init_answer)
 
-            try:
-                pipe = self._manager.getPipe(request.engine_id)
-            except KeyError as e:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details("Engine not found")
-                return
+        if latents is not None:
+            if image is not None: self.unimp("Both an init image and init latents")
+            if inMask is not None: self.unimp("Masks with init latents")
+
+            # Either every sample starts from the same latents, or each from its own
+            if latents.shape[0] not in (1, params.samples):
+                samples = f" or {params.samples} (the number of samples)" if params.samples > 1 else ""
+                raise InvalidArtifactError(f"Init latents should have a batch of 1{samples}, not {latents.shape[0]}")
+
+        # Masked results are composited with the init image, which needs the decoded image
+        if output_latents and inMask is not None: self.unimp("Latent output when inpainting")
+
+        # An upscaler transform just upscales the init image, with no diffusion
+        if request.image.HasField("transform") and request.image.transform.WhichOneof("type") == "upscaler":
+            if image is None: self.unimp("Upscaling without an init image")
+            if output_latents: self.unimp("Latent output when upscaling")
+
+            height = request.image.height if request.image.HasField("height") else 0
+            width = request.image.width if request.image.HasField("width") else 0
 
-            stop_event = threading.Event()
-            context.add_callback(lambda: stop_event.set())
-
-            ctr = 0
-            last_seed = -1
-
-            for _ in range(params.samples):
-                seed = -1
-
-                # While we still have seeds from the client, consume them
-                if seeds:
-                    seed = seeds.pop(0)
-                # Or if we have a previous seed, sequentially work from that
-                elif last_seed != -1:
-                    seed = last_seed + 1
-
-                # If either the client passed -1, or they passed nothing & this is our first seed, pick something randomly
-                if seed == -1: 
-                    seed = random.randrange(0, 2**32-1)
-
-                params.seed = last_seed = seed
-                print(f'Generating {repr(params)}, {"with Image" if image != None else ""}, {"with Mask" if inMask != None else ""}')
-                results = pipe.generate(text=text, negative_text=negative, image=image, mask=inMask, outmask=outMask, params=params, stop_event=stop_event)
-
-                for result_image, nsfw in zip(results[0], results[1]):
-                    answer = generation_pb2.Answer()
-                    answer.request_id=request.request_id
-                    answer.answer_id=f"{request.request_id}-{ctr}"
-                    artifact=image_to_artifact(result_image)
-                    artifact.finish_reason=generation_pb2.FILTER if nsfw else generation_pb2.NULL
-                    artifact.index=ctr
-                    artifact.seed=seed
-                    answer.artifacts.append(artifact)
- 
-                    yield answer
-                    ctr += 1
-            
+            if not height and not width: 
+                factor = params.upscale_factor or 2
+                height, width = round(image.shape[-2] * factor), round(image.shape[-1] * factor)
+
+            upscaled = self._rescale(image, height, width, upscaler=request.image.transform.upscaler)
+            yield SN(image=upscaled[0], latents=None, finish_reason=generation_pb2.NULL, seed=0, steps=None, draft=False)
+            return
+
+        try:
+            pipe = self._manager.getPipe(request.engine_id)
+        except KeyError as e:
+            raise EngineNotFoundError(request.engine_id)
+
+        if output_latents and params.upscale_factor: self.unimp("Latent output with upscale_factor")
+
+        checkpoint_steps = self._checkpointSteps(params.checkpoint_steps) if params.checkpoint_steps else []
+        resume_samples = self._cachedCheckpoints(params.resume_from) if params.resume_from else []
+
+        if (checkpoint_steps or resume_samples) and not request.request_id: self.unimp("Checkpoints without a request_id")
+
+        # A request with more checkpoints than the whole cache holds would push out everything else
+        if len(set(checkpoint_steps)) * params.samples > CHECKPOINT_CACHE_SIZE:
+            raise InvalidParameterError(f"At most {CHECKPOINT_CACHE_SIZE} checkpoints can be kept per request (checkpoint steps times samples)")
+
+        # The size to return images at, even if they're generated at a lower resolution to meet the deadline
+        output_size = params.height, params.width
+        if params.upscale_factor: output_size = round(params.height * params.upscale_factor), round(params.width * params.upscale_factor)
+
+        has_init = image is not None or latents is not None
+
+        # With an init, the pipeline generates at the size of the init rather than the requested size
+        init_size = None
+        if image is not None: init_size = tuple(image.shape[-2:])
+        elif latents is not None: init_size = latents.shape[-2] * 8, latents.shape[-1] * 8
+
+        if deadline is not None: self._fitDeadline(request.engine_id, params, init_size, deadline - time.monotonic(), output_latents)
+
+        last_seed = -1
+
+        for sample in range(params.samples):
+            seed = -1
+
+            # While we still have seeds from the client, consume them
+            if seeds:
+                seed = seeds.pop(0)
+            # Or if we have a previous seed, sequentially work from that
+            elif last_seed != -1:
+                seed = last_seed + 1
+
+            # If either the client passed -1, or they passed nothing & this is our first seed, pick something randomly
+            if seed == -1: 
+                seed = random.randrange(0, 2**32-1)
+
+            # A sample resuming from an earlier request's checkpoints carries on with the seed of the matching sample
+            checkpoints = []
+            if sample < len(resume_samples): seed, checkpoints = resume_samples[sample]
+
+            params.seed = last_seed = seed
+
+            # In a chain, a later stage might have activated a different engine since the last sample
+            pipe = self._manager.getPipe(request.engine_id)
+
+            print(f'Generating {repr(params)}, {"with Image" if image != None else ""}, {"with Mask" if inMask != None else ""}')
+            sample_latents = latents[sample:sample+1] if latents is not None and latents.shape[0] > 1 else latents
+            inputs = dict(text=text, negative_text=negative, image=image, mask=inMask, outmask=outMask, stop_event=stop_event, init_latents=sample_latents)
+
+            # Stream a quick draft first, and then carry on from partway through it to the full quality result
+            if drafts and params.draft_steps and not checkpoints and not output_latents:
+                draft, checkpoints = self._generateDraft(pipe, params, output_size, **inputs)
+                self._checkDeadline(deadline)
+                yield draft
+                if stop_event.is_set(): break
+
+            latent_checkpoints = None
+            if checkpoint_steps or checkpoints: latent_checkpoints = LatentCheckpoints(checkpoint_steps, checkpoints)
+
+            start = time.monotonic()
+            results = pipe.generate(params=params, output_latents=output_latents, latent_checkpoints=latent_checkpoints, **inputs)
+            self._checkDeadline(deadline)
+
+            if not stop_event.is_set():
+                steps = results[2]
+                if steps is None and latent_checkpoints and latent_checkpoints.resumed_from is not None: steps = params.steps - latent_checkpoints.resumed_from
+                if steps is None: steps = self._expectedSteps(params, has_init) - (params.draft_steps or 0)
+                # Time it against the size actually generated, which with an init (or latents) isn't the requested size
+                height, width = results[0].shape[-2:]
+                if output_latents: height, width = height * 8, width * 8
+                self._cost_model.record(request.engine_id, params.sampler, height * width, steps, time.monotonic() - start)
+
+            # Keep the checkpoints (including any this run resumed from), so this request can be resumed from too
+            if latent_checkpoints and latent_checkpoints.saved:
+                self._saveCheckpoints(request.request_id, seed, latent_checkpoints.saved)
+
+            result_latents = results[3] if results[3] is not None else [None] * len(results[1])
+
+            if output_latents:
+                for result_latent in result_latents:
+                    yield SN(image=None, latents=result_latent, finish_reason=generation_pb2.NULL, seed=seed, steps=results[2], draft=False)
+                continue
+
+            result_images = results[0]
+            if output_size != (params.height, params.width):
+                result_images = self._rescale(result_images, *output_size, upscaler=params.upscaler)
+
+            for result_image, result_latent, nsfw in zip(result_images, result_latents, results[1]):
+                # Don't keep the latents of filtered images around for variations
+                if nsfw: result_latent = None
+                yield SN(image=result_image, latents=result_latent, finish_reason=generation_pb2.FILTER if nsfw else generation_pb2.NULL, seed=seed, steps=results[2], draft=False)
+
+    def _buildAnswer(self, request_id, answer_id, index, result):
+        answer = generation_pb2.Answer()
+        answer.request_id=request_id
+        answer.answer_id=answer_id
+        if result.steps is not None: answer.meta.steps=result.steps
+        if result.image is None: artifact=latents_to_artifact(result.latents[None])
+        else: artifact=image_to_artifact(result.image.cpu())
+        if result.latents is not None: self._cacheLatents(answer_id, result.latents)
+        artifact.finish_reason=result.finish_reason
+        artifact.index=index
+        artifact.seed=result.seed
+        if result.draft: artifact.draft=True
+        answer.artifacts.append(artifact)
+        return answer
+
+    def _handleErrors(self, context, answers):
+        try:
+            yield from answers
+        except EngineNotFoundError as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("Engine not found")
+        except AnswerNotFoundError as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(f"Answer {e} not found (its latents may have expired from the cache)")
+        except CheckpointsNotFoundError as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(f"No checkpoints for request {e} (they may have expired from the cache)")
+        except AdmissionRejectedError as e:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(str(e))
+            context.set_trailing_metadata((("estimated-wait", f"{e.wait:.1f}"),))
+        except DeadlineExceededError as e:
+            context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+            context.set_details(str(e))
+            print(f"Deadline exceeded: {e}")
+        except (InvalidChainError, InvalidArtifactError, InvalidParameterError) as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            print(f"Invalid request: {e}")
         except NotImplementedError as e:
             context.set_code(grpc.StatusCode.UNIMPLEMENTED)
             context.set_details(str(e))
             print(f"Unsupported request parameters: {e}")
         except Exception as e:
             traceback.print_exc()
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details("Something went wrong")
+            # Batches are already split down to one before an allocation failure gets this far
+            if is_out_of_memory(e):
+                context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                context.set_details("Out of memory, try a smaller size or enable tiling")
+            else:
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details("Something went wrong")
+
+    @contextmanager
+    def _stopEvent(self, context):
+        """Gives an event that's set when the request is cancelled or its deadline passes, for the length of the request"""
+        stop_event = threading.Event()
+        context.add_callback(lambda: stop_event.set())
+
+        # Stop at the deadline too (the client has given up by then, and GRPC-WEB doesn't support cancelling anyway)
+        timer = None
+        remaining = context.time_remaining()
+        if remaining is not None:
+            timer = threading.Timer(remaining, stop_event.set)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            yield stop_event
+        finally:
+            # Don't leave a timer thread around until the deadline once the request is done
+            if timer is not None: timer.cancel()
+
+    def _deadline(self, context):
+        remaining = context.time_remaining()
+        return None if remaining is None else time.monotonic() + remaining
+
+    def _requester(self, request, context):
+        """
+        The priority class and owner to queue a request under. Priority comes from the `priority` metadata, or 
+        otherwise is batch for request agents that say they're batch (like `g-diffuser-cli/batch`) and interactive
+        for everything else. Requests are shared out fairly by the `user` metadata, or the access token if not given
+        """
+        metadata = {key: value for key, value in (context.invocation_metadata() or ())}
+
+        priority = metadata.get("priority", "").lower()
+        if priority not in PRIORITIES: priority = "batch" if "batch" in request.request_agent.lower() else "interactive"
+
+        return priority, metadata.get("user") or metadata.get("authorization", "")
+
+    @contextmanager
+    def _admitted(self, cost, stop_event, deadline, priority="interactive", owner=""):
+        """
+        Queue a request with the admission controller, and wait for its turn to run. Gives True once it's running, 
+        or False if it was cancelled while waiting
+        """
+        if deadline is not None:
+            wait, _, _ = self._admission.estimate(cost, priority, owner)
+            if wait > deadline - time.monotonic(): raise DeadlineExceededError(f"Request wouldn't start for about {wait:.1f}s, after its deadline")
+
+        with self._admission.slot(cost, stop_event, priority, owner) as running:
+            if not running: self._checkDeadline(deadline)
+            yield running
+
+    def Generate(self, request, context):
+        def answers():
+            deadline = self._deadline(context)
+            requester = self._requester(request, context)
+
+            with self._stopEvent(context) as stop_event, self._admitted(self._requestCost(request), stop_event, deadline, *requester) as running:
+                if not running: return
+
+                ctr = 0
+                for result in self._generateResults(request, stop_event, deadline, drafts=True):
+                    # A draft has the same index as the result that replaces it
+                    if result.draft:
+                        yield self._buildAnswer(request.request_id, f"{request.request_id}-{ctr}-draft", ctr, result)
+                    else:
+                        yield self._buildAnswer(request.request_id, f"{request.request_id}-{ctr}", ctr, result)
+                        ctr += 1
+
+        yield from self._handleErrors(context, answers())
+
+    def _checkChain(self, stages):
+        # Every target needs to exist, and following targets must never lead back to an earlier stage
+        def visit(stage_id, path):
+            if stage_id in path: raise InvalidChainError(f"Stage {stage_id} is part of a cycle")
+            for on_status in stages[stage_id].on_status:
+                if not on_status.HasField("target"): continue
+                if on_status.target not in stages: raise InvalidChainError(f"Stage {stage_id} targets unknown stage {on_status.target}")
+                visit(on_status.target, path | {stage_id})
+
+        for stage_id in stages: visit(stage_id, set())
+
+    def _stageActions(self, stage, finish_reason):
+        # Results that don't match any OnStatus are returned to the client
+        matches = [on_status for on_status in stage.on_status if not on_status.reason or finish_reason in on_status.reason]
+        if not matches: return [(None, generation_pb2.STAGE_ACTION_RETURN)]
+
+        return [(on_status.target if on_status.HasField("target") else None, action) for on_status in matches for action in on_status.action]
+
+    def _runStage(self, chain, stages, stage, stop_event, deadline, counters, init_image=None, init_latents=None):
+        for result in self._generateResults(stage.request, stop_event, deadline, init_image, init_latents):
+            for target, action in self._stageActions(stage, result.finish_reason):
+                if action == generation_pb2.STAGE_ACTION_RETURN:
+                    # A stage can run more than once in a chain, so count answers per stage across the whole chain
+                    ctr = counters[stage.id] = counters.get(stage.id, -1) + 1
+                    yield self._buildAnswer(chain.request_id, f"{chain.request_id}-{stage.id}-{ctr}", ctr, result)
+                elif action == generation_pb2.STAGE_ACTION_PASS and target:
+                    # Hand the image (or latents) on as a tensor on the device, rather than round tripping it through a PNG
+                    device = self._manager.mode.device
+                    if result.image is None: passed = dict(init_latents=result.latents[None].to(device))
+                    else: passed = dict(init_image=result.image[None].to(device))
+
+                    yield from self._runStage(chain, stages, stages[target], stop_event, deadline, counters, **passed)
+
+            if stop_event.is_set(): break
+
+    def ChainGenerate(self, request, context):
+        """
+        Run a chain of stages, starting with the first. Each result of a stage is returned, passed on to the 
+        target stage as its init image, or discarded, depending on the stage's OnStatus rules. Only returned 
+        results are ever encoded
+        """
+        def answers():
+            stages = {stage.id: stage for stage in request.stage}
+            self._checkChain(stages)
+
+            if not request.stage: return
+            deadline = self._deadline(context)
+
+            # Stages can run more than once, or not at all, but each stage once is a reasonable guess
+            cost = sum(self._requestCost(stage.request) for stage in request.stage)
+            requester = self._requester(request.stage[0].request, context)
+
+            with self._stopEvent(context) as stop_event, self._admitted(cost, stop_event, deadline, *requester) as running:
+                if running: yield from self._runStage(request, stages, request.stage[0], stop_event, deadline, {})
+
+        yield from self._handleErrors(context, answers())
+
+    def Estimate(self, request, context):
+        """
+        How long a request is expected to take, and to wait before starting, going by recent timings on its engine and
+        the requests already queued. Also says if it would be admitted right now, without actually queuing it
+        """
+        def estimates():
+            seconds = self._requestCost(request)
+            wait, queued, admitted = self._admission.estimate(seconds, *self._requester(request, context))
+            yield generation_pb2.CostEstimate(seconds=seconds, wait=wait, queued=queued, admitted=admitted)
+
+        return next(self._handleErrors(context, estimates()), generation_pb2.CostEstimate())
@@ -0,0 +1,82 @@
+import os, json, glob, hashlib, inspect, shutil, tempfile, time
+
+import torch
+
+# Bump when the bundle layout changes
+SNAPSHOT_VERSION = 1
+
+def _codeFingerprint():
+    # Snapshots are pickles, so they're only valid for the exact code (and libraries) that made them
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.py"), recursive=True)):
+        with open(path, "rb") as f: digest.update(f.read())
+    return digest.hexdigest()
+
+def _libraryVersions():
+    import diffusers, transformers
+    return {"torch": torch.__version__, "diffusers": diffusers.__version__, "transformers": transformers.__version__}
+
+class SnapshotStore(object):
+    """
+    Saves fully initialised engines (weights, schedulers, safety checker and all) as versioned bundles under root,
+    and restores them with a single load. Each bundle is a directory holding a manifest.json and the pickled engine,
+    named by a hash of everything that has to match for it to be reused: the bundle version, the engine's config,
+    how it was loaded (precision, NSFW behaviour), the library versions and the server code. Anything else just
+    doesn't find a bundle, and the engine is built from its weights as usual
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._fingerprint = None
+
+    def _manifest(self, engine, settings):
+        if self._fingerprint is None: self._fingerprint = _codeFingerprint()
+
+        return {
+            "version": SNAPSHOT_VERSION,
+            "engine": engine,
+            "settings": settings,
+            "libraries": _libraryVersions(),
+            "code": self._fingerprint,
+        }
+
+    def _path(self, manifest):
+        digest = hashlib.sha256(json.dumps(manifest, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.root, f"{manifest['engine']['id']}-{digest[:16]}")
+
+    def save(self, engine, settings, obj):
+        """Save obj as the snapshot of engine when loaded with settings (a dict), replacing any older one. Returns the bundle path"""
+        manifest = self._manifest(engine, settings)
+        path = self._path(manifest)
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # Write to a temporary directory and move it into place, so a reader never sees half a bundle
+        staging = tempfile.mkdtemp(prefix=".snapshot-", dir=self.root)
+        try:
+            torch.save(obj, os.path.join(staging, "engine.pt"))
+            with open(os.path.join(staging, "manifest.json"), "w") as f:
+                json.dump({**manifest, "created": time.time()}, f, indent=2, default=str)
+
+            if os.path.exists(path): shutil.rmtree(path)
+            os.rename(staging, path)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        return path
+
+    def load(self, engine, settings):
+        """Load the snapshot of engine when loaded with settings, or return None if there isn't a usable one"""
+        path = self._path(self._manifest(engine, settings))
+        if not os.path.exists(os.path.join(path, "manifest.json")): return None
+
+        # Newer torch only loads plain tensors by default
+        kwargs = {"weights_only": False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+
+        try:
+            return torch.load(os.path.join(path, "engine.pt"), map_location="cpu", **kwargs)
+        except Exception as e:
+            print(f"Couldn't restore snapshot {path}, building {engine['id']} instead: {e}")
+            return None
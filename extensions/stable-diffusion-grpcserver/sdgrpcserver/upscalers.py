@@ -0,0 +1,59 @@
+import torch
+
+from sdgrpcserver import images
+
+class RGBUpscaler(object):
+    """
+    Upscales (or downscales) by plain resampling. Always available, and runs as batched tensor ops on whatever
+    device the images are already on
+    """
+
+    def __init__(self, id="rgb", algorithm=None):
+        self.id = id
+        self.algorithm = algorithm
+
+    def __call__(self, tensor, height, width, algorithm=None):
+        return images.resize(tensor, height, width, algorithm or self.algorithm)
+
+class TorchScriptUpscaler(object):
+    """
+    A learned upscaler (like ESRGAN) from a small local model exported with torch.jit. The model should take a
+    BCHW RGB image in 0..1 and return a larger one in the same format.
+
+    The model is repeatedly applied until the image is at least the requested size (so a 4x model can be used
+    for 2x, and a 2x one for 4x), and the result is then resampled to the exact size. Alpha channels are
+    resampled, not passed through the model.
+    """
+
+    def __init__(self, id, path, mode, max_passes=2):
+        self.id = id
+        self._path = path
+        self._mode = mode
+        self._max_passes = max_passes
+        self._model = None
+
+    def _load(self, device):
+        if self._model is None:
+            self._model = torch.jit.load(self._path, map_location="cpu").eval()
+            if self._mode.fp16: self._model = self._model.half()
+
+        return self._model.to(device)
+
+    def __call__(self, tensor, height, width, algorithm=None):
+        if height <= tensor.shape[-2] and width <= tensor.shape[-1]:
+            return images.resize(tensor, height, width, algorithm)
+
+        model = self._load(tensor.device)
+        dtype = next(model.parameters()).dtype
+
+        rgb, alpha = tensor[:, :3], tensor[:, 3:]
+
+        with torch.no_grad():
+            for _ in range(self._max_passes):
+                rgb = model(rgb.to(dtype)).float().clamp(0, 1)
+                if rgb.shape[-2] >= height and rgb.shape[-1] >= width: break
+
+        rgb = images.resize(rgb, height, width, algorithm)
+        if alpha.shape[1] == 0: return rgb
+
+        return torch.cat([rgb, images.resize(alpha, height, width, algorithm)], dim=1)
@@ -36,3 +36,29 @@ def image_to_artifact(im, artifact_type=generation_pb2.ARTIFACT_IMAGE):
         mime="image/png"
     )
 
+
+def latents_to_artifact(latents):
+    latents = latents.detach().to("cpu", torch.float16)
+
+    return generation_pb2.Artifact(
+        type=generation_pb2.ARTIFACT_LATENT,
+        binary=latents.numpy().astype("<f2").tobytes(),
+        shape=latents.shape,
+        mime="application/octet-stream"
+    )
+
+def artifact_to_latents(artifact, device=None):
+    if artifact.type != generation_pb2.ARTIFACT_LATENT:
+        raise NotImplementedError("Can't convert that artifact to latents")
+
+    shape = tuple(artifact.shape)
+    if len(shape) != 4 or shape[1] != 4:
+        raise ValueError(f"Latent artifacts should have a shape of (batch, 4, height, width), not {shape}")
+    # The unet halves the latents three times, so they need to be a multiple of 8 (an image a multiple of 64)
+    if shape[0] < 1 or shape[2] < 8 or shape[3] < 8 or shape[2] % 8 or shape[3] % 8:
+        raise ValueError(f"Latent artifacts should have a batch of at least 1, and a height and width that are multiples of 8, not {shape}")
+    if len(artifact.binary) != 2 * np.prod(shape):
+        raise ValueError(f"Latent artifact data doesn't match its shape {shape}")
+
+    latents = torch.from_numpy(np.frombuffer(artifact.binary, dtype="<f2").reshape(shape).copy())
+    return latents.to(device) if device else latents
@@ -0,0 +1,82 @@
+import os, sys, json
+from types import SimpleNamespace as SN
+
+import pytest
+import torch
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+sys.path.append(os.path.join(basePath, "sdgrpcserver", "generated"))
+
+import generation_pb2
+
+def tiny_pipeline(tokenizer_path):
+    """A UnifiedPipeline with tiny random modules, small enough to run on the CPU in a test"""
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer, CLIPConfig, CLIPFeatureExtractor
+    from diffusers import AutoencoderKL, UNet2DConditionModel, PNDMScheduler
+    from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+    from sdgrpcserver.pipeline.unified_pipeline import UnifiedPipeline
+
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for c in "abcdefghijklmnopqrstuvwxyz": vocab[c], vocab[c + "</w>"] = len(vocab), len(vocab) + 1
+    with open(os.path.join(tokenizer_path, "vocab.json"), "w") as f: json.dump(vocab, f)
+    with open(os.path.join(tokenizer_path, "merges.txt"), "w") as f: f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(os.path.join(tokenizer_path, "vocab.json"), os.path.join(tokenizer_path, "merges.txt"), model_max_length=16)
+
+    torch.manual_seed(0)
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4, max_position_embeddings=16
+    ))
+    unet = UNet2DConditionModel(
+        sample_size=8, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"), up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8
+    )
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, down_block_types=("DownEncoderBlock2D",) * 4, up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(8, 8, 8, 8), latent_channels=4, layers_per_block=1, norm_num_groups=4
+    )
+    safety_checker = StableDiffusionSafetyChecker(CLIPConfig(
+        text_config_dict=dict(hidden_size=32, intermediate_size=37, num_hidden_layers=1, num_attention_heads=4),
+        vision_config_dict=dict(hidden_size=32, intermediate_size=37, num_hidden_layers=1, num_attention_heads=4, image_size=32, patch_size=8),
+        projection_dim=16
+    ))
+    scheduler = PNDMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", skip_prk_steps=True)
+
+    return UnifiedPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=safety_checker, feature_extractor=CLIPFeatureExtractor(size=32, crop_size=32)
+    ).to("cpu")
+
+@pytest.fixture
+def pipeline(tmp_path):
+    return tiny_pipeline(str(tmp_path))
+
+@pytest.fixture
+def wrapper(pipeline):
+    from sdgrpcserver.manager import PipelineWrapper, EngineMode
+    return PipelineWrapper("tiny", EngineMode(enable_cuda=False), pipeline)
+
+def generation_params(**overrides):
+    """The parameters PipelineWrapper.generate takes, as GenerationServiceServicer would parse them, for a small image"""
+    params = SN(
+        height=64, width=64, cfg_scale=7.5, cfg_interval=1.0, cfg_threshold=0.0, convergence_tolerance=0.0, convergence_patience=3,
+        inpaint_crop_margin=None, hires_fix_strength=None, hires_fix_base_size=512, tile_size=None, tile_overlap=128, tile_batch_size=None,
+        eta=0, sampler=generation_pb2.SAMPLER_K_EULER, steps=4, seed=42, samples=1, strength=0.8
+    )
+    vars(params).update(overrides)
+    return params
+
+def simulate_out_of_memory(module, max_batch):
+    """Make a module's forward raise an allocation failure for batches bigger than max_batch. Returns the batch sizes it's called with"""
+    forward, batches = module.forward, []
+
+    def limited(sample, *args, **kwargs):
+        batches.append(sample.shape[0])
+        if sample.shape[0] > max_batch: raise RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 1 bytes")
+        return forward(sample, *args, **kwargs)
+
+    module.forward = limited
+    return batches
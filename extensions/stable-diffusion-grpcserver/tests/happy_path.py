@@ -30,6 +30,8 @@ algorithms = {
     "k_dpm_2": generation_pb2.SAMPLER_K_DPM_2,
     "k_dpm_2_ancestral": generation_pb2.SAMPLER_K_DPM_2_ANCESTRAL,
     "k_lms": generation_pb2.SAMPLER_K_LMS,
+    "k_dpmpp_2m": generation_pb2.SAMPLER_K_DPMPP_2M,
+    "k_dpmpp_2m_karras": generation_pb2.SAMPLER_K_DPMPP_2M_KARRAS,
 }
 
 args = {
@@ -43,6 +45,8 @@ args = {
         {"sampler": "k_heun"}, 
         {"sampler": "k_dpm_2"}, 
         {"sampler": "k_dpm_2_ancestral"}, 
+        {"sampler": "k_dpmpp_2m"}, 
+        {"sampler": "k_dpmpp_2m_karras"}, 
     ],
     "image": [
         {},
@@ -171,7 +175,7 @@ with open(os.path.normpath("testengines.yaml"), 'r') as cfg:
 
 stats = {}
 
-for vramO in range(4):
+for vramO in [*range(4), "auto"]:
     print("opt", vramO)
 
     torch.cuda.empty_cache()
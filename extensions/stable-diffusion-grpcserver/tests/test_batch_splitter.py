@@ -0,0 +1,64 @@
+import torch
+
+from sdgrpcserver.pipeline.unified_pipeline import BatchSplitter
+
+from conftest import generation_params, simulate_out_of_memory
+
+def test_split_batches_give_the_same_results():
+    torch.manual_seed(0)
+    model, inputs = torch.nn.Linear(8, 8), torch.randn(8, 8)
+    batches = simulate_out_of_memory(model, max_batch=2)
+
+    splitter = BatchSplitter()
+    outputs = splitter.run("key", 8, lambda start, end: model(inputs[start:end]))
+
+    assert torch.equal(outputs, torch.cat([model(inputs[start:start+2]) for start in range(0, 8, 2)]))
+    assert batches[:3] == [8, 4, 2]
+    assert splitter.limits == {"key": 2}
+
+    # Later batches of the same size start at the limit
+    batches.clear()
+    splitter.run("key", 8, lambda start, end: model(inputs[start:end]))
+    assert batches == [2, 2, 2, 2]
+
+def test_failures_at_a_batch_of_one_are_raised():
+    model = torch.nn.Linear(8, 8)
+    simulate_out_of_memory(model, max_batch=0)
+
+    try:
+        BatchSplitter().run("key", 2, lambda start, end: model(torch.randn(end - start, 8)))
+    except RuntimeError as e:
+        assert "can't allocate memory" in str(e)
+    else:
+        assert False, "Expected the allocation failure to be raised"
+
+def test_limits_recover_after_a_passing_shortage():
+    model, inputs = torch.nn.Linear(8, 8), torch.randn(4, 8)
+    splitter = BatchSplitter(recover_after=4)
+
+    # Runs out of memory once, at a batch of 4
+    forward, failed = model.forward, []
+    def flaky(x):
+        if x.shape[0] == 4 and not failed:
+            failed.append(True)
+            raise RuntimeError("CUDA out of memory")
+        return forward(x)
+    model.forward = flaky
+
+    splitter.run("key", 4, lambda start, end: model(inputs[start:end]))
+    assert splitter.limits == {"key": 2}
+
+    # Two more batches at the limit makes four in a row, and it's raised again
+    splitter.run("key", 4, lambda start, end: model(inputs[start:end]))
+    assert splitter.limits == {"key": 4}
+
+def test_pipeline_results_match_when_the_unet_runs_out_of_memory(wrapper):
+    params = dict(height=128, width=128, tile_size=64, tile_overlap=32)
+    expected, *_ = wrapper.generate("a cat", generation_params(**params))
+
+    batches = simulate_out_of_memory(wrapper._pipeline.unet, max_batch=2)
+    images, *_ = wrapper.generate("a cat", generation_params(**params))
+
+    # Nine tiles, each with an unconditional and text half
+    assert batches[:4] == [18, 9, 4, 2] and max(batches[4:]) <= 2
+    assert torch.allclose(images, expected, atol=1e-5)
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from sdgrpcserver import images
+
+def directionalblur_by_steps(tensor, sigma, direction, steps=256):
+    """The directional blur as it was originally done, every step as a full resolution gaussian blur"""
+    orig = tensor
+    sigma /= steps ** 0.5
+
+    for _ in range(steps):
+        tensor = images.gaussianblur(tensor, sigma)
+        tensor = torch.minimum(tensor, orig) if direction == "down" else torch.maximum(tensor, orig)
+
+    return tensor
+
+def mask(size):
+    mask = torch.zeros(1, 1, size, size)
+    mask[:, :, size // 4:size // 2, size // 3:size * 3 // 4] = 1
+    mask[:, :, size * 5 // 8:size * 3 // 4, size // 8:size // 4] = 1
+    return mask
+
+@pytest.mark.parametrize("direction", ["up", "down"])
+def test_directionalblur_at_full_resolution_is_exact(direction):
+    # A step sigma of 1 is too small to do any of the steps at a lower resolution
+    assert torch.allclose(images.directionalblur(mask(256), 16, direction), directionalblur_by_steps(mask(256), 16, direction), atol=1e-5)
+
+@pytest.mark.parametrize("direction", ["up", "down"])
+def test_directionalblur_at_lower_resolution_is_close(direction):
+    # A step sigma of 2 runs all but the refine steps at half resolution
+    result, expected = images.directionalblur(mask(256), 32, direction), directionalblur_by_steps(mask(256), 32, direction)
+
+    assert (result - expected).abs().max() < 0.03
+    assert (result - expected).abs().mean() < 0.005
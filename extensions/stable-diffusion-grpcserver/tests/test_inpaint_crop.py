@@ -0,0 +1,27 @@
+import torch
+
+from conftest import generation_params, simulate_out_of_memory
+
+def test_cropped_inpaint_splits_batches_that_run_out_of_memory(wrapper):
+    image = torch.rand(1, 3, 128, 128)
+    mask = torch.zeros(1, 3, 128, 128)
+    mask[:, :, 8:24, 8:24] = 1
+
+    batches = simulate_out_of_memory(wrapper._pipeline.unet, max_batch=1)
+
+    images, *_ = wrapper.generate("a cat", generation_params(height=128, width=128, strength=0.5, inpaint_crop_margin=8), image=image, mask=mask, outmask=mask)
+
+    assert images.shape == (1, 3, 128, 128)
+    # Only the crop was diffused, and the unconditional and text halves were split up once they ran out of memory
+    assert max(batches) == 2 and batches[-1] == 1
+    assert list(wrapper._batch_splitter.limits.values()) == [1]
+
+def test_cropped_inpaint_returns_no_latents(wrapper):
+    image = torch.rand(1, 3, 128, 128)
+    mask = torch.zeros(1, 3, 128, 128)
+    mask[:, :, 8:24, 8:24] = 1
+
+    *_, latents = wrapper.generate("a cat", generation_params(height=128, width=128, strength=0.5, inpaint_crop_margin=8), image=image, mask=mask, outmask=mask)
+
+    # Only the crop was diffused, so there are no latents of the whole image to keep for variations
+    assert latents is None
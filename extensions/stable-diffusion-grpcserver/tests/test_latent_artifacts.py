@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+import generation_pb2
+
+from sdgrpcserver.utils import latents_to_artifact, artifact_to_latents
+
+def test_latents_round_trip():
+    latents = torch.randn(2, 4, 8, 16)
+    assert torch.equal(artifact_to_latents(latents_to_artifact(latents)), latents.half())
+
+@pytest.mark.parametrize("shape", [(4, 8, 8), (1, 3, 8, 8), (1, 4, 8, 12), (0, 4, 8, 8), (1, 4, 0, 8), (1, 1, 4, 8, 8)])
+def test_badly_shaped_latents_are_rejected(shape):
+    artifact = generation_pb2.Artifact(type=generation_pb2.ARTIFACT_LATENT, binary=torch.zeros(shape).half().numpy().tobytes(), shape=shape)
+
+    with pytest.raises(ValueError):
+        artifact_to_latents(artifact)
+
+def test_latents_that_dont_match_their_shape_are_rejected():
+    artifact = latents_to_artifact(torch.randn(1, 4, 8, 8))
+    artifact.binary = artifact.binary[:-2]
+
+    with pytest.raises(ValueError):
+        artifact_to_latents(artifact)
@@ -0,0 +1,102 @@
+import threading, time
+
+import torch
+
+from sdgrpcserver.pipeline.module_offload import MODULE_ORDER, ModuleDevice, ModuleScheduler, TorchModuleDevice
+
+class SimulatedDevice(ModuleDevice):
+    """Tracks which modules are "on the device", with a fixed budget, and logs each load and which thread it ran on"""
+
+    def __init__(self, modules, budget=None, load_seconds=0):
+        self.modules = list(modules.values())
+        self.names = {id(module): name for name, module in modules.items()}
+        self.budget, self.load_seconds = budget, load_seconds
+        self.on, self.log = set(), []
+        self._lock = threading.Lock()
+
+    def resident(self, module):
+        with self._lock: return id(module) in self.on
+
+    def load(self, module):
+        time.sleep(self.load_seconds)
+        with self._lock:
+            self.on.add(id(module))
+            self.log.append(("load", self.names[id(module)], threading.current_thread() is threading.main_thread()))
+
+    def unload(self, module):
+        with self._lock:
+            self.on.discard(id(module))
+            self.log.append(("unload", self.names[id(module)]))
+
+    def available(self):
+        if self.budget is None: return None
+        with self._lock: return self.budget - sum(self.size(module) for module in self.modules if id(module) in self.on)
+
+def modules():
+    return {name: torch.nn.Linear(16, 16) for name in MODULE_ORDER}
+
+def scheduler(modules, device):
+    return ModuleScheduler(modules.get, device)
+
+def test_modules_are_prefetched_in_order():
+    mods = modules()
+    device = SimulatedDevice(mods, budget=10**9)
+    sched = scheduler(mods, device)
+
+    for name in MODULE_ORDER: sched.acquire(name)
+    sched.close()
+
+    # The first module is loaded when it's needed, the rest in the background while the one before is in use
+    assert [entry[1] for entry in device.log] == list(MODULE_ORDER)
+    assert [entry[2] for entry in device.log] == [True, False, False, False]
+
+def test_acquire_waits_for_a_prefetch_in_flight():
+    mods = modules()
+    device = SimulatedDevice(mods, budget=10**9, load_seconds=0.2)
+    sched = scheduler(mods, device)
+
+    sched.acquire("text_encoder")
+    # The unet is still loading in the background, so acquiring it has to wait for that rather than load it again
+    unet = sched.acquire("unet")
+    assert device.resident(unet)
+    assert [entry[1] for entry in device.log if entry[0] == "load"].count("unet") == 1
+    sched.close()
+
+def test_nothing_is_prefetched_without_a_budget():
+    mods = modules()
+    device = SimulatedDevice(mods)
+    sched = scheduler(mods, device)
+
+    for name in MODULE_ORDER:
+        sched.acquire(name)
+        # Only the module in use is kept on the device
+        assert device.on == {id(mods[name])}
+    sched.close()
+
+    assert all(entry[2] for entry in device.log if entry[0] == "load")
+
+def test_modules_are_evicted_to_fit_the_budget():
+    mods = modules()
+    size = ModuleDevice().size(mods["unet"])
+    # Room for two modules, alongside the headroom
+    device = SimulatedDevice(mods, budget=size * 2.5)
+    sched = scheduler(mods, device)
+
+    for name in MODULE_ORDER:
+        sched.acquire(name)
+        sched.reset()
+        assert id(mods[name]) in device.on and len(device.on) <= 2
+    sched.close()
+
+def test_torch_device_without_a_stream():
+    mods = modules()
+    device = TorchModuleDevice("cpu")
+    sched = ModuleScheduler(mods.get, device)
+
+    # On the CPU there's no side stream, so modules are just moved on the calling (or prefetch) thread
+    assert device._stream is None
+    for name in MODULE_ORDER:
+        module = sched.acquire(name)
+        assert device.resident(module)
+        assert torch.equal(module(torch.ones(1, 16)), mods[name](torch.ones(1, 16)))
+    sched.close()
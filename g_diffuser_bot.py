@@ -38,6 +38,7 @@ import os; os.chdir(DEFAULT_PATHS.root)
 
 import datetime
 import pathlib
+import io
 import urllib
 import json
 from typing import Optional
@@ -212,12 +213,38 @@ async def dream(
     args.steps = steps
     args.n = n
     args.interactive = True
+    args.draft_steps = DISCORD_BOT_SETTINGS.draft_steps
+    args.priority = "interactive"
+    args.user = "discord:" + str(interaction.user.id) # the server shares its time fairly between discord users
     gdl.print_namespace(args, debug=0, verbosity_level=1)
 
+    try: estimate = gdl.get_estimate(args)
+    except Exception as e: estimate = None # if the server can't estimate, just go ahead
+    if estimate is not None:
+        refusal = ""
+        if not estimate.admitted: refusal = "sorry @"+interaction.user.display_name+", the server is busy, please try again in about " + str(round(estimate.wait)) + "s"
+        elif estimate.seconds > DISCORD_BOT_SETTINGS.max_job_seconds: refusal = "sorry @"+interaction.user.display_name+", that would take about " + str(round(estimate.seconds)) + "s, please try fewer steps, a smaller size or a smaller n"
+        if refusal:
+            try: await interaction.followup.send(content=refusal, ephemeral=True)
+            except Exception as e: pass #print("exception in await interaction - " + str(e))
+            return
+        if estimate.wait >= 10:
+            try: await interaction.followup.send(content="@"+interaction.user.display_name+", your image should start in about " + str(round(estimate.wait)) + "s", ephemeral=True)
+            except Exception as e: pass #print("exception in await interaction - " + str(e))
+
+    draft_message = None
+    async def show_draft(artifact): # show each draft as soon as it arrives, the final result replaces it
+        nonlocal draft_message
+        draft_file = discord.File(io.BytesIO(artifact.binary), filename="draft.png")
+        try:
+            if draft_message is None: draft_message = await interaction.followup.send(file=draft_file, content="@" + interaction.user.display_name + ":  drafting  prompt: " + prompt)
+            else: await draft_message.edit(attachments=[draft_file])
+        except Exception as e: pass # print("exception in await interaction - " + str(e))
+
     start_time = datetime.datetime.now()
     try:
         #gdl.print_namespace(args)
-        await gdl.get_samples_async(args)
+        await gdl.get_samples_async(args, on_draft=show_draft)
     except Exception as e:
         print("error - " + str(e)); gdl.print_namespace(args, debug=1)
         try: await interaction.followup.send(content="sorry, something went wrong :(", ephemeral=True)
@@ -225,6 +252,7 @@ async def dream(
         return
 
     if "output_file" in args:
+        vary_args = argparse.Namespace(**vars(args)) # keep the args as they were used, for the vary buttons
         output_file = args.output_file # todo: use bot-specific output path
         sample_filename = DEFAULT_PATHS.outputs + "/" + output_file
         attachment_files = [discord.File(sample_filename)]
@@ -255,7 +283,9 @@ async def dream(
         args_str = "prompt: " + args_prompt + "  " + args_str + "  seed: " + str(args_seed)
         message = "@" + interaction.user.display_name + ":  /dream "+ args_str
 
-        try: await interaction.followup.send(files=attachment_files, content=message)
+        try:
+            if draft_message: await draft_message.edit(attachments=attachment_files, content=message, view=VaryView(vary_args))
+            else: await interaction.followup.send(files=attachment_files, content=message, view=VaryView(vary_args))
         except Exception as e: pass # print("exception in await interaction - " + str(e))
     else:
         print("error - " + args.err_txt); gdl.print_namespace(args, debug=1)
@@ -265,7 +295,49 @@ async def dream(
 
     print("elapsed time: " + str(datetime.datetime.now() - start_time) + "s")
     return
-    
+
+class VaryView(discord.ui.View): # buttons under a result to make variations of each of its samples
+    def __init__(self, args):
+        super().__init__(timeout=3600) # the server only keeps the latents of recent samples around anyway
+        answer_ids = args.answer_ids[:25] # discord allows at most 25 buttons per message
+        for i, answer_id in enumerate(answer_ids):
+            button = discord.ui.Button(label="vary" if len(answer_ids) == 1 else "vary " + str(i+1), style=discord.ButtonStyle.secondary)
+            button.callback = lambda interaction, answer_id=answer_id: vary(interaction, args, answer_id)
+            self.add_item(button)
+
+async def vary(interaction, args, answer_id): # low strength img2img from the latents the server kept for a sample, so no image upload or vae encode
+    global DEFAULT_PATHS, DEFAULT_SAMPLE_SETTINGS
+
+    try: await interaction.response.defer(thinking=True, ephemeral=False) # start by requesting more time to respond
+    except Exception as e: pass #print("exception in await interaction - " + str(e))
+
+    args = argparse.Namespace(**vars(args))
+    args.init_answer = answer_id
+    args.init_img = ""
+    args.noise_start = DEFAULT_SAMPLE_SETTINGS.variation_strength
+    args.seed = 0 # new random seeds for the variations
+    args.draft_steps = 0 # low strength variations are quick anyway
+    if "auto_seed" in args: del args.auto_seed
+    if "output_file" in args: del args.output_file
+
+    start_time = datetime.datetime.now()
+    try: await gdl.get_samples_async(args)
+    except Exception as e: print("error - " + str(e))
+
+    if "output_file" not in args:
+        print("error - " + vars(args).get("err_txt", "")); gdl.print_namespace(args, debug=1)
+        try: await interaction.followup.send(content="sorry, something went wrong (that sample may be too old to vary) :(", ephemeral=True)
+        except Exception as e: pass # print("exception in await interaction - " + str(e))
+        return
+
+    attachment_files = [discord.File(DEFAULT_PATHS.outputs + "/" + args.output_file)]
+    message = "@" + interaction.user.display_name + ":  variations of  prompt: " + args.prompt
+    try: await interaction.followup.send(files=attachment_files, content=message, view=VaryView(args))
+    except Exception as e: pass # print("exception in await interaction - " + str(e))
+
+    print("elapsed time: " + str(datetime.datetime.now() - start_time) + "s")
+    return
+
 def get_file_extension_from_url(url):
     tokens = os.path.splitext(os.path.basename(urllib.parse.urlsplit(url).path))
     if len(tokens) > 1: return tokens[1]
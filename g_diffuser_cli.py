@@ -307,6 +307,7 @@ def cli_resample(old_path, new_path, **kwargs):
             output_resample_args = argparse.Namespace(**(args_file_dict | vars(resample_args))) # merge with original args
             output_resample_args.n = 1
             output_resample_args.output_path = new_path # ensure output goes to specified path, regardless of output_path in args
+            if "priority" not in resample_args: output_resample_args.priority = "batch" # resampling can wait for interactive samples
 
             try:
                 samples = gdl.get_samples(output_resample_args)
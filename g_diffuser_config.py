@@ -41,14 +41,16 @@ DISCORD_BOT_SETTINGS.max_queue_print_items = 5   # max number of items to show f
 DISCORD_BOT_SETTINGS.default_output_n = 1        # default batch size to create images (n>1 will show a composite grid image)
 DISCORD_BOT_SETTINGS.max_output_limit = 10       # max number of samples to create simultaneously with -n param
 DISCORD_BOT_SETTINGS.max_steps_limit = 100       # max number of steps per sample command
+DISCORD_BOT_SETTINGS.max_job_seconds = 120        # refuse sample commands the server expects to take longer than this, so they don't hold everyone else up
+DISCORD_BOT_SETTINGS.draft_steps = 8             # if > 0, show a quick draft with this many steps while the full quality image is generated
 DISCORD_BOT_SETTINGS.accepted_attachments = [".png", ".jpg", ".jpeg"] # attachments in bot commands not matching this list will not be downloaded
 DISCORD_BOT_SETTINGS.state_file_path = "./g-diffuser-bot.json"        # relative to root path
 DISCORD_BOT_SETTINGS.activity = "/help, /about"
 
 #IMPORTANT - GRPC server settings (you probably won't need to adjust these settings unless you are an advanced user)
 GRPC_SERVER_SETTINGS.enable_local_network_access = True
-GRPC_SERVER_SETTINGS.memory_optimization_level = 2  # 2 is maximum memory savings, 1 is less, and 0 is off
-                                                    # 1 should be the best setting for most users
+GRPC_SERVER_SETTINGS.memory_optimization_level = "auto"  # "auto" picks the memory savings for each request from its size and the memory available,
+                                                         # and should be the best setting for most users. Or use a fixed level: 3 is maximum memory savings, 2 and 1 are less, and 0 is off
 GRPC_SERVER_SETTINGS.enable_mps = False
 GRPC_SERVER_SETTINGS.nsfw_behaviour="flag" #"block"
 GRPC_SERVER_SETTINGS.hf_token = "YOUR_HUGGINGFACE_ACCESS_TOKEN_HERE"
@@ -3,18 +3,32 @@ import argparse
 # ******************** SETTINGS BEGIN ************************
 
 DEFAULT_SAMPLE_SETTINGS = argparse.Namespace()
-DEFAULT_SAMPLE_SETTINGS.sampler = "k_euler"                  # default sampling mode (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms)
+DEFAULT_SAMPLE_SETTINGS.sampler = "k_euler"                  # default sampling mode (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms, k_dpmpp_2m, k_dpmpp_2m_karras)
 DEFAULT_SAMPLE_SETTINGS.n = 1                                # number of samples to generate per sample command by default
 DEFAULT_SAMPLE_SETTINGS.prompt = "something's wrong with the g-diffuser system"
 DEFAULT_SAMPLE_SETTINGS.resolution = (512,512)               # default resolution for img / video outputs
 DEFAULT_SAMPLE_SETTINGS.max_resolution = (1280,1280)         # if you run out of ram due to output resolution lower this to prevent exceeding your max memory
 DEFAULT_SAMPLE_SETTINGS.resolution_granularity = 64          # required by diffusers stable-diffusion for now due to latent space subsampling
+DEFAULT_SAMPLE_SETTINGS.hires_fix_strength = 0.              # if > 0, large images are sampled at hires_fix_base_size first, then refined at full size with this strength
+DEFAULT_SAMPLE_SETTINGS.hires_fix_base_size = 512            # size of the longest side of the first, lower resolution, pass of hires fix
+DEFAULT_SAMPLE_SETTINGS.tile_size = 0                        # if > 0, images larger than this are denoised in overlapping tiles of this size, to limit memory use
+DEFAULT_SAMPLE_SETTINGS.tile_overlap = 128                   # number of pixels neighbouring tiles overlap by when tiling
+DEFAULT_SAMPLE_SETTINGS.draft_steps = 0                      # if > 0, the server sends a quick draft of each sample with this many steps before the full quality one
+DEFAULT_SAMPLE_SETTINGS.draft_scale = 1.                     # resolution of drafts relative to the sample (at 1. the full quality pass carries on from the draft)
+DEFAULT_SAMPLE_SETTINGS.priority = ""                        # interactive or batch, batch samples give way to interactive ones on the server ("" for batch only when n <= 0)
 DEFAULT_SAMPLE_SETTINGS.noise_start = 0.42                   # default strength for pure img2img or style transfer
+DEFAULT_SAMPLE_SETTINGS.variation_strength = 0.3            # strength for variations of an earlier sample (the bot's vary buttons), lower stays closer to the original
 DEFAULT_SAMPLE_SETTINGS.noise_end = 0.01                     # can be used to influence in/out-painting quality
 DEFAULT_SAMPLE_SETTINGS.noise_eta = 0.70                     # can be used to influence in/out-painting quality
 DEFAULT_SAMPLE_SETTINGS.scale = 10.                           # default cfg scale
+DEFAULT_SAMPLE_SETTINGS.guidance_interval = 1.               # fraction of the steps to apply cfg for, lower to reduce sampling time
+DEFAULT_SAMPLE_SETTINGS.guidance_threshold = 0.              # stop applying cfg once guided and unguided predictions are this close (0 to disable)
 DEFAULT_SAMPLE_SETTINGS.steps = 32                           # default number of sampling steps, lower to reduce sampling time
+DEFAULT_SAMPLE_SETTINGS.convergence_tolerance = 0.           # stop sampling early once the image changes less than this per step (0 to disable)
+DEFAULT_SAMPLE_SETTINGS.convergence_patience = 3             # number of steps in a row the change must stay below the tolerance to stop early
+DEFAULT_SAMPLE_SETTINGS.checkpoint_steps = ""                # comma separated steps the server keeps latents at, so sample(resume_from="last", ...) can skip them
 DEFAULT_SAMPLE_SETTINGS.noise_q = 1.                         # fall-off of shaped noise distribution for in/out-painting
+DEFAULT_SAMPLE_SETTINGS.inpaint_crop_margin = -1             # if >= 0, in-painting only samples the masked area plus this many pixels of context (much faster for small masks)
 DEFAULT_SAMPLE_SETTINGS.auto_seed_range = (10000,99999)      # automatic random seed range
 DEFAULT_SAMPLE_SETTINGS.model_name = "stable-diffusion-v1-4" # default model id to use, see g_diffuser_config_models.yaml for the list of models to be loaded by grpc server
 